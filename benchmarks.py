@@ -0,0 +1,664 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks cho các đường nóng của pipeline.
+
+Chạy:  python benchmarks.py [tên benchmark ...]   (không truyền gì = chạy tất cả)
+"""
+import argparse
+import os
+import random
+import re
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from test_cases_extended import EXTENDED_TEST_CASES
+from vietnamese_foods_extended import (
+    VIETNAMESE_FOODS_NUTRITION,
+    FoodExtractor,
+    FoodNameMatcher,
+    normalize_vietnamese,
+)
+
+
+def _timeit(func, repeat: int) -> float:
+    """Return average seconds per call."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def _random_word(rng: random.Random, min_len: int = 3, max_len: int = 7) -> str:
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(min_len, max_len)))
+
+
+def bench_matcher_index():
+    """find_food cost as the alias count grows (inverted token index vs linear scan)."""
+    rng = random.Random(42)
+    queries = ["2 to pho bo tai", "com suon nuong", "banh mi thit nuong", "tra sua tran chau", "mon gi do la"]
+
+    def linear_find(matcher, text):
+        # Reference: the pre-index full scan over alias_map.
+        input_tokens = matcher.normalize_text(text).split()
+        best = (None, 0.0)
+        for alias, food_name in matcher.alias_map.items():
+            alias_tokens = alias.split()
+            if all(tok in input_tokens for tok in alias_tokens):
+                conf = matcher._token_confidence(len(alias_tokens), len(input_tokens))
+                if conf > best[1]:
+                    best = (food_name, conf)
+        return best
+
+    print(f"{'aliases':>10} {'indexed (us)':>14} {'linear (us)':>14}")
+    matcher = FoodNameMatcher()
+    food_names = list(matcher.food_map.values())
+    for target in (1_000, 10_000, 100_000):
+        while len(matcher.alias_map) < target:
+            alias = " ".join(_random_word(rng) for _ in range(rng.randint(1, 3)))
+            matcher.add_alias(alias, rng.choice(food_names))
+        indexed = _timeit(lambda: [matcher.find_food(q) for q in queries], 50) / len(queries)
+        linear = _timeit(lambda: [linear_find(matcher, q) for q in queries], 3) / len(queries)
+        print(f"{len(matcher.alias_map):>10} {indexed * 1e6:>14.1f} {linear * 1e6:>14.1f}")
+
+
+def bench_normalizer():
+    """normalize_text: multi-pass re.sub vs single str.translate pass (+ LRU memo)."""
+    def regex_normalize(text):
+        text = text.lower()
+        text = re.sub(r'[àáảãạăắằẳẵặâấầẩẫậ]', 'a', text)
+        text = re.sub(r'[đ]', 'd', text)
+        text = re.sub(r'[èéẻẽẹêếềểễệ]', 'e', text)
+        text = re.sub(r'[ìíỉĩị]', 'i', text)
+        text = re.sub(r'[òóỏõọôốồổỗộơớờởỡợ]', 'o', text)
+        text = re.sub(r'[ùúủũụưứừửữự]', 'u', text)
+        text = re.sub(r'[ỳýỷỹỵ]', 'y', text)
+        return re.sub(r'\s+', ' ', text).strip()
+
+    texts = [text for text, _ in EXTENDED_TEST_CASES]
+    for food_name, data in VIETNAMESE_FOODS_NUTRITION.items():
+        texts.append(food_name)
+        texts.extend(data.get("aliases", []))
+    mismatches = sum(regex_normalize(t) != normalize_vietnamese(t) for t in texts)
+
+    def cold():
+        normalize_vietnamese.cache_clear()
+        for t in texts:
+            normalize_vietnamese(t)
+
+    regex = _timeit(lambda: [regex_normalize(t) for t in texts], 20) / len(texts)
+    translate = _timeit(cold, 20) / len(texts)
+    warm = _timeit(lambda: [normalize_vietnamese(t) for t in texts], 20) / len(texts)
+    print(f"texts={len(texts)} mismatches={mismatches}")
+    print(f"re.sub x8        : {regex * 1e6:7.2f} us/text")
+    print(f"translate (cold) : {translate * 1e6:7.2f} us/text  ({regex / translate:.1f}x)")
+    print(f"translate (memo) : {warm * 1e6:7.2f} us/text  ({regex / warm:.1f}x)")
+
+
+def _would_call_llm(foods, threshold: float = 0.6) -> bool:
+    """Mirror of NutritionPipelineAdvanced._should_use_deepseek on extractor output."""
+    return not foods or min(float(f.get('match_confidence', 0) or 0) for f in foods) < threshold
+
+
+def bench_extraction_modes():
+    """FoodExtractor split vs Aho-Corasick scan on the 300 test cases."""
+    texts = [text for text, _ in EXTENDED_TEST_CASES]
+    print(f"{'mode':>6} {'us/input':>10} {'foods':>7} {'multi-food inputs':>18} {'LLM fallbacks':>14}")
+    for mode in FoodExtractor.MODES:
+        extractor = FoodExtractor(mode=mode)
+        extractor.extract(texts[0])  # build lazily-created indexes outside the timer
+        results = [extractor.extract(t) for t in texts]
+        per_input = _timeit(lambda: [extractor.extract(t) for t in texts], 5) / len(texts)
+        foods = sum(len(r) for r in results)
+        multi = sum(len(r) > 1 for r in results)
+        fallbacks = sum(_would_call_llm(r) for r in results)
+        print(f"{mode:>6} {per_input * 1e6:>10.1f} {foods:>7} {multi:>18} {fallbacks:>14}")
+
+
+def bench_llm_call_rate():
+    """Share of test-corpus inputs sent to DeepSeek, without and with the top-1 margin rule."""
+    from nutrition_pipeline_advanced import NutritionPipelineAdvanced
+
+    texts = [text for text, _ in EXTENDED_TEST_CASES]
+    pipeline = NutritionPipelineAdvanced()
+    pipeline.deepseek_client.is_available = lambda: True  # count would-be calls, never call
+    margin = pipeline.candidate_margin
+    print(f"{'mode':>6} {'margin':>7} {'LLM calls':>10} {'rate':>7}")
+    for mode in FoodExtractor.MODES:
+        pipeline.extractor.mode = mode
+        for candidate_margin in (0.0, margin):
+            pipeline.candidate_margin = candidate_margin
+            calls = 0
+            for text in texts:
+                extracted = pipeline.extractor.extract(text)
+                analyzed = [food for food in map(pipeline._analyze_food, extracted) if food]
+                calls += pipeline._should_use_deepseek(extracted, analyzed)[0]
+            print(f"{mode:>6} {candidate_margin:>7.2f} {calls:>10} {calls / len(texts):>7.1%}")
+
+
+def bench_segment_regex():
+    """Per-segment stop words + quantity parsing: per-call re patterns vs precompiled, with re cache thrash."""
+    extractor = FoodExtractor()
+    unit_pattern = extractor.parser.unit_pattern
+    number_words = extractor.parser.number_words
+
+    # Reference: the pre-registry code, building every pattern per call.
+    def legacy_parse(text):
+        text = text.lower().strip()
+        m = re.search(r'(\d+(?:\.\d+)?)\s*(g|gr|gram|ml|lít|l|kg|kilogram)(?![a-zA-Z])', text)
+        if m:
+            amount, unit = float(m.group(1)), m.group(2)
+            if unit in ['kg', 'kilogram']:
+                amount, unit = amount * 1000, 'g'
+            elif unit in ('lít', 'l'):
+                amount, unit = amount * 1000, 'ml'
+            return {'amount': amount, 'unit': unit, 'type': 'exact', 'confidence': 1.0}
+        m = re.search(rf'(\d+)\s*{unit_pattern}', text)
+        if m:
+            return {'amount': int(m.group(1)), 'unit': m.group(2), 'type': 'relative', 'confidence': 0.9}
+        m = re.search(
+            rf'(một|môt|mot|hai|ba|bốn|bôn|bon|năm|nam|sáu|sau|bảy|bây|bay|tám|tam|chín|chin|mười|muoi|mấy|vài|dăm)\s+{unit_pattern}',
+            text,
+        )
+        if m:
+            return {'amount': number_words.get(m.group(1), 1), 'unit': m.group(2), 'type': 'relative', 'confidence': 0.8}
+        m = re.search(r'(\d+)', text)
+        if m:
+            return {'amount': int(m.group(1)), 'unit': 'phần', 'type': 'relative', 'confidence': 0.7}
+        return {'amount': 1, 'unit': 'phần', 'type': 'relative', 'confidence': 0.5}
+
+    def legacy_remove_quantity(text, quantity_info):
+        result = text.lower()
+        if quantity_info['type'] == 'exact':
+            result = re.sub(r'\d+(?:\.\d+)?\s*(?:g|gr|gram|ml|lít|l|kg|kilogram)', '', result)
+        elif quantity_info['amount'] > 1:
+            result = re.sub(f"{quantity_info['amount']}\\s*{re.escape(quantity_info['unit'])}", '', result)
+        else:
+            result = re.sub(f"(?:một|môt|mot|1)\\s*{re.escape(quantity_info['unit'])}", '', result)
+        result = re.sub(r'\s+', ' ', result).strip()
+        for word in ['cái', 'cục', 'miếng', 'phần', 'suất', 'của']:
+            result = re.sub(f'\\b{word}\\b', '', result)
+        return re.sub(r'\s+', ' ', result).strip()
+
+    def legacy_segment(part):
+        clean = part
+        for word in FoodExtractor.STOP_WORDS:
+            clean = re.sub(rf'\b{re.escape(word)}\b', ' ', clean)
+        clean = re.sub(r'\s+', ' ', clean).strip()
+        quantity = legacy_parse(clean)
+        return quantity, legacy_remove_quantity(clean, quantity)
+
+    def compiled_segment(part):
+        clean = extractor.WHITESPACE_RE.sub(' ', extractor.stop_words_re.sub(' ', part)).strip()
+        quantity = extractor.parser.parse(clean)
+        return quantity, extractor._remove_quantity_from_text(clean, quantity)
+
+    segments = [
+        part.strip()
+        for text, _ in EXTENDED_TEST_CASES
+        for part in extractor.SEPARATOR_RE.split(text.lower())
+        if len(part.strip()) >= 2
+    ]
+    mismatches = sum(legacy_segment(p) != compiled_segment(p) for p in segments)
+
+    def run(segment_fn, thrash):
+        for part in segments:
+            if thrash:
+                re.purge()  # other code pushed our patterns out of re's 512-entry cache
+            segment_fn(part)
+
+    print(f"segments={len(segments)} mismatches={mismatches}")
+    print(f"{'re cache':>10} {'per-call (us)':>14} {'compiled (us)':>14}")
+    for thrash in (False, True):
+        legacy = _timeit(lambda: run(legacy_segment, thrash), 3) / len(segments)
+        compiled = _timeit(lambda: run(compiled_segment, thrash), 3) / len(segments)
+        print(f"{'thrashed' if thrash else 'warm':>10} {legacy * 1e6:>14.1f} {compiled * 1e6:>14.1f}")
+
+
+def bench_extract_cache():
+    """FoodExtractor.extract on a repetitive (Zipf) daily-log workload, with and without the LRU cache."""
+    rng = random.Random(5)
+    texts = [text for text, _ in EXTENDED_TEST_CASES]
+    weights = [1 / (rank + 1) for rank in range(len(texts))]
+    workload = rng.choices(texts, weights=weights, k=5000)
+    print(f"{'cache size':>10} {'us/call':>9} {'hit rate':>9}")
+    for cache_size in (0, 64, 1024):
+        extractor = FoodExtractor(cache_size=cache_size)
+        extractor.extract(texts[0])
+        if extractor.cache is not None:
+            extractor.cache.clear()
+        per_call = _timeit(lambda: [extractor.extract(t) for t in workload], 1) / len(workload)
+        hit_rate = extractor.cache.stats()["hit_rate"] if extractor.cache is not None else 0.0
+        print(f"{cache_size:>10} {per_call * 1e6:>9.1f} {hit_rate:>9.1%}")
+
+
+def bench_typo_correction():
+    """find_food on aliases with one injected typo, with and without the SymSpell index."""
+    rng = random.Random(7)
+    matcher = FoodNameMatcher()
+    samples = []
+    for alias, food_name in matcher.alias_map.items():
+        tokens = alias.split()
+        positions = [i for i, tok in enumerate(tokens) if len(tok) >= 3 and tok.isalpha()]
+        if not positions:
+            continue
+        i = rng.choice(positions)
+        tok = tokens[i]
+        j = rng.randrange(len(tok))
+        edit = rng.choice(("insert", "delete", "replace"))
+        if edit == "insert":
+            tok = tok[:j] + rng.choice(string.ascii_lowercase) + tok[j:]
+        elif edit == "delete":
+            tok = tok[:j] + tok[j + 1:]
+        else:
+            tok = tok[:j] + rng.choice(string.ascii_lowercase) + tok[j + 1:]
+        typo = " ".join(tokens[:i] + [tok] + tokens[i + 1:])
+        if typo not in matcher.alias_map and typo not in matcher.food_map:
+            samples.append((typo, food_name))
+
+    def run():
+        resolved = correct = 0
+        for typo, food_name in samples:
+            name, confidence = matcher.find_food(typo)
+            if confidence >= 0.6:
+                resolved += 1
+                correct += name == food_name
+        return resolved, correct
+
+    with_index = run()
+    per_call = _timeit(lambda: [matcher.find_food(t) for t, _ in samples], 3) / len(samples)
+    matcher._match_with_typo_correction = lambda tokens, index=None: (None, 0.0, None)
+    without_index = run()
+    print(f"typo samples={len(samples)}  (>= 0.6 confidence = no DeepSeek call)")
+    print(f"without correction: resolved={without_index[0]} correct={without_index[1]}")
+    print(f"with SymSpell     : resolved={with_index[0]} correct={with_index[1]}  {per_call * 1e6:.0f} us/call")
+
+
+def bench_approval():
+    """Admin approval: full build_index vs incremental learn() as the dataset grows."""
+    rng = random.Random(11)
+    matcher = FoodNameMatcher()
+    added = []
+    print(f"{'foods':>8} {'rebuild (ms)':>14} {'learn (us)':>12}")
+    try:
+        for target in (1_000, 10_000, 50_000):
+            while len(VIETNAMESE_FOODS_NUTRITION) < target:
+                name = " ".join(_random_word(rng) for _ in range(rng.randint(1, 3)))
+                if name not in VIETNAMESE_FOODS_NUTRITION:
+                    VIETNAMESE_FOODS_NUTRITION[name] = {"aliases": [name + " x"], "category": "custom"}
+                    added.append(name)
+            rebuild = _timeit(matcher.build_index, 3)
+
+            def approve():
+                name = f"mon duyet {len(added)}"
+                added.append(name)
+                matcher.learn(name, {"calories_per_100g": 100, "aliases": [name + " y"]}, aliases=[name + " z"])
+
+            learn = _timeit(approve, 200)
+            print(f"{len(VIETNAMESE_FOODS_NUTRITION):>8} {rebuild * 1e3:>14.1f} {learn * 1e6:>12.1f}")
+    finally:
+        for name in added:
+            VIETNAMESE_FOODS_NUTRITION.pop(name, None)
+
+
+def bench_startup():
+    """Worker cold start (import + first FoodExtractor) with and without the food_index.py artifact."""
+    import statistics
+    import subprocess
+    import tempfile
+
+    from food_index import build_artifact
+
+    # config/dbs are imported by main.py before the dataset module anyway.
+    probe = (
+        "import time, config, dbs; t = time.perf_counter(); "
+        "from vietnamese_foods_extended import FoodExtractor; FoodExtractor(); "
+        "print(time.perf_counter() - t)"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        artifact = build_artifact(os.path.join(tmp, "food_index.pkl"))
+        print(f"artifact: {os.path.getsize(artifact)} bytes")
+        for label, path in (("build", ""), ("artifact", str(artifact))):
+            env = {**os.environ, "FOOD_INDEX_PATH": path}
+            runs = [
+                float(subprocess.check_output([sys.executable, "-c", probe], env=env, cwd=os.path.dirname(__file__) or "."))
+                for _ in range(7)
+            ]
+            print(f"{label:>9}: median {statistics.median(runs) * 1e3:6.1f} ms  (min {min(runs) * 1e3:.1f})")
+
+
+def bench_http_pool():
+    """DeepSeek call overhead against the local mock: fresh requests.post per call vs the shared keep-alive pool."""
+    import asyncio
+
+    import requests
+
+    import http_client
+    from deepseek_client import DeepSeekClient
+    from mock_deepseek_server import MockDeepSeekServer
+
+    server = MockDeepSeekServer().start()
+    client = DeepSeekClient()
+    client.api_key = "bench"
+    client.base_url = server.base_url
+    url, payload, headers = client._build_request("2 tô phở bò và 1 ly trà đá")
+    repeat = 300
+    try:
+        def fresh():
+            response = requests.post(url, json=payload, headers=headers, timeout=http_client.request_timeouts())
+            response.raise_for_status()
+            return response.json()
+
+        for label, call in (("requests.post", fresh), ("pooled session", lambda: http_client.post_json(url, payload, headers))):
+            connections = server.connections
+            per_call = _timeit(call, repeat)
+            print(f"{label:>15}: {per_call * 1e6:7.0f} us/call  ({server.connections - connections} connections)")
+
+        async def async_calls():
+            await http_client.apost_json(url, payload, headers)  # open the pooled connection
+            start = time.perf_counter()
+            for _ in range(repeat):
+                await http_client.apost_json(url, payload, headers)
+            elapsed = (time.perf_counter() - start) / repeat
+            await http_client.aclose_clients()
+            return elapsed
+
+        connections = server.connections
+        per_call = asyncio.run(async_calls())
+        print(f"{'async pool':>15}: {per_call * 1e6:7.0f} us/call  ({server.connections - connections} connections)")
+    finally:
+        server.stop()
+        http_client.close_clients()
+    print("(mock is plain HTTP on loopback; against api.deepseek.com each fresh call also pays DNS + TLS)")
+
+
+def bench_deepseek_cache():
+    """Repeated low-confidence phrases across 2 workers against the mock (50 ms/call): no cache vs LRU + shared SQLite."""
+    import tempfile
+
+    import http_client
+    from caching import TieredResponseCache
+    from dbs import ResponseCacheDB
+    from deepseek_client import DeepSeekClient
+    from mock_deepseek_server import MockDeepSeekServer
+
+    rng = random.Random(13)
+    phrases = [f"món lạ số {i} với topping {i % 7}" for i in range(60)]
+    weights = [1 / (rank + 1) for rank in range(len(phrases))]
+    workload = rng.choices(phrases, weights=weights, k=400)
+    server = MockDeepSeekServer(delay=0.05).start()
+    print(f"{'mode':>12} {'ms/call':>8} {'upstream':>9} {'hit rate':>9}")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for mode in ("no cache", "lru+sqlite"):
+                workers = []
+                for _ in range(2):
+                    client = DeepSeekClient()
+                    client.api_key = "bench"
+                    client.base_url = server.base_url
+                    client.response_cache = (
+                        TieredResponseCache(memory_size=32, store=ResponseCacheDB(os.path.join(tmp, "cache.db")))
+                        if mode != "no cache" else None
+                    )
+                    workers.append(client)
+                before = server.requests
+                per_call = _timeit(lambda: [workers[i % 2].analyze(text) for i, text in enumerate(workload)], 1) / len(workload)
+                lookups = hits = 0
+                for client in workers:
+                    if client.response_cache is not None:
+                        stats = client.response_cache.stats()
+                        hits += stats["memoryHits"] + stats["storeHits"]
+                        lookups += stats["memoryHits"] + stats["storeHits"] + stats["misses"]
+                hit_rate = hits / lookups if lookups else 0.0
+                print(f"{mode:>12} {per_call * 1e3:>8.2f} {server.requests - before:>9} {hit_rate:>9.1%}")
+    finally:
+        server.stop()
+        http_client.close_clients()
+
+
+def bench_llm_tokens():
+    """LLM fallback on the 300 test cases against the mock: whole sentence vs only unresolved segments (~tokens)."""
+    import http_client
+    from config import Config
+    from mock_deepseek_server import MockDeepSeekServer
+    from nutrition_pipeline_advanced import NutritionPipelineAdvanced
+
+    texts = [text for text, _ in EXTENDED_TEST_CASES]
+    server = MockDeepSeekServer().start()
+    scope_before = Config.LLM_FALLBACK_SCOPE
+    print(f"{'scope':>9} {'calls':>6} {'user tok':>9} {'prompt tok':>11} {'compl. tok':>11} {'local kept':>11}")
+    try:
+        for scope in ("sentence", "segment"):
+            Config.LLM_FALLBACK_SCOPE = scope
+            pipeline = NutritionPipelineAdvanced(deterministic_weight=True)
+            pipeline._persist_daily_totals = lambda: None
+            pipeline._persist_deepseek_pending = lambda *args: None
+            client = pipeline.deepseek_client
+            client.api_key = "bench"
+            client.base_url = server.base_url
+            client.response_cache = None
+            before = (server.requests, server.prompt_tokens, server.completion_tokens)
+            user_tokens = kept = 0
+            for text in texts:
+                result = pipeline.process_input(text)
+                if result["deepseek_used"]:
+                    user_tokens += (len(result["deepseek_input"].encode("utf-8")) + 3) // 4
+                    kept += sum(1 for f in result["foods"] if "raw_food_name" not in f)
+            calls, prompt, completion = (now - then for now, then in zip(
+                (server.requests, server.prompt_tokens, server.completion_tokens), before))
+            print(f"{scope:>9} {calls:>6} {user_tokens:>9} {prompt:>11} {completion:>11} {kept:>11}")
+    finally:
+        Config.LLM_FALLBACK_SCOPE = scope_before
+        server.stop()
+        http_client.close_clients()
+
+
+def bench_llm_batch():
+    """16 concurrent /analyze-like callers, one unresolved segment each: per-request calls vs micro-batching (window, max items)."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    import http_client
+    from config import Config
+    from mock_deepseek_server import MockDeepSeekServer
+    from nutrition_pipeline_advanced import NutritionPipelineAdvanced
+
+    texts = [f"2 tô phở bò, món lạ số {i}" for i in range(320)]
+    settings_before = (Config.DEEPSEEK_BATCH_WINDOW_MS, Config.DEEPSEEK_BATCH_MAX_ITEMS)
+    # Round-trip bound (fixed 50 ms) vs output bound (+0.5 ms per completion token)
+    for token_delay in (0.0, 0.0005):
+        server = MockDeepSeekServer(delay=0.05, token_delay=token_delay).start()
+        print(f"\nmock: 50 ms + {token_delay * 1e3:g} ms/output token")
+        print(f"{'batch':>12} {'calls':>6} {'prompt tok':>11} {'req/s':>7} {'p50 ms':>7} {'p95 ms':>7}")
+        try:
+            for window_ms, max_items in ((0, 16), (20, 4), (20, 16), (50, 16)):
+                Config.DEEPSEEK_BATCH_WINDOW_MS = window_ms
+                Config.DEEPSEEK_BATCH_MAX_ITEMS = max_items
+                pipeline = NutritionPipelineAdvanced(deterministic_weight=True)
+                pipeline._persist_daily_totals = lambda: None
+                pipeline._persist_deepseek_pending = lambda *args: None
+                client = pipeline.deepseek_client
+                client.api_key = "bench"
+                client.base_url = server.base_url
+                client.response_cache = None
+                latencies = []
+
+                def timed(text):
+                    start = time.perf_counter()
+                    pipeline.process_input(text)
+                    latencies.append(time.perf_counter() - start)
+
+                before = (server.requests, server.prompt_tokens)
+                start = time.perf_counter()
+                with ThreadPoolExecutor(16) as pool:
+                    list(pool.map(timed, texts))
+                elapsed = time.perf_counter() - start
+                latencies.sort()
+                p50, p95 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)]
+                label = f"{window_ms} ms/{max_items}" if window_ms else "off"
+                print(f"{label:>12} {server.requests - before[0]:>6} {server.prompt_tokens - before[1]:>11} "
+                      f"{len(texts) / elapsed:>7.1f} {p50 * 1e3:>7.1f} {p95 * 1e3:>7.1f}")
+        finally:
+            Config.DEEPSEEK_BATCH_WINDOW_MS, Config.DEEPSEEK_BATCH_MAX_ITEMS = settings_before
+            server.stop()
+            http_client.close_clients()
+
+
+def _db_write_worker(db_path, mode, worker, threads, writes, results):
+    """One gunicorn-like worker process: `threads` DB-pool threads appending entries (+ /history read)."""
+    import sqlite3
+    from concurrent.futures import ThreadPoolExecutor
+
+    from dbs import DailyLogDB
+
+    if mode == "per-call":  # pre-pool behaviour: fresh connection, rollback journal, default pragmas
+        DailyLogDB._connect = lambda self: sqlite3.connect(self.db_path)
+    db = DailyLogDB(db_path)
+    foods = [{"foodId": f"f{i}", "foodName": "phở bò", "nutrition": {"calories": 450, "protein": 25}}
+             for i in range(3)]
+
+    def run(thread):
+        patient = f"w{worker}-t{thread}"
+        for i in range(writes):
+            day = f"2025-01-{i % 28 + 1:02d}"
+            db.append_entry(patient, day, {"entryId": f"{thread}-{i}", "foods": foods,
+                                           "mealSummary": {"calories": 1350, "protein": 75}})
+            db.get_history(patient, day, day)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(run, range(threads)))
+    results.put(time.perf_counter() - start)
+
+
+def bench_db_write():
+    """Daily-log writes from 2 worker processes x 4 DB threads: connection per call (rollback journal) vs per-thread WAL connections."""
+    import multiprocessing
+    import tempfile
+
+    ctx = multiprocessing.get_context("fork")
+    processes, threads, writes = 2, 4, 150
+    print(f"{'mode':>10} {'writes/s':>9} {'ms/write':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("per-call", "pooled"):
+            db_path = os.path.join(tmp, f"{mode}.db")
+            results = ctx.Queue()
+            workers = [ctx.Process(target=_db_write_worker, args=(db_path, mode, w, threads, writes, results))
+                       for w in range(processes)]
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+            total = processes * threads * writes
+            per_write = sum(results.get() for _ in workers) / processes / (threads * writes) * threads
+            print(f"{mode:>10} {total / elapsed:>9.0f} {per_write * 1e3:>9.2f}")
+
+
+def _history_read_worker(db_path, mode, worker, readers, seconds, results):
+    """One worker process: `readers` threads polling /history while one thread appends entries."""
+    import threading
+
+    from dbs import DailyLogDB
+
+    db = DailyLogDB(db_path)
+    if mode == "ensure-on-read":  # previous behaviour: INSERT OR IGNORE + commit before every read
+        db.known_patients = None
+        get_history = db.get_history
+        db.get_history = lambda *args: (db.ensure_patient(args[0]), get_history(*args))[1]
+    foods = [{"foodId": f"f{i}", "foodName": "phở bò", "nutrition": {"calories": 450}} for i in range(3)]
+    stop = time.perf_counter() + seconds
+    counts = {"reads": 0, "writes": 0}
+    latencies = []
+
+    def read(thread):
+        n = 0
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            db.get_history(f"p{(worker * readers + thread + n) % 50}", "2025-01-01", "2025-01-07")
+            latencies.append(time.perf_counter() - start)
+            n += 1
+        counts["reads"] += n
+
+    def write():
+        n = 0
+        while time.perf_counter() < stop:
+            db.append_entry(f"p{n % 50}", f"2025-01-{n % 7 + 1:02d}",
+                            {"entryId": f"w{worker}-{n}", "foods": foods, "mealSummary": {"calories": 1350}})
+            n += 1
+        counts["writes"] += n
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in range(readers)] + [threading.Thread(target=write)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    results.put((counts["reads"], counts["writes"], latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]))
+
+
+def bench_history_read():
+    """/history polling (2 processes x 6 reader threads) with a writer thread per process: ensure_patient on every read vs read-only."""
+    import multiprocessing
+    import tempfile
+
+    from dbs import DailyLogDB
+
+    ctx = multiprocessing.get_context("fork")
+    processes, readers, seconds = 2, 6, 3.0
+    print(f"{'mode':>15} {'reads/s':>8} {'writes/s':>9} {'p50 ms':>7} {'p99 ms':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ("ensure-on-read", "read-only"):
+            db_path = os.path.join(tmp, f"{mode}.db")
+            db = DailyLogDB(db_path)
+            for n in range(350):  # 50 patients x a week of history
+                db.append_entry(f"p{n % 50}", f"2025-01-{n % 7 + 1:02d}",
+                                {"entryId": f"seed-{n}", "foods": [], "mealSummary": {"calories": 500}})
+            results = ctx.Queue()
+            workers = [ctx.Process(target=_history_read_worker, args=(db_path, mode, w, readers, seconds, results))
+                       for w in range(processes)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            stats = [results.get() for _ in workers]
+            reads, writes = sum(r[0] for r in stats), sum(r[1] for r in stats)
+            p50, p99 = max(r[2] for r in stats), max(r[3] for r in stats)
+            print(f"{mode:>15} {reads / seconds:>8.0f} {writes / seconds:>9.0f} {p50 * 1e3:>7.2f} {p99 * 1e3:>7.2f}")
+
+
+BENCHMARKS = {
+    "matcher-index": bench_matcher_index,
+    "normalizer": bench_normalizer,
+    "extraction-modes": bench_extraction_modes,
+    "llm-call-rate": bench_llm_call_rate,
+    "segment-regex": bench_segment_regex,
+    "extract-cache": bench_extract_cache,
+    "typo-correction": bench_typo_correction,
+    "approval": bench_approval,
+    "startup": bench_startup,
+    "http-pool": bench_http_pool,
+    "deepseek-cache": bench_deepseek_cache,
+    "llm-tokens": bench_llm_tokens,
+    "llm-batch": bench_llm_batch,
+    "db-write": bench_db_write,
+    "history-read": bench_history_read,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)}")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(unknown)}")
+    for name in args.names or list(BENCHMARKS):
+        print(f"\n=== {name}: {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Bounded in-process caches shared by the pipeline.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """Thread-safe bounded LRU map with hit/miss/eviction counters."""
+
+    def __init__(self, maxsize: int = 1024):
+        if maxsize <= 0:
+            raise ValueError("maxsize must be positive")
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class TieredResponseCache:
+    """
+    Per-process LRU in front of an optional shared store (e.g. dbs.ResponseCacheDB).
+
+    Entries expire after `ttl` seconds, or `negative_ttl` for failed/empty results. A store
+    hit is promoted into the LRU with the store's expiry. Values are deep-copied in and
+    out so callers may mutate what they get.
+    """
+
+    def __init__(
+        self,
+        memory_size: int = 512,
+        store: Any = None,
+        ttl: float = 7 * 24 * 3600,
+        negative_ttl: float = 60,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.memory = LRUCache(memory_size)
+        self.store = store
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.store_errors = 0
+
+    def _count(self, field: str) -> None:
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def get(self, key: str) -> Optional[Any]:
+        now = self.clock()
+        cached = self.memory.get(key)
+        if cached is not None and cached[0] > now:
+            self._count("memory_hits")
+            return copy.deepcopy(cached[1])
+
+        if self.store is not None:
+            try:
+                stored = self.store.get(key, now)
+            except Exception:
+                stored = None
+                self._count("store_errors")
+            if stored is not None:
+                value, expires_at = stored
+                self.memory.put(key, (expires_at, value))
+                self._count("store_hits")
+                return copy.deepcopy(value)
+
+        self._count("misses")
+        return None
+
+    def put(self, key: str, value: Any, negative: bool = False) -> None:
+        ttl = self.negative_ttl if negative else self.ttl
+        if ttl <= 0:
+            return
+        now = self.clock()
+        value = copy.deepcopy(value)
+        self.memory.put(key, (now + ttl, value))
+        if self.store is not None:
+            try:
+                self.store.put(key, value, now + ttl, negative, now)
+            except Exception:
+                self._count("store_errors")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.memory_hits + self.store_hits + self.misses
+            stats = {
+                "memoryHits": self.memory_hits,
+                "storeHits": self.store_hits,
+                "misses": self.misses,
+                "storeErrors": self.store_errors,
+                "hitRate": round((self.memory_hits + self.store_hits) / lookups, 4) if lookups else 0.0,
+            }
+        stats["memory"] = self.memory.stats()
+        if self.store is not None:
+            try:
+                stats["store"] = self.store.stats()
+            except Exception:
+                stats["store"] = None
+        return stats
@@ -0,0 +1,272 @@
+"""
+Execution model for blocking work called from async FastAPI routes.
+
+Pipeline calls (may wait on DeepSeek for up to REQUEST_TIMEOUT) and SQLite calls run
+on separate bounded thread pools, so a slow LLM call can neither freeze the event
+loop nor starve quick DB reads such as /history.
+"""
+import asyncio
+import copy
+import functools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterator, List, Optional, Tuple
+
+from config import Config
+
+POOL_SIZES = {
+    "pipeline": Config.PIPELINE_POOL_SIZE,
+    "db": Config.DB_POOL_SIZE,
+    "enrichment": Config.ENRICHMENT_POOL_SIZE,
+    "llm-batch": Config.DEEPSEEK_BATCH_CONCURRENCY,
+}
+
+_executors: Dict[str, ThreadPoolExecutor] = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(pool: str) -> ThreadPoolExecutor:
+    executor = _executors.get(pool)
+    if executor is None:
+        with _executors_lock:
+            executor = _executors.get(pool)
+            if executor is None:
+                executor = ThreadPoolExecutor(
+                    max_workers=max(1, POOL_SIZES[pool]),
+                    thread_name_prefix=f"{pool}-pool",
+                )
+                _executors[pool] = executor
+    return executor
+
+
+async def run_blocking(func: Callable[..., Any], *args: Any, pool: str = "db", **kwargs: Any) -> Any:
+    """Run func(*args, **kwargs) on the named pool and await the result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(pool), functools.partial(func, *args, **kwargs))
+
+
+async def iterate_blocking(iterator: Iterator[Any], pool: str = "db") -> AsyncIterator[Any]:
+    """
+    Drive a blocking iterator (e.g. a generator waiting on DeepSeek) from async code,
+    one next() per hop onto the named pool; closes it if the consumer stops early.
+    """
+    done = object()
+    try:
+        while True:
+            item = await run_blocking(next, iterator, done, pool=pool)
+            if item is done:
+                return
+            yield item
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await run_blocking(close, pool=pool)
+
+
+def offload(pool: str = "db"):
+    """
+    Turn a sync route handler into an async one that runs on the named pool.
+    functools.wraps keeps the signature so FastAPI still sees the parameters.
+    """
+    def decorator(func: Callable[..., Any]):
+        @functools.wraps(func)
+        async def wrapper(*args: Any, **kwargs: Any) -> Any:
+            return await run_blocking(func, *args, pool=pool, **kwargs)
+        return wrapper
+    return decorator
+
+
+def pool_stats() -> Dict[str, Dict[str, int]]:
+    """Size and queued work items per started pool (for /metrics)."""
+    with _executors_lock:
+        return {
+            name: {"maxWorkers": executor._max_workers, "queued": executor._work_queue.qsize()}
+            for name, executor in _executors.items()
+        }
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Any = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls with the same key (threaded path): the first caller runs
+    func, callers arriving while it is in flight wait and get a deep copy of its result
+    (or its exception). Nothing is remembered once the call returns.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def do(self, key: Hashable, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+            else:
+                self.followers += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"leaders": self.leaders, "followers": self.followers, "inFlight": len(self._calls)}
+
+
+class AsyncSingleFlight:
+    """SingleFlight for coroutines; followers await the leader's future (shielded from their own cancellation)."""
+
+    def __init__(self):
+        self._calls: Dict[Tuple[asyncio.AbstractEventLoop, Hashable], "asyncio.Future[Any]"] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        flight_key = (loop, key)
+        future = self._calls.get(flight_key)
+        if future is not None:
+            self.followers += 1
+            return copy.deepcopy(await asyncio.shield(future))
+
+        self.leaders += 1
+        future = self._calls[flight_key] = loop.create_future()
+        try:
+            result = await func(*args, **kwargs)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()  # retrieved: no "never retrieved" warning without followers
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._calls.pop(flight_key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"leaders": self.leaders, "followers": self.followers, "inFlight": len(self._calls)}
+
+
+class MicroBatcher:
+    """
+    Collect items submitted from many threads for up to `window` seconds (or until
+    `max_items`) and hand them to batch_func(items) in one call on the named pool;
+    batch_func returns results in the same order. submit() returns a Future, and items
+    whose key is already queued share that Future.
+    """
+
+    def __init__(
+        self,
+        batch_func: Callable[[List[Any]], List[Any]],
+        window: float,
+        max_items: int = 16,
+        pool: str = "llm-batch",
+    ):
+        self.batch_func = batch_func
+        self.window = max(0.0, window)
+        self.max_items = max(1, max_items)
+        self.pool = pool
+        self._cond = threading.Condition()
+        self._queue: List[Tuple[Hashable, Any]] = []
+        self._pending: Dict[Hashable, Future] = {}
+        self._deadline = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self.batches = 0
+        self.items = 0
+        self.deduplicated = 0
+        self.largest_batch = 0
+
+    def submit(self, key: Hashable, item: Any) -> Future:
+        with self._cond:
+            future = self._pending.get(key)
+            if future is not None:
+                self.deduplicated += 1
+                return future
+            future = self._pending[key] = Future()
+            if not self._queue:
+                self._deadline = time.monotonic() + self.window
+            self._queue.append((key, item))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._collect, name="micro-batcher", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return future
+
+    def _collect(self) -> None:
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                while len(self._queue) < self.max_items:
+                    remaining = self._deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._queue = self._queue[:self.max_items], self._queue[self.max_items:]
+                # Leftovers already waited a full window: the next batch flushes at once
+                futures = [self._pending.pop(key) for key, _ in batch]
+                self.batches += 1
+                self.items += len(batch)
+                self.largest_batch = max(self.largest_batch, len(batch))
+            get_executor(self.pool).submit(self._run_batch, [item for _, item in batch], futures)
+
+    def _run_batch(self, items: List[Any], futures: List[Future]) -> None:
+        try:
+            results = self.batch_func(items)
+            if len(results) != len(items):
+                raise ValueError(f"batch_func returned {len(results)} results for {len(items)} items")
+        except BaseException as exc:
+            for future in futures:
+                future.set_exception(exc)
+            return
+        for future, result in zip(futures, results):
+            future.set_result(result)
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                "batches": self.batches,
+                "items": self.items,
+                "deduplicated": self.deduplicated,
+                "largestBatch": self.largest_batch,
+                "queued": len(self._queue),
+            }
+
+
+def shutdown_executors(wait: bool = True) -> None:
+    with _executors_lock:
+        executors = list(_executors.values())
+        _executors.clear()
+    for executor in executors:
+        executor.shutdown(wait=wait)
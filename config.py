@@ -16,12 +16,73 @@ class Config:
     # Nutrition calculation
     DEFAULT_CALORIES_PER_100G = 150
     MIN_CONFIDENCE_FOR_API = 0.6  # Gọi DeepSeek khi độ tin cậy < 60%
+    # Không gọi DeepSeek nếu món top-1 hơn phương án kế tiếp >= margin (<= 0 để tắt)
+    CANDIDATE_MARGIN = float(os.getenv("CANDIDATE_MARGIN", "0.2"))
+    # "segment": chỉ gửi các đoạn chưa chắc chắn lên DeepSeek, giữ món local đã chắc;
+    # "sentence": gửi cả câu và thay toàn bộ kết quả local (hành vi cũ)
+    LLM_FALLBACK_SCOPE = os.getenv("LLM_FALLBACK_SCOPE", "segment")
+    # "sync": /analyze chờ DeepSeek; "async": lưu + trả kết quả local ngay (enrichmentPending),
+    # worker nền gọi DeepSeek rồi cập nhật entry
+    LLM_ENRICHMENT_MODE = os.getenv("LLM_ENRICHMENT_MODE", "sync")
     ENABLE_DEEPSEEK = bool(DEEPSEEK_API_KEY)
+    # Bỏ sai số ngẫu nhiên ±10% khi ước lượng gram (cùng input -> cùng kết quả)
+    DETERMINISTIC_WEIGHT = os.getenv("DETERMINISTIC_WEIGHT", "0").lower() in ("1", "true", "yes")
+    # Cache câu trả lời DeepSeek: LRU trong worker + bảng SQLite dùng chung giữa các worker
+    DEEPSEEK_CACHE_TTL_SECONDS = int(os.getenv("DEEPSEEK_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))  # <= 0 để tắt
+    DEEPSEEK_NEGATIVE_CACHE_TTL_SECONDS = int(os.getenv("DEEPSEEK_NEGATIVE_CACHE_TTL_SECONDS", "60"))  # DeepSeek trả lời nhưng không ra món
+    DEEPSEEK_CACHE_MEMORY_SIZE = int(os.getenv("DEEPSEEK_CACHE_MEMORY_SIZE", "512"))
+    DEEPSEEK_CACHE_DB_MAX_ENTRIES = int(os.getenv("DEEPSEEK_CACHE_DB_MAX_ENTRIES", "20000"))
+    # Gom cụm món chưa chắc chắn từ nhiều request vào một lần gọi DeepSeek (0 = tắt):
+    # chờ tối đa window ms hoặc đủ max items; tối đa concurrency batch gọi song song
+    DEEPSEEK_BATCH_WINDOW_MS = int(os.getenv("DEEPSEEK_BATCH_WINDOW_MS", "0"))
+    DEEPSEEK_BATCH_MAX_ITEMS = int(os.getenv("DEEPSEEK_BATCH_MAX_ITEMS", "16"))
+    DEEPSEEK_BATCH_CONCURRENCY = int(os.getenv("DEEPSEEK_BATCH_CONCURRENCY", "4"))
+    # Tách món: "split" (theo dấu câu/từ nối) hoặc "scan" (Aho-Corasick cả câu)
+    EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "split")
+    # Số kết quả extract được cache (LRU, 0 = tắt)
+    EXTRACT_CACHE_SIZE = int(os.getenv("EXTRACT_CACHE_SIZE", "1024"))
+    # Artifact index dựng sẵn (python food_index.py build); để rỗng để tắt
+    FOOD_INDEX_PATH = os.getenv(
+        "FOOD_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "food_index.pkl")
+    )
     
+    # Thread pool cho việc blocking gọi từ route async: pipeline (có thể chờ DeepSeek) và SQLite
+    PIPELINE_POOL_SIZE = int(os.getenv("PIPELINE_POOL_SIZE", "8"))
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+    ENRICHMENT_POOL_SIZE = int(os.getenv("ENRICHMENT_POOL_SIZE", "2"))  # worker nền cho LLM_ENRICHMENT_MODE=async
+
+    # SQLite: mỗi thread giữ một connection (WAL, synchronous=NORMAL) thay vì mở mới mỗi lần gọi
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+    SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "8192"))  # page cache mỗi connection
+    SQLITE_MMAP_SIZE_MB = int(os.getenv("SQLITE_MMAP_SIZE_MB", "64"))  # 0 = tắt memory-mapped I/O
+    SQLITE_WRITE_ATTEMPTS = int(os.getenv("SQLITE_WRITE_ATTEMPTS", "5"))  # retry unit-of-work khi SQLITE_BUSY
+    KNOWN_PATIENTS_CACHE_SIZE = int(os.getenv("KNOWN_PATIENTS_CACHE_SIZE", "10000"))  # 0 = luôn INSERT OR IGNORE
+
     # API timeout
     REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT_SECONDS", "600"))
     REQUEST_READ_TIMEOUT = int(os.getenv("REQUEST_READ_TIMEOUT_SECONDS", "600"))
     REQUEST_CONNECT_TIMEOUT = int(os.getenv("REQUEST_CONNECT_TIMEOUT_SECONDS", "10"))
+    # Ngân sách thời gian cho mỗi /analyze (gồm cả retry DeepSeek) và cho job enrichment nền
+    ANALYZE_DEADLINE_SECONDS = float(os.getenv("ANALYZE_DEADLINE_SECONDS", "20"))
+    ENRICHMENT_DEADLINE_SECONDS = float(os.getenv("ENRICHMENT_DEADLINE_SECONDS", "120"))
+    # Retry lỗi tạm thời (mất kết nối, timeout, 429/5xx) với backoff ngẫu nhiên, trong ngân sách còn lại
+    DEEPSEEK_MAX_ATTEMPTS = int(os.getenv("DEEPSEEK_MAX_ATTEMPTS", "3"))
+    DEEPSEEK_RETRY_BASE_DELAY = float(os.getenv("DEEPSEEK_RETRY_BASE_DELAY", "0.2"))
+    DEEPSEEK_RETRY_MAX_DELAY = float(os.getenv("DEEPSEEK_RETRY_MAX_DELAY", "2.0"))
+    # Circuit breaker: sau N lỗi liên tiếp thì chỉ chạy local trong reset giây rồi thử lại 1 request
+    DEEPSEEK_BREAKER_FAILURES = int(os.getenv("DEEPSEEK_BREAKER_FAILURES", "5"))
+    DEEPSEEK_BREAKER_RESET_SECONDS = float(os.getenv("DEEPSEEK_BREAKER_RESET_SECONDS", "30"))
+    # Giới hạn số lần gọi LLM đồng thời theo loại (food = /analyze, lab = /match) + hàng chờ có giới hạn;
+    # quá tải thì food chạy local, /match trả 503 + Retry-After
+    LLM_FOOD_MAX_CONCURRENT = int(os.getenv("LLM_FOOD_MAX_CONCURRENT", "8"))
+    LLM_FOOD_MAX_QUEUE = int(os.getenv("LLM_FOOD_MAX_QUEUE", "16"))
+    LLM_FOOD_MAX_WAIT_SECONDS = float(os.getenv("LLM_FOOD_MAX_WAIT_SECONDS", "2"))
+    LLM_LAB_MAX_CONCURRENT = int(os.getenv("LLM_LAB_MAX_CONCURRENT", "2"))
+    LLM_LAB_MAX_QUEUE = int(os.getenv("LLM_LAB_MAX_QUEUE", "4"))
+    LLM_LAB_MAX_WAIT_SECONDS = float(os.getenv("LLM_LAB_MAX_WAIT_SECONDS", "5"))
+    # Pool keep-alive dùng chung cho các lần gọi DeepSeek (số host, số connection tối đa)
+    HTTP_POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "4"))
+    HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
     
     @classmethod
     def is_deepseek_available(cls):
@@ -3,17 +3,124 @@ SQLite-backed storage for patient daily nutrition logs.
 
 Schema:
 - patients: patient_id (TEXT PK), created_at
-- daily_logs: patient_id (TEXT), day (YYYY-MM-DD), daily_totals (JSON), meals (JSON), last_updated (ISO)
+- daily_logs: patient_id (TEXT), day (YYYY-MM-DD), daily_totals (JSON), meals (legacy JSON blob,
+  '[]' once migrated), last_updated (ISO), version (bumped by every write to the day)
+- entries: id, patient_id, day, position, entry_id, has_foods, data (entry JSON without foods)
+- entry_foods: entry_rowid -> entries.id, position, food_id, data (food JSON)
+
+Reads never write: patients rows are created lazily by the first write for a patient.
+
+All classes share one connection per (thread, database file) from get_connection():
+WAL journal (readers never block the writer), synchronous=NORMAL, a busy timeout and
+tunable page cache / mmap (Config.SQLITE_*).
 """
+import contextlib
+import copy
 import json
+import os
+import random
 import sqlite3
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, Iterator, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from caching import LRUCache
+from config import Config
 
 
 DB_PATH = Path(__file__).resolve().parent / "nutrition.db"
 
+
+class ConnectionManager:
+    """
+    One long-lived sqlite3 connection per thread for a database file. Use it as
+    `with manager.connection() as conn:` (commits on success, rolls back on error,
+    the connection stays open). Connections inherited across fork() are not reused.
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._local = threading.local()
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self.opened = 0
+
+    def connection(self) -> sqlite3.Connection:
+        if self._pid != os.getpid():  # forked worker: start over, never touch the parent's handles
+            self._local = threading.local()
+            self._pid = os.getpid()
+            with self._lock:
+                self._connections = []
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+        return conn
+
+    def _open(self) -> sqlite3.Connection:
+        # check_same_thread=False only so close_all() can close it; each thread uses its own
+        conn = sqlite3.connect(
+            self.db_path, timeout=Config.SQLITE_BUSY_TIMEOUT_MS / 1000, check_same_thread=False
+        )
+        conn.execute(f"PRAGMA busy_timeout = {int(Config.SQLITE_BUSY_TIMEOUT_MS)}")
+        conn.execute("PRAGMA journal_mode = WAL")  # persistent: stored in the database file
+        conn.execute("PRAGMA synchronous = NORMAL")  # WAL: durable across app crashes, fsync at checkpoints
+        conn.execute(f"PRAGMA cache_size = {-int(Config.SQLITE_CACHE_SIZE_KB)}")
+        conn.execute(f"PRAGMA mmap_size = {int(Config.SQLITE_MMAP_SIZE_MB) * 1024 * 1024}")
+        with self._lock:
+            self._connections.append(conn)
+            self.opened += 1
+        return conn
+
+    def close_all(self) -> None:
+        """Close every connection (shutdown/tests, no query may be running); threads reopen on next use."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"path": str(self.db_path), "open": len(self._connections), "opened": self.opened}
+
+
+_managers: Dict[str, ConnectionManager] = {}
+_managers_lock = threading.Lock()
+
+
+def connection_manager(db_path: Path = DB_PATH) -> ConnectionManager:
+    key = str(Path(db_path).resolve())
+    manager = _managers.get(key)
+    if manager is None:
+        with _managers_lock:
+            manager = _managers.setdefault(key, ConnectionManager(Path(key)))
+    return manager
+
+
+def get_connection(db_path: Path = DB_PATH) -> sqlite3.Connection:
+    """This thread's pooled connection to db_path."""
+    return connection_manager(db_path).connection()
+
+
+def connection_stats() -> List[Dict[str, Any]]:
+    with _managers_lock:
+        return [manager.stats() for manager in _managers.values()]
+
+def _is_busy(exc: sqlite3.OperationalError) -> bool:
+    message = str(exc).lower()
+    return "locked" in message or "busy" in message
+
+
+class VersionConflict(Exception):
+    """The day was changed by another writer since it was read."""
+
+
+ENRICHMENT_PENDING_SQL = "json_extract({alias}data, '$.enrichmentPending') = 1"
+
 DEFAULT_TOTALS = {
     "calories": 0,
     "carbs": 0,
@@ -25,15 +132,29 @@ DEFAULT_TOTALS = {
 
 
 class DailyLogDB:
-    """Lightweight wrapper around sqlite for storing daily logs."""
+    """
+    Lightweight wrapper around sqlite for storing daily logs.
+
+    Entries are stored normalized: one `entries` row per entry (its JSON without foods)
+    and one `entry_foods` row per food, so an edit rewrites only the rows that changed.
+    The `daily_logs` row of a day keeps the totals: an append adds its summary, an edit
+    re-sums the entries' mealSummary in SQL instead of decoding the day.
+    Days still holding a legacy `meals` JSON blob are migrated at startup (in batches)
+    and on their first write; reads merge the blob until then.
+    """
 
     def __init__(self, db_path: Path = DB_PATH):
         self.db_path = Path(db_path)
         self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.write_retries = 0
+        # Patients known to have a row: writes skip the INSERT OR IGNORE, reads never create one
+        size = Config.KNOWN_PATIENTS_CACHE_SIZE
+        self.known_patients: Optional[LRUCache] = LRUCache(size) if size > 0 else None
         self._ensure_schema()
+        self.migrate_legacy_days()
 
     def _connect(self):
-        return sqlite3.connect(self.db_path)
+        return get_connection(self.db_path)
 
     def _ensure_schema(self) -> None:
         with self._connect() as conn:
@@ -53,17 +174,96 @@ class DailyLogDB:
                     daily_totals TEXT NOT NULL,
                     meals TEXT NOT NULL,
                     last_updated TEXT NOT NULL,
+                    version INTEGER NOT NULL DEFAULT 0,
                     PRIMARY KEY (patient_id, day)
                 )
                 """
             )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(daily_logs)")}
+            if "version" not in columns:
+                conn.execute("ALTER TABLE daily_logs ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    id INTEGER PRIMARY KEY,
+                    patient_id TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    entry_id TEXT,
+                    has_foods INTEGER NOT NULL,
+                    data TEXT NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_entries_day ON entries (patient_id, day, position)"
+            )
+            # entryId -> day: covering index, kept in step with every write by SQLite itself
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_entries_entry_id ON entries (patient_id, entry_id, day)"
+            )
+            # Partial index: only the (few) entries still waiting for async enrichment
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_entries_enrichment_pending ON entries (patient_id, day) "
+                f"WHERE {ENRICHMENT_PENDING_SQL.format(alias='')}"
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entry_foods (
+                    entry_rowid INTEGER NOT NULL,
+                    position INTEGER NOT NULL,
+                    food_id TEXT,
+                    data TEXT NOT NULL,
+                    PRIMARY KEY (entry_rowid, position)
+                )
+                """
+            )
+            conn.commit()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _transaction(conn: sqlite3.Connection):
+        """BEGIN IMMEDIATE .. COMMIT: reads inside see exactly what the writes will change."""
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _snapshot(conn: sqlite3.Connection):
+        """Several SELECTs against one consistent snapshot (WAL read transaction)."""
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        finally:
             conn.commit()
 
     def ensure_patient(self, patient_id: str) -> None:
         """Create patient row if not exists."""
-        if not patient_id:
+        if not patient_id or self._is_known_patient(patient_id):
             return
         with self._connect() as conn:
+            self._insert_patient(conn, patient_id)
+            conn.commit()
+        self._remember_patient(patient_id)
+
+    def _is_known_patient(self, patient_id: str) -> bool:
+        return self.known_patients is not None and self.known_patients.get(patient_id) is not None
+
+    def _remember_patient(self, patient_id: str) -> None:
+        """Only after the commit that created the row: a rolled back insert must not be cached."""
+        if patient_id and self.known_patients is not None:
+            self.known_patients.put(patient_id, True)
+
+    def _insert_patient(self, conn: sqlite3.Connection, patient_id: str) -> None:
+        if patient_id and not self._is_known_patient(patient_id):
             conn.execute(
                 """
                 INSERT OR IGNORE INTO patients (patient_id, created_at)
@@ -71,18 +271,108 @@ class DailyLogDB:
                 """,
                 (patient_id, datetime.utcnow().isoformat() + "Z"),
             )
-            conn.commit()
 
-    def _row_to_log(self, patient_id: str, row: sqlite3.Row) -> Dict[str, Any]:
-        day, daily_totals_raw, meals_raw, last_updated = row
+    # ----------------------------
+    # Row <-> entry mapping
+    # ----------------------------
+    @staticmethod
+    def _split_entry(entry: Dict[str, Any]) -> Tuple[str, int, List[Any]]:
+        """(entry JSON with foods left as a placeholder, has_foods, foods) for the two tables."""
+        foods = entry.get("foods")
+        if isinstance(foods, list):
+            # Placeholder keeps "foods" at its original key position
+            return json.dumps({**entry, "foods": None}, ensure_ascii=False), 1, foods
+        return json.dumps(entry, ensure_ascii=False), 0, []
+
+    @staticmethod
+    def _join_entry(data_raw: str, has_foods: int, foods: List[Any]) -> Dict[str, Any]:
         try:
-            daily_totals = json.loads(daily_totals_raw)
+            entry = json.loads(data_raw)
         except json.JSONDecodeError:
-            daily_totals = {}
+            entry = {}
+        if has_foods:
+            entry["foods"] = foods
+        return entry
+
+    @staticmethod
+    def _food_row(entry_rowid: int, position: int, food: Any) -> Tuple[int, int, Optional[str], str]:
+        food_id = food.get("foodId") if isinstance(food, dict) else None
+        return (
+            entry_rowid,
+            position,
+            str(food_id) if food_id is not None else None,
+            json.dumps(food, ensure_ascii=False),
+        )
+
+    @staticmethod
+    def _decode_meals(meals_raw: Optional[str]) -> List[Dict[str, Any]]:
         try:
-            meals = json.loads(meals_raw)
+            meals = json.loads(meals_raw) if meals_raw else []
         except json.JSONDecodeError:
             meals = []
+        return meals if isinstance(meals, list) else []
+
+    @classmethod
+    def _merge_legacy(cls, entries: List[Dict[str, Any]], meals_raw: Optional[str]) -> List[Dict[str, Any]]:
+        """Normalized entries + entries still in a not yet migrated meals blob."""
+        legacy = cls._decode_meals(meals_raw)
+        if not legacy:
+            return entries
+        known = {entry.get("entryId") for entry in entries if entry.get("entryId") is not None}
+        return entries + [
+            entry for entry in legacy
+            if not isinstance(entry, dict) or entry.get("entryId") is None or entry.get("entryId") not in known
+        ]
+
+    def _load_entries(
+        self,
+        conn: sqlite3.Connection,
+        where: str,
+        params: Tuple[Any, ...],
+    ) -> Dict[Tuple[str, str], List[Dict[str, Any]]]:
+        """Entries (with foods) matching `where` on alias e, grouped by (patient_id, day) in order."""
+        foods: Dict[int, List[Any]] = {}
+        for entry_rowid, data_raw in conn.execute(
+            f"""
+            SELECT f.entry_rowid, f.data
+            FROM entry_foods f JOIN entries e ON e.id = f.entry_rowid
+            WHERE {where}
+            ORDER BY f.entry_rowid, f.position
+            """,
+            params,
+        ):
+            try:
+                foods.setdefault(entry_rowid, []).append(json.loads(data_raw))
+            except json.JSONDecodeError:
+                continue
+
+        grouped: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        for entry_rowid, patient_id, day, has_foods, data_raw in conn.execute(
+            f"""
+            SELECT e.id, e.patient_id, e.day, e.has_foods, e.data
+            FROM entries e
+            WHERE {where}
+            ORDER BY e.patient_id, e.day, e.position
+            """,
+            params,
+        ):
+            grouped.setdefault((patient_id, day), []).append(
+                self._join_entry(data_raw, has_foods, foods.get(entry_rowid, []))
+            )
+        return grouped
+
+    def _row_to_log(
+        self,
+        patient_id: str,
+        row: sqlite3.Row,
+        entries: Optional[List[Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        day, daily_totals_raw, meals_raw, last_updated = row
+        try:
+            daily_totals = json.loads(daily_totals_raw)
+        except json.JSONDecodeError:
+            daily_totals = {}
+        meals = self._merge_legacy(entries or [], meals_raw)
 
         return {
             "patientId": patient_id,
@@ -92,49 +382,273 @@ class DailyLogDB:
             "last_updated": last_updated,
         }
 
-    def get_patient_logs(self, patient_id: str) -> List[Dict[str, Any]]:
-        """Return all logs for a patient (empty list if none)."""
-        self.ensure_patient(patient_id)
-        with self._connect() as conn:
-            cursor = conn.execute(
-                """
+    @staticmethod
+    def _day_filter(date_from: Optional[str], date_to: Optional[str], column: str) -> Tuple[str, List[Any]]:
+        """SQL condition (with leading AND) for an inclusive YYYY-MM-DD range."""
+        if date_from and date_to:
+            return f" AND {column} BETWEEN ? AND ?", [date_from, date_to]
+        if date_from:
+            return f" AND {column} >= ?", [date_from]
+        if date_to:
+            return f" AND {column} <= ?", [date_to]
+        return "", []
+
+    # ----------------------------
+    # Reads
+    # ----------------------------
+    def _get_logs(
+        self,
+        patient_id: str,
+        date_from: Optional[str] = None,
+        date_to: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Day logs of a patient in range, newest first."""
+        condition, params = self._day_filter(date_from, date_to, "day")
+        entry_condition, _ = self._day_filter(date_from, date_to, "e.day")
+        conn = self._connect()
+        with self._snapshot(conn):
+            rows = conn.execute(
+                f"""
                 SELECT day, daily_totals, meals, last_updated
                 FROM daily_logs
-                WHERE patient_id = ?
+                WHERE patient_id = ?{condition}
                 ORDER BY day DESC
                 """,
-                (patient_id,),
-            )
-            rows = cursor.fetchall()
+                (patient_id, *params),
+            ).fetchall()
+            entries = self._load_entries(conn, f"e.patient_id = ?{entry_condition}", (patient_id, *params))
+
+        return [self._row_to_log(patient_id, row, entries.get((patient_id, row[0]))) for row in rows]
 
-        return [self._row_to_log(patient_id, row) for row in rows]
+    def get_patient_logs(self, patient_id: str) -> List[Dict[str, Any]]:
+        """Return all logs for a patient (empty list if none)."""
+        return self._get_logs(patient_id)
 
     def get_daily_log(self, patient_id: str, day: str) -> Optional[Dict[str, Any]]:
         """Return a log for a given day or None."""
-        self.ensure_patient(patient_id)
-        with self._connect() as conn:
-            cursor = conn.execute(
+        return self._read_day(self._connect(), patient_id, day)
+
+    def _read_day(self, conn: sqlite3.Connection, patient_id: str, day: str) -> Optional[Dict[str, Any]]:
+        with self._snapshot(conn):
+            row = conn.execute(
                 """
                 SELECT day, daily_totals, meals, last_updated
                 FROM daily_logs
                 WHERE patient_id = ? AND day = ?
                 """,
                 (patient_id, day),
-            )
-            row = cursor.fetchone()
-
-        if not row:
-            return None
-        return self._row_to_log(patient_id, row)
-
+            ).fetchone()
+            if not row:
+                return None
+            entries = self._load_entries(conn, "e.patient_id = ? AND e.day = ?", (patient_id, day))
+
+        return self._row_to_log(patient_id, row, entries.get((patient_id, day)))
+
+    def pending_enrichments(self) -> List[Tuple[str, str, Dict[str, Any]]]:
+        """(patient_id, day, entry) for every entry still marked enrichmentPending."""
+        conn = self._connect()
+        with self._snapshot(conn):
+            grouped = self._load_entries(conn, ENRICHMENT_PENDING_SQL.format(alias="e."), ())
+        return [(patient_id, day, entry) for (patient_id, day), entries in grouped.items() for entry in entries]
+
+    def locate_entry(self, patient_id: str, entry_id: str) -> Optional[str]:
+        """Day holding an entry id for a patient (latest day if duplicated), or None."""
+        conn = self._connect()
+        row = conn.execute(
+            """
+            SELECT day FROM entries
+            WHERE patient_id = ? AND entry_id = ?
+            ORDER BY day DESC LIMIT 1
+            """,
+            (patient_id, str(entry_id)),
+        ).fetchone()
+        if row:
+            return row[0]
+        # Days not yet migrated (blob written by an older process): normally no row qualifies
+        row = conn.execute(
+            """
+            SELECT d.day
+            FROM daily_logs d, json_each(CASE WHEN json_valid(d.meals) THEN d.meals ELSE '[]' END) m
+            WHERE d.patient_id = ? AND d.meals NOT IN ('[]', '')
+              AND json_extract(m.value, '$.entryId') = ?
+            ORDER BY d.day DESC LIMIT 1
+            """,
+            (patient_id, str(entry_id)),
+        ).fetchone()
+        return row[0] if row else None
+
+    # ----------------------------
+    # Writes
+    # ----------------------------
     def _recalc_totals(self, entries: List[Dict[str, Any]]) -> Dict[str, Any]:
         totals = DEFAULT_TOTALS.copy()
         for entry in entries or []:
-            summary = entry.get("mealSummary", {})
+            summary = self._summary_values(entry)
             for key in totals:
-                totals[key] += float(summary.get(key, 0) or 0)
+                totals[key] += summary[key]
+        return totals
+
+    @staticmethod
+    def _summary_values(entry: Dict[str, Any]) -> Dict[str, float]:
+        summary = (entry.get("mealSummary") if isinstance(entry, dict) else None) or {}
+        return {key: float(summary.get(key, 0) or 0) for key in DEFAULT_TOTALS}
+
+    def _refresh_totals(self, conn: sqlite3.Connection, patient_id: str, day: str) -> Dict[str, Any]:
+        """
+        Re-sum the day from the entries' mealSummary (json_extract on entry rows, foods untouched).
+        Used after edits: subtracting the old summary and adding the new one drifts in floating point.
+        """
+        columns = ", ".join(f"json_extract(data, '$.mealSummary.{key}')" for key in DEFAULT_TOTALS)
+        totals = DEFAULT_TOTALS.copy()
+        for values in conn.execute(
+            f"SELECT {columns} FROM entries WHERE patient_id = ? AND day = ? ORDER BY position",
+            (patient_id, day),
+        ):
+            for key, value in zip(DEFAULT_TOTALS, values):
+                try:
+                    totals[key] += float(value or 0)
+                except (TypeError, ValueError):
+                    continue
         return totals
 
+    def _insert_entry(
+        self,
+        conn: sqlite3.Connection,
+        patient_id: str,
+        day: str,
+        position: int,
+        entry: Dict[str, Any],
+    ) -> None:
+        data, has_foods, foods = self._split_entry(entry)
+        entry_id = entry.get("entryId")
+        cursor = conn.execute(
+            """
+            INSERT INTO entries (patient_id, day, position, entry_id, has_foods, data)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (patient_id, day, position, str(entry_id) if entry_id is not None else None, has_foods, data),
+        )
+        conn.executemany(
+            "INSERT INTO entry_foods (entry_rowid, position, food_id, data) VALUES (?, ?, ?, ?)",
+            [self._food_row(cursor.lastrowid, i, food) for i, food in enumerate(foods)],
+        )
+
+    @staticmethod
+    def _delete_day_entries(conn: sqlite3.Connection, patient_id: str, day: str) -> None:
+        conn.execute(
+            """
+            DELETE FROM entry_foods WHERE entry_rowid IN (
+                SELECT id FROM entries WHERE patient_id = ? AND day = ?
+            )
+            """,
+            (patient_id, day),
+        )
+        conn.execute("DELETE FROM entries WHERE patient_id = ? AND day = ?", (patient_id, day))
+
+    def _next_position(self, conn: sqlite3.Connection, patient_id: str, day: str) -> int:
+        (position,) = conn.execute(
+            "SELECT COALESCE(MAX(position), -1) + 1 FROM entries WHERE patient_id = ? AND day = ?",
+            (patient_id, day),
+        ).fetchone()
+        return position
+
+    def _migrate_day(self, conn: sqlite3.Connection, patient_id: str, day: str, meals_raw: str) -> None:
+        """Move a legacy meals blob into entries/entry_foods (inside the caller's transaction)."""
+        existing = self._load_entries(conn, "e.patient_id = ? AND e.day = ?", (patient_id, day)).get(
+            (patient_id, day), []
+        )
+        entries = self._merge_legacy(existing, meals_raw)
+        position = self._next_position(conn, patient_id, day)
+        for offset, entry in enumerate(entries[len(existing):]):
+            self._insert_entry(conn, patient_id, day, position + offset, entry if isinstance(entry, dict) else {})
+        conn.execute(
+            "UPDATE daily_logs SET meals = '[]', daily_totals = ? WHERE patient_id = ? AND day = ?",
+            (json.dumps(self._recalc_totals(entries), ensure_ascii=False), patient_id, day),
+        )
+
+    def _open_day(self, conn: sqlite3.Connection, patient_id: str, day: str, create: bool) -> Optional[int]:
+        """Inside a write transaction: create (if asked) and migrate the day row, return its version (None if missing)."""
+        if create:
+            self._insert_patient(conn, patient_id)
+            conn.execute(
+                """
+                INSERT OR IGNORE INTO daily_logs (patient_id, day, daily_totals, meals, last_updated)
+                VALUES (?, ?, ?, '[]', ?)
+                """,
+                (patient_id, day, json.dumps(DEFAULT_TOTALS), datetime.now().isoformat()),
+            )
+        row = conn.execute(
+            "SELECT meals, version FROM daily_logs WHERE patient_id = ? AND day = ?", (patient_id, day)
+        ).fetchone()
+        if not row:
+            return None
+        if self._decode_meals(row[0]):
+            self._migrate_day(conn, patient_id, day, row[0])
+        return row[1]
+
+    def migrate_legacy_days(self, batch_size: int = 200) -> int:
+        """
+        Online migration of legacy meals blobs, one short transaction per batch of days so
+        other workers keep writing in between. Returns the number of days migrated.
+        """
+        migrated = 0
+        conn = self._connect()
+        while True:
+            with self._transaction(conn):
+                rows = conn.execute(
+                    "SELECT patient_id, day, meals FROM daily_logs WHERE meals NOT IN ('[]', '') LIMIT ?",
+                    (batch_size,),
+                ).fetchall()
+                for patient_id, day, meals_raw in rows:
+                    self._migrate_day(conn, patient_id, day, meals_raw)
+            migrated += len(rows)
+            if len(rows) < batch_size:
+                return migrated
+
+    # ----------------------------
+    # Unit of work
+    # ----------------------------
+    def unit_of_work(
+        self,
+        patient_id: str,
+        day: str,
+        work: Callable[["DayUnitOfWork"], Any],
+        create: bool = False,
+        expected_version: Optional[int] = None,
+    ) -> Any:
+        """
+        Run work(unit) as one read-modify-write of a patient's day: a single BEGIN IMMEDIATE
+        transaction on this thread's connection, committed when work returns (its result is
+        returned), rolled back if it raises. SQLITE_BUSY (busy timeout exhausted) and version
+        conflicts re-run work from a fresh read, so work must not have side effects outside
+        the unit. With expected_version (from day_version), a day changed since the caller
+        read it raises VersionConflict instead.
+        """
+        attempts = max(1, Config.SQLITE_WRITE_ATTEMPTS)
+        for attempt in range(1, attempts + 1):
+            conn = self._connect()
+            try:
+                with self._transaction(conn):
+                    result = work(DayUnitOfWork(self, conn, patient_id, day, create, expected_version))
+                if create:
+                    self._remember_patient(patient_id)
+                return result
+            except VersionConflict:
+                if expected_version is not None or attempt == attempts:
+                    raise
+            except sqlite3.OperationalError as exc:
+                if not _is_busy(exc) or attempt == attempts:
+                    raise
+            self.write_retries += 1
+            time.sleep(random.uniform(0, 0.005 * 2 ** attempt))
+
+    def day_version(self, patient_id: str, day: str) -> Optional[int]:
+        """Version of a day (bumped by every write to it), None if the day does not exist."""
+        row = self._connect().execute(
+            "SELECT version FROM daily_logs WHERE patient_id = ? AND day = ?", (patient_id, day)
+        ).fetchone()
+        return row[0] if row else None
+
     def upsert_daily_log(
         self,
         patient_id: str,
@@ -144,48 +658,33 @@ class DailyLogDB:
         last_updated: Optional[str] = None,
     ) -> Dict[str, Any]:
         """Create/update a daily log. Kept for backward compatibility."""
-        last_updated = last_updated or datetime.now().isoformat()
-        self.ensure_patient(patient_id)
-        with self._connect() as conn:
-            conn.execute(
-                """
-                INSERT INTO daily_logs (patient_id, day, daily_totals, meals, last_updated)
-                VALUES (?, ?, ?, ?, ?)
-                ON CONFLICT(patient_id, day) DO UPDATE SET
-                    daily_totals = excluded.daily_totals,
-                    meals = excluded.meals,
-                    last_updated = excluded.last_updated
-                """,
-                (
-                    patient_id,
-                    day,
-                    json.dumps(daily_totals, ensure_ascii=False),
-                    json.dumps(meals, ensure_ascii=False),
-                    last_updated,
-                ),
-            )
-            conn.commit()
-        return self.get_daily_log(patient_id, day) or {
-            "patientId": patient_id,
-            "day": day,
-            "totals": daily_totals,
-            "entries": meals,
-            "last_updated": last_updated,
-        }
+        def work(unit: DayUnitOfWork) -> Dict[str, Any]:
+            unit.replace(meals, daily_totals, last_updated)
+            return unit.log()
+
+        return self.unit_of_work(patient_id, day, work, create=True)
 
     def save_day(self, patient_id: str, day: str, entries: List[Dict[str, Any]]) -> Dict[str, Any]:
         """Persist a full day's entries and derived totals."""
-        self.ensure_patient(patient_id)
         totals = self._recalc_totals(entries)
         return self.upsert_daily_log(patient_id, day, totals, entries)
 
-    def append_entry(self, patient_id: str, day: str, entry: Dict[str, Any]) -> Dict[str, Any]:
-        """Append a new entry to a patient's day."""
-        self.ensure_patient(patient_id)
-        log = self.get_daily_log(patient_id, day)
-        entries = list(log.get("entries", [])) if log else []
-        entries.append(entry)
-        return self.save_day(patient_id, day, entries)
+    def append_entry(
+        self,
+        patient_id: str,
+        day: str,
+        entry: Dict[str, Any],
+        return_log: bool = True,
+    ) -> Dict[str, Any]:
+        """
+        Append a new entry to a patient's day (two inserts + a totals delta).
+        Returns the day log; return_log=False returns just the entry and skips re-reading the day.
+        """
+        def work(unit: DayUnitOfWork) -> Dict[str, Any]:
+            unit.append(entry)
+            return unit.log() if return_log else entry
+
+        return self.unit_of_work(patient_id, day, work, create=True)
 
     def update_entry(
         self,
@@ -193,27 +692,52 @@ class DailyLogDB:
         day: str,
         entry_id: str,
         updater,
+        return_log: bool = True,
     ) -> Optional[Dict[str, Any]]:
         """
         Apply an updater(entry_dict) -> entry_dict to the matched entry.
-        Returns updated day log or None if entry not found.
+        Returns updated day log or None if entry not found (return_log=False: the updated
+        entry, without re-reading the day).
+        Only the entry row, the changed food rows and the day totals are rewritten.
         """
-        log = self.get_daily_log(patient_id, day)
-        if not log:
-            return None
+        def work(unit: DayUnitOfWork) -> Optional[Dict[str, Any]]:
+            updated = unit.update(entry_id, updater)
+            if updated is None:
+                return None
+            return unit.log() if return_log else updated
 
-        entries = []
-        found = False
-        for entry in log.get("entries", []):
-            if entry.get("entryId") == entry_id:
-                entry = updater(dict(entry))
-                found = True
-            entries.append(entry)
+        return self.unit_of_work(patient_id, day, work)
 
-        if not found:
-            return None
-
-        return self.save_day(patient_id, day, entries)
+    def _write_entry_changes(
+        self,
+        conn: sqlite3.Connection,
+        entry_rowid: int,
+        old_entry: Dict[str, Any],
+        new_entry: Dict[str, Any],
+    ) -> None:
+        old_data, old_has_foods, old_foods = self._split_entry(old_entry)
+        new_data, new_has_foods, new_foods = self._split_entry(new_entry)
+        if (new_data, new_has_foods) != (old_data, old_has_foods):
+            entry_id = new_entry.get("entryId")
+            conn.execute(
+                "UPDATE entries SET data = ?, has_foods = ?, entry_id = ? WHERE id = ?",
+                (new_data, new_has_foods, str(entry_id) if entry_id is not None else None, entry_rowid),
+            )
+        # Foods are keyed by position: a removal rewrites only the foods after it in this entry
+        changed = [
+            self._food_row(entry_rowid, i, food)
+            for i, food in enumerate(new_foods)
+            if i >= len(old_foods) or food != old_foods[i]
+        ]
+        conn.executemany(
+            "INSERT OR REPLACE INTO entry_foods (entry_rowid, position, food_id, data) VALUES (?, ?, ?, ?)",
+            changed,
+        )
+        if len(new_foods) < len(old_foods):
+            conn.execute(
+                "DELETE FROM entry_foods WHERE entry_rowid = ? AND position >= ?",
+                (entry_rowid, len(new_foods)),
+            )
 
     def delete_food_in_entry(
         self,
@@ -244,14 +768,7 @@ class DailyLogDB:
 
     def delete_daily_log(self, patient_id: str, day: str) -> bool:
         """Delete a log, return True if removed."""
-        self.ensure_patient(patient_id)
-        with self._connect() as conn:
-            cursor = conn.execute(
-                "DELETE FROM daily_logs WHERE patient_id = ? AND day = ?",
-                (patient_id, day),
-            )
-            conn.commit()
-            return cursor.rowcount > 0
+        return self.unit_of_work(patient_id, day, lambda unit: unit.delete())
 
     def get_history(
         self,
@@ -263,32 +780,8 @@ class DailyLogDB:
         Return a mapping of day -> {totals, entries} within range.
         date_from/date_to inclusive, expect format YYYY-MM-DD.
         """
-        self.ensure_patient(patient_id)
-        query = """
-            SELECT day, daily_totals, meals, last_updated
-            FROM daily_logs
-            WHERE patient_id = ?
-        """
-        params: List[Any] = [patient_id]
-        if date_from and date_to:
-            query += " AND day BETWEEN ? AND ?"
-            params.extend([date_from, date_to])
-        elif date_from:
-            query += " AND day >= ?"
-            params.append(date_from)
-        elif date_to:
-            query += " AND day <= ?"
-            params.append(date_to)
-
-        query += " ORDER BY day DESC"
-
-        with self._connect() as conn:
-            cursor = conn.execute(query, tuple(params))
-            rows = cursor.fetchall()
-
         days = {}
-        for row in rows:
-            log = self._row_to_log(patient_id, row)
+        for log in self._get_logs(patient_id, date_from, date_to):
             days[log["day"]] = {
                 "totals": log.get("totals", DEFAULT_TOTALS.copy()),
                 "entries": log.get("entries", []),
@@ -302,35 +795,144 @@ class DailyLogDB:
     ) -> Iterator[Tuple[str, str, List[Dict[str, Any]]]]:
         """
         Yield (patient_id, day, entries) for all patients within date range (inclusive).
-        Expects day format YYYY-MM-DD.
+        Expects day format YYYY-MM-DD. Loads one day (all patients) at a time.
         """
-        query = """
-            SELECT patient_id, day, meals
-            FROM daily_logs
-            WHERE 1=1
-        """
-        params: List[Any] = []
-
-        if date_from and date_to:
-            query += " AND day BETWEEN ? AND ?"
-            params.extend([date_from, date_to])
-        elif date_from:
-            query += " AND day >= ?"
-            params.append(date_from)
-        elif date_to:
-            query += " AND day <= ?"
-            params.append(date_to)
-
-        query += " ORDER BY day ASC"
+        condition, params = self._day_filter(date_from, date_to, "day")
+        conn = self._connect()
+        days = [
+            day for (day,) in conn.execute(
+                f"SELECT DISTINCT day FROM daily_logs WHERE 1=1{condition} ORDER BY day ASC",
+                tuple(params),
+            ).fetchall()
+        ]
+        for day in days:
+            with self._snapshot(conn):
+                rows = conn.execute(
+                    "SELECT patient_id, meals FROM daily_logs WHERE day = ? ORDER BY patient_id",
+                    (day,),
+                ).fetchall()
+                entries = self._load_entries(conn, "e.day = ?", (day,))
+            for patient_id, meals_raw in rows:
+                yield patient_id, day, self._merge_legacy(entries.get((patient_id, day), []), meals_raw)
+
+
+class DayUnitOfWork:
+    """
+    One patient's day inside a DailyLogDB.unit_of_work transaction. Reads see the
+    transaction's own writes; every write bumps the day version, checked against the
+    version read when the unit started (compare-and-set), so a change made behind the
+    transaction's back fails with VersionConflict instead of being overwritten.
+    """
 
-        with self._connect() as conn:
-            cursor = conn.execute(query, tuple(params))
-            for patient_id, day, meals_raw in cursor:
-                try:
-                    entries = json.loads(meals_raw) if meals_raw else []
-                except json.JSONDecodeError:
-                    entries = []
-                yield patient_id, day, entries or []
+    def __init__(
+        self,
+        db: "DailyLogDB",
+        conn: sqlite3.Connection,
+        patient_id: str,
+        day: str,
+        create: bool = False,
+        expected_version: Optional[int] = None,
+    ):
+        self.db = db
+        self.conn = conn
+        self.patient_id = patient_id
+        self.day = day
+        self.version = db._open_day(conn, patient_id, day, create)
+        if expected_version is not None and self.version != expected_version:
+            raise VersionConflict(f"{patient_id}/{day}: version {self.version}, expected {expected_version}")
+
+    @property
+    def exists(self) -> bool:
+        return self.version is not None
+
+    def log(self) -> Optional[Dict[str, Any]]:
+        """The day as get_daily_log returns it, including this unit's uncommitted writes."""
+        return self.db._read_day(self.conn, self.patient_id, self.day)
+
+    def entries(self) -> List[Dict[str, Any]]:
+        log = self.log()
+        return log["entries"] if log else []
+
+    def append(self, entry: Dict[str, Any]) -> None:
+        db, conn = self.db, self.conn
+        position = db._next_position(conn, self.patient_id, self.day)
+        db._insert_entry(conn, self.patient_id, self.day, position, entry)
+        row = conn.execute(
+            "SELECT daily_totals FROM daily_logs WHERE patient_id = ? AND day = ?", (self.patient_id, self.day)
+        ).fetchone()
+        try:
+            totals = json.loads(row[0]) if row else {}
+        except json.JSONDecodeError:
+            totals = {}
+        totals = {**DEFAULT_TOTALS, **(totals or {})}
+        summary = db._summary_values(entry)
+        for key in DEFAULT_TOTALS:
+            totals[key] += summary[key]
+        self._write_day(totals)
+
+    def update(
+        self, entry_id: str, updater: Callable[[Dict[str, Any]], Dict[str, Any]]
+    ) -> Optional[Dict[str, Any]]:
+        """Apply updater to every entry with this id; the updated entry (last one), None if there is none."""
+        if not self.exists:
+            return None
+        db, conn = self.db, self.conn
+        rows = conn.execute(
+            "SELECT id, has_foods, data FROM entries WHERE patient_id = ? AND day = ? AND entry_id = ?",
+            (self.patient_id, self.day, str(entry_id)),
+        ).fetchall()
+        if not rows:
+            return None
+        for entry_rowid, has_foods, data_raw in rows:
+            food_rows = conn.execute(
+                "SELECT data FROM entry_foods WHERE entry_rowid = ? ORDER BY position", (entry_rowid,)
+            ).fetchall()
+            old_entry = db._join_entry(data_raw, has_foods, [json.loads(food_raw) for (food_raw,) in food_rows])
+            # deepcopy: updaters edit foods in place, the old version is needed for the diff
+            new_entry = updater(copy.deepcopy(old_entry))
+            db._write_entry_changes(conn, entry_rowid, old_entry, new_entry)
+        self._write_day(db._refresh_totals(conn, self.patient_id, self.day))
+        return new_entry
+
+    def replace(
+        self,
+        entries: List[Dict[str, Any]],
+        totals: Optional[Dict[str, Any]] = None,
+        last_updated: Optional[str] = None,
+    ) -> None:
+        """Replace the whole day (totals default to the entries' sum)."""
+        self.db._delete_day_entries(self.conn, self.patient_id, self.day)
+        for position, entry in enumerate(entries):
+            self.db._insert_entry(self.conn, self.patient_id, self.day, position, entry)
+        self._write_day(self.db._recalc_totals(entries) if totals is None else totals, last_updated)
+
+    def delete(self) -> bool:
+        """Delete the day, True if it existed."""
+        self.db._delete_day_entries(self.conn, self.patient_id, self.day)
+        cursor = self.conn.execute(
+            "DELETE FROM daily_logs WHERE patient_id = ? AND day = ? AND version IS ?",
+            (self.patient_id, self.day, self.version),
+        )
+        existed, self.version = cursor.rowcount > 0, None
+        return existed
+
+    def _write_day(self, totals: Dict[str, Any], last_updated: Optional[str] = None) -> None:
+        cursor = self.conn.execute(
+            """
+            UPDATE daily_logs SET daily_totals = ?, last_updated = ?, version = version + 1
+            WHERE patient_id = ? AND day = ? AND version = ?
+            """,
+            (
+                json.dumps(totals, ensure_ascii=False),
+                last_updated or datetime.now().isoformat(),
+                self.patient_id,
+                self.day,
+                self.version,
+            ),
+        )
+        if cursor.rowcount != 1:
+            raise VersionConflict(f"{self.patient_id}/{self.day} changed since version {self.version}")
+        self.version += 1
 
 
 class FoodLearningDB:
@@ -349,7 +951,7 @@ class FoodLearningDB:
         self._ensure_schema()
 
     def _connect(self):
-        return sqlite3.connect(self.db_path)
+        return get_connection(self.db_path)
 
     def _ensure_schema(self) -> None:
         with self._connect() as conn:
@@ -760,6 +1362,20 @@ class FoodLearningDB:
                 foods[food_name] = {}
         return foods
 
+    def get_learned_food(self, food_name: str) -> Optional[Dict[str, Any]]:
+        """Return food_data of one learned food, or None."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT food_data FROM learned_foods WHERE food_name = ?",
+                ((food_name or "").strip(),),
+            ).fetchone()
+        if not row:
+            return None
+        try:
+            return json.loads(row[0]) if row[0] else {}
+        except json.JSONDecodeError:
+            return {}
+
     def get_learned_aliases(self) -> List[Dict[str, str]]:
         """Return list of {alias, canonical_name}."""
         with self._connect() as conn:
@@ -768,3 +1384,112 @@ class FoodLearningDB:
             )
             rows = cursor.fetchall()
         return [{"alias": alias, "canonical_name": canonical} for alias, canonical in rows]
+
+
+class ResponseCacheDB:
+    """
+    SQLite tier of the DeepSeek response cache, shared by all workers on this host.
+
+    Table:
+    - llm_response_cache: key (hash of model + prompt version + normalized input) -> JSON response,
+      with absolute expiry (epoch seconds), a negative-result flag and last-hit time for LRU eviction.
+    """
+
+    def __init__(self, db_path: Path = DB_PATH, max_entries: int = 20000):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self._puts = 0
+        self._ensure_schema()
+
+    def _connect(self):
+        return get_connection(self.db_path)
+
+    def _ensure_schema(self) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS llm_response_cache (
+                    key TEXT PRIMARY KEY,
+                    response TEXT NOT NULL,
+                    negative INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_hit_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_llm_response_cache_last_hit "
+                "ON llm_response_cache (last_hit_at)"
+            )
+            conn.commit()
+
+    def get(self, key: str, now: float) -> Optional[Tuple[Dict[str, Any], float]]:
+        """Return (response, expires_at) for a live entry, or None."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT response, expires_at FROM llm_response_cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if not row:
+                return None
+            if row[1] <= now:
+                conn.execute("DELETE FROM llm_response_cache WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            conn.execute(
+                "UPDATE llm_response_cache SET last_hit_at = ? WHERE key = ?",
+                (now, key),
+            )
+            conn.commit()
+        try:
+            return json.loads(row[0]), row[1]
+        except json.JSONDecodeError:
+            return None
+
+    def put(self, key: str, response: Dict[str, Any], expires_at: float, negative: bool, now: float) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO llm_response_cache (key, response, negative, created_at, expires_at, last_hit_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    response = excluded.response,
+                    negative = excluded.negative,
+                    created_at = excluded.created_at,
+                    expires_at = excluded.expires_at,
+                    last_hit_at = excluded.last_hit_at
+                """,
+                (key, json.dumps(response, ensure_ascii=False), int(negative), now, expires_at, now),
+            )
+            conn.commit()
+        self._puts += 1
+        if self._puts % 64 == 0:
+            self.evict(now)
+
+    def evict(self, now: float) -> int:
+        """Drop expired rows, then the least recently hit rows above max_entries."""
+        with self._connect() as conn:
+            removed = conn.execute(
+                "DELETE FROM llm_response_cache WHERE expires_at <= ?", (now,)
+            ).rowcount
+            (count,) = conn.execute("SELECT COUNT(*) FROM llm_response_cache").fetchone()
+            if count > self.max_entries:
+                removed += conn.execute(
+                    """
+                    DELETE FROM llm_response_cache WHERE key IN (
+                        SELECT key FROM llm_response_cache ORDER BY last_hit_at LIMIT ?
+                    )
+                    """,
+                    (count - self.max_entries,),
+                ).rowcount
+            conn.commit()
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._connect() as conn:
+            total, negative = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(negative), 0) FROM llm_response_cache"
+            ).fetchone()
+        return {"entries": total, "negativeEntries": negative, "maxEntries": self.max_entries}
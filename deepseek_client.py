@@ -1,11 +1,26 @@
+import copy
+import hashlib
 import json
 import re
-import time
-from typing import Any, Dict, List, Optional
-
-import requests
+import threading
+import unicodedata
+from typing import Any, Dict, Generator, List, Optional, Tuple
 
+from caching import TieredResponseCache
+from concurrency import AsyncSingleFlight, MicroBatcher, SingleFlight, run_blocking
 from config import Config
+from dbs import ResponseCacheDB
+from http_client import apost_json, iter_sse_data, open_event_stream, post_json, request_timeouts
+from resilience import (
+    CircuitBreaker,
+    Deadline,
+    DeadlineExceeded,
+    Overloaded,
+    acall_with_retries,
+    call_with_retries,
+    current_deadline,
+    llm_limiters,
+)
 
 
 SYSTEM_PROMPT = """
@@ -40,6 +55,108 @@ Ghi nhớ:
 - Chỉ trả về JSON, không thêm giải thích khác.
 """
 
+# Gom nhiều cụm món (của nhiều request) vào một lần gọi: system prompt chỉ gửi một lần.
+# Chỉ đổi phần bọc input/output, kết quả từng item tương đương gọi riêng nên dùng chung cache key.
+BATCH_SYSTEM_PROMPT = SYSTEM_PROMPT.strip() + """
+Chế độ batch: nội dung user là JSON {"items": [{"id": số, "text": "cụm món"}]}.
+Phân tích từng text độc lập như một câu riêng và trả về đúng JSON:
+{"items": [{"id": id giữ nguyên, "foods": [các món, cùng cấu trúc như trên]}]}
+Mỗi id đầu vào có đúng một phần tử; không cần analysis/suggestions.
+"""
+# Trần max_tokens cho một batch (max_tokens mỗi item, tối đa bằng giới hạn output của model)
+MAX_BATCH_OUTPUT_TOKENS = 8192
+
+# Đổi prompt là đổi version -> cache cũ tự hết hiệu lực
+PROMPT_VERSION = hashlib.sha256(SYSTEM_PROMPT.strip().encode("utf-8")).hexdigest()[:12]
+
+_shared_cache: Optional[TieredResponseCache] = None
+_shared_cache_lock = threading.Lock()
+
+# Cùng input đang được gọi (retry từ app, nhiều bệnh nhân cùng lúc) -> chỉ 1 request lên DeepSeek
+inflight = SingleFlight()
+ainflight = AsyncSingleFlight()
+
+# Dùng chung cho mọi client trong process: DeepSeek lỗi liên tục -> chỉ chạy local một lúc
+breaker = CircuitBreaker(Config.DEEPSEEK_BREAKER_FAILURES, Config.DEEPSEEK_BREAKER_RESET_SECONDS)
+
+
+def shared_response_cache() -> Optional[TieredResponseCache]:
+    """Process-wide DeepSeek response cache (None when DEEPSEEK_CACHE_TTL_SECONDS <= 0)."""
+    global _shared_cache
+    if Config.DEEPSEEK_CACHE_TTL_SECONDS <= 0:
+        return None
+    if _shared_cache is None:
+        with _shared_cache_lock:
+            if _shared_cache is None:
+                _shared_cache = TieredResponseCache(
+                    memory_size=Config.DEEPSEEK_CACHE_MEMORY_SIZE,
+                    store=ResponseCacheDB(max_entries=Config.DEEPSEEK_CACHE_DB_MAX_ENTRIES),
+                    ttl=Config.DEEPSEEK_CACHE_TTL_SECONDS,
+                    negative_ttl=Config.DEEPSEEK_NEGATIVE_CACHE_TTL_SECONDS,
+                )
+    return _shared_cache
+
+
+def normalize_cache_input(text: str) -> str:
+    """Lower-case, NFC, collapsed whitespace (keeps diacritics: "phở" != "pho")."""
+    return unicodedata.normalize("NFC", " ".join((text or "").lower().split()))
+
+
+class FoodStreamParser:
+    """
+    Parse dần nội dung JSON đang được stream: feed(chunk) trả về các object trong mảng
+    "foods" cấp ngoài cùng vừa đóng ngoặc (chưa cần phần còn lại của câu trả lời).
+    """
+
+    def __init__(self) -> None:
+        self.content = ""
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string: Optional[str] = None
+        self._in_foods = False
+        self._food_start: Optional[int] = None
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self.content += chunk
+        foods: List[Dict[str, Any]] = []
+        content = self.content
+        for pos in range(self._pos, len(content)):
+            char = content[pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._last_string = content[self._string_start:pos]
+                continue
+            if char == '"':
+                self._in_string, self._string_start = True, pos + 1
+            elif char in "{[":
+                if char == "[" and self._stack == ["{"] and self._last_string == "foods":
+                    self._in_foods = True
+                elif char == "{" and self._in_foods and len(self._stack) == 2:
+                    self._food_start = pos
+                self._stack.append(char)
+            elif char in "}]" and self._stack:
+                self._stack.pop()
+                if self._in_foods and len(self._stack) == 1:
+                    self._in_foods = False  # đóng mảng foods
+                elif self._food_start is not None and len(self._stack) == 2:
+                    try:
+                        food = json.loads(content[self._food_start:pos + 1])
+                    except json.JSONDecodeError:
+                        food = None
+                    if isinstance(food, dict):
+                        foods.append(food)
+                    self._food_start = None
+        self._pos = len(content)
+        return foods
+
 
 class DeepSeekClient:
     """Client đơn giản gọi DeepSeek API để trích xuất món ăn."""
@@ -50,82 +167,91 @@ class DeepSeekClient:
         self.model = Config.MODEL
         self.temperature = Config.TEMPERATURE
         self.max_tokens = Config.MAX_TOKENS
-        self.timeout = Config.REQUEST_TIMEOUT
-        # Cache ngắn để tránh gọi DeepSeek 2 lần cho cùng input trong cùng phiên/request
-        self._cache_ttl = getattr(Config, "DEEPSEEK_CACHE_TTL_SECONDS", 5)
-        self._last_cache: Dict[str, Any] = {"key": None, "ts": 0.0, "response": None}
+        self.max_attempts = Config.DEEPSEEK_MAX_ATTEMPTS
+        self.retry_base_delay = Config.DEEPSEEK_RETRY_BASE_DELAY
+        self.retry_max_delay = Config.DEEPSEEK_RETRY_MAX_DELAY
+        self.breaker = breaker
+        # Hạn mức gọi LLM của loại "food" (dùng chung với mọi client trong process)
+        self.limiter = llm_limiters["food"]
+        # None = không cache (gán TieredResponseCache riêng để test/benchmark)
+        self.response_cache = shared_response_cache()
+        # Gom cụm món từ nhiều request (None = tắt, xem DEEPSEEK_BATCH_WINDOW_MS)
+        self.batcher: Optional[MicroBatcher] = None
+        if Config.DEEPSEEK_BATCH_WINDOW_MS > 0:
+            self.batcher = MicroBatcher(
+                self._fetch_batch,
+                window=Config.DEEPSEEK_BATCH_WINDOW_MS / 1000,
+                max_items=Config.DEEPSEEK_BATCH_MAX_ITEMS,
+            )
 
     def is_available(self) -> bool:
         return bool(self.api_key)
 
-    def analyze(self, user_input: str) -> Dict[str, Any]:
-        """Gửi câu người dùng tới DeepSeek và cố gắng parse JSON."""
-        if not self.is_available():
-            return {
-                "success": False,
-                "error": "DeepSeek API key not configured",
-                "foods": [],
-                "analysis": "",
-                "suggestions": [],
-                "raw_content": "",
-            }
+    def _empty_result(self, error: str, overloaded: bool = False) -> Dict[str, Any]:
+        result = {
+            "success": False,
+            "error": error,
+            "foods": [],
+            "analysis": "",
+            "suggestions": [],
+            "raw_content": "",
+        }
+        if overloaded:
+            result["overloaded"] = True
+        return result
 
+    def _build_request(
+        self,
+        user_input: str,
+        system_prompt: str = SYSTEM_PROMPT,
+        max_tokens: Optional[int] = None,
+    ) -> Tuple[str, Dict[str, Any], Dict[str, str]]:
         payload = {
             "model": self.model,
             "messages": [
-                {"role": "system", "content": SYSTEM_PROMPT.strip()},
+                {"role": "system", "content": system_prompt.strip()},
                 {"role": "user", "content": user_input},
             ],
             "temperature": self.temperature,
-            "max_tokens": self.max_tokens,
+            "max_tokens": max_tokens or self.max_tokens,
         }
 
         headers = {
             "Authorization": f"Bearer {self.api_key}",
             "Content-Type": "application/json",
         }
+        return f"{self.base_url}/chat/completions", payload, headers
 
-        # Dedupe: nếu cùng input được gọi lại trong thời gian ngắn, dùng cache để tránh double-call
-        cache_key = f"{self.model}:{user_input.strip()}"
-        now = time.time()
-        if (
-            self._last_cache.get("key") == cache_key
-            and now - float(self._last_cache.get("ts", 0)) <= float(self._cache_ttl or 0)
-            and self._last_cache.get("response") is not None
-        ):
-            cached = self._last_cache["response"]
-            return dict(cached)
+    def cache_key(self, user_input: str) -> str:
+        raw = f"{self.model}|{PROMPT_VERSION}|{normalize_cache_input(user_input)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-        try:
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                json=payload,
-                headers=headers,
-                timeout=self.timeout,
-            )
-            response.raise_for_status()
-        except Exception as exc:  # pragma: no cover - network errors are runtime issues
-            result = {
-                "success": False,
-                "error": str(exc),
-                "foods": [],
-                "analysis": "",
-                "suggestions": [],
-                "raw_content": "",
-            }
-            self._last_cache = {"key": cache_key, "ts": now, "response": result}
-            return result
+    def _get_cached(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        if self.response_cache is None:
+            return None
+        return self.response_cache.get(cache_key)
+
+    def _store(self, cache_key: str, result: Dict[str, Any]) -> None:
+        # Chỉ gọi với câu trả lời thật của DeepSeek; không có món/không parse được vẫn cache
+        # (TTL ngắn) để câu lặp lại không gọi lại ngay. Lỗi transport/HTTP không bao giờ cache:
+        # tier SQLite dùng chung, một lần sự cố sẽ làm hỏng input đó cho mọi worker
+        if self.response_cache is not None:
+            self.response_cache.put(cache_key, result, negative=not result.get("success"))
 
-        data = response.json()
-        content = (
+    @staticmethod
+    def _message_content(data: Dict[str, Any]) -> str:
+        return (
             data.get("choices", [{}])[0]
             .get("message", {})
             .get("content", "")
         )
 
+    def _parse_response(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        content = self._message_content(data)
+
         parsed = self._extract_json(content)
 
-        result = {
+        return {
             "success": parsed is not None,
             "error": None if parsed is not None else "Cannot parse DeepSeek JSON response",
             "foods": parsed.get("foods", []) if parsed else [],
@@ -133,9 +259,264 @@ class DeepSeekClient:
             "suggestions": parsed.get("suggestions", []) if parsed else [],
             "raw_content": content,
         }
-        self._last_cache = {"key": cache_key, "ts": now, "response": result}
+
+    def analyze(self, user_input: str) -> Dict[str, Any]:
+        """Gửi câu người dùng tới DeepSeek và cố gắng parse JSON."""
+        if not self.is_available():
+            return self._empty_result("DeepSeek API key not configured")
+
+        cache_key = self.cache_key(user_input)
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            return cached
+        return inflight.do((self.base_url, cache_key), self._fetch, user_input, cache_key)
+
+    @staticmethod
+    def _deadline() -> Deadline:
+        # Ngân sách do endpoint đặt (deadline_scope); ngoài request thì theo REQUEST_TIMEOUT
+        return current_deadline() or Deadline(Config.REQUEST_TIMEOUT)
+
+    def _post(
+        self,
+        url: str,
+        payload: Dict[str, Any],
+        headers: Dict[str, str],
+        deadline: Optional[Deadline] = None,
+    ) -> Dict[str, Any]:
+        """
+        post_json trong ngân sách còn lại, retry lỗi tạm thời, qua circuit breaker.
+        Chờ slot của limiter tối đa phần ngân sách còn lại (Overloaded nếu hết chỗ).
+        deadline: truyền thẳng khi chạy ngoài context của request (thread của batcher).
+        """
+        connect_timeout, read_timeout = request_timeouts()
+        deadline = deadline or self._deadline()
+        with self.limiter.slot(deadline.remaining()):
+            return call_with_retries(
+                lambda attempt_deadline: post_json(
+                    url, payload, headers, attempt_deadline.timeouts(connect_timeout, read_timeout)
+                ),
+                deadline,
+                attempts=self.max_attempts,
+                base_delay=self.retry_base_delay,
+                max_delay=self.retry_max_delay,
+                breaker=self.breaker,
+            )
+
+    async def _apost(self, url: str, payload: Dict[str, Any], headers: Dict[str, str]) -> Dict[str, Any]:
+        connect_timeout, read_timeout = request_timeouts()
+
+        async def attempt(deadline: Deadline) -> Dict[str, Any]:
+            return await apost_json(url, payload, headers, deadline.timeouts(connect_timeout, read_timeout))
+
+        deadline = self._deadline()
+        async with self.limiter.aslot(deadline.remaining()):
+            return await acall_with_retries(
+                attempt,
+                deadline,
+                attempts=self.max_attempts,
+                base_delay=self.retry_base_delay,
+                max_delay=self.retry_max_delay,
+                breaker=self.breaker,
+            )
+
+    def _fetch(self, user_input: str, cache_key: str) -> Dict[str, Any]:
+        url, payload, headers = self._build_request(user_input)
+        try:
+            data = self._post(url, payload, headers)
+        except Overloaded as exc:
+            return self._empty_result(str(exc), overloaded=True)  # không cache, caller chạy local
+        except Exception as exc:
+            # Lỗi kết nối, 5xx sau retry, breaker mở, hết deadline...: không nói gì về input này
+            return self._empty_result(str(exc) or type(exc).__name__)
+        result = self._parse_response(data)
+        self._store(cache_key, result)
+        return result
+
+    async def aanalyze(self, user_input: str) -> Dict[str, Any]:
+        """Bản asyncio của analyze() (httpx pool nếu có, không thì chạy trên thread pool)."""
+        if not self.is_available():
+            return self._empty_result("DeepSeek API key not configured")
+
+        cache_key = self.cache_key(user_input)
+        # SQLite tier: không chạy trên event loop
+        cached = await run_blocking(self._get_cached, cache_key)
+        if cached is not None:
+            return cached
+        return await ainflight.do((self.base_url, cache_key), self._afetch, user_input, cache_key)
+
+    async def _afetch(self, user_input: str, cache_key: str) -> Dict[str, Any]:
+        url, payload, headers = self._build_request(user_input)
+        try:
+            data = await self._apost(url, payload, headers)
+        except Overloaded as exc:
+            return self._empty_result(str(exc), overloaded=True)
+        except Exception as exc:
+            return self._empty_result(str(exc) or type(exc).__name__)  # không cache, xem _fetch
+        result = self._parse_response(data)
+        await run_blocking(self._store, cache_key, result)
+        return result
+
+    def analyze_stream(
+        self, user_input: str, deadline: Optional[Deadline] = None
+    ) -> Generator[Dict[str, Any], None, Dict[str, Any]]:
+        """
+        Bản streaming của analyze(): yield từng món (raw, như phần tử của "foods") ngay khi
+        object JSON của món đóng lại, return kết quả đầy đủ (cùng format analyze()).
+        Dùng: result = yield from client.analyze_stream(text).
+        Không gộp single-flight; chỉ retry lúc mở stream, lỗi giữa chừng không cache.
+        deadline: truyền thẳng vì generator có thể chạy tiếp ở thread khác (không có contextvar).
+        """
+        if not self.is_available():
+            return self._empty_result("DeepSeek API key not configured")
+
+        cache_key = self.cache_key(user_input)
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            yield from cached.get("foods", [])
+            return cached
+
+        deadline = deadline or self._deadline()
+        url, payload, headers = self._build_request(user_input)
+        payload["stream"] = True
+        connect_timeout, read_timeout = request_timeouts()
+        parser = FoodStreamParser()
+        streamed: List[Dict[str, Any]] = []
+        try:
+            with self.limiter.slot(deadline.remaining()):
+                response = call_with_retries(
+                    lambda attempt_deadline: open_event_stream(
+                        url, payload, headers, attempt_deadline.timeouts(connect_timeout, read_timeout)
+                    ),
+                    deadline,
+                    attempts=self.max_attempts,
+                    base_delay=self.retry_base_delay,
+                    max_delay=self.retry_max_delay,
+                    breaker=self.breaker,
+                )
+                with response:  # trả connection về pool kể cả khi caller bỏ ngang generator
+                    for data in iter_sse_data(response):
+                        if deadline.expired():
+                            raise DeadlineExceeded("deadline exceeded while streaming DeepSeek response")
+                        for food in parser.feed(self._delta_content(json.loads(data))):
+                            streamed.append(food)
+                            yield food
+        except Exception as exc:
+            error = str(exc) or type(exc).__name__
+            if isinstance(exc, Overloaded):
+                return self._empty_result(error, overloaded=True)
+            # Không cache: kết quả thiếu (đứt giữa chừng) hoặc lỗi không nói gì về input này
+            return {**self._empty_result(error), "success": bool(streamed), "foods": streamed}
+        else:
+            result = self._parse_response({"choices": [{"message": {"content": parser.content}}]})
+            if len(result["foods"]) < len(streamed):  # JSON tổng không parse được: giữ món đã ra
+                result.update(success=True, error=None, foods=streamed)
+            # Parser không nhận ra (vd JSON bọc lạ): phần còn lại ra ở cuối
+            yield from result["foods"][len(streamed):]
+        self._store(cache_key, result)
         return result
 
+    @staticmethod
+    def _delta_content(data: Dict[str, Any]) -> str:
+        choices = data.get("choices") or [{}]
+        return (choices[0].get("delta") or {}).get("content") or ""
+
+    def analyze_phrases(self, phrases: List[str]) -> List[Dict[str, Any]]:
+        """
+        Phân tích từng cụm món riêng, kết quả cùng thứ tự (cùng format analyze()).
+        Có batcher thì gom chung với các request khác; không thì một lần gọi cho cả list.
+        """
+        if not self.is_available():
+            return [self._empty_result("DeepSeek API key not configured") for _ in phrases]
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(phrases)
+        deadline = current_deadline()
+        missing = []
+        for i, phrase in enumerate(phrases):
+            cache_key = self.cache_key(phrase)
+            results[i] = self._get_cached(cache_key)
+            if results[i] is None:
+                # Deadline đi cùng item: batch chạy trên thread khác, không thấy contextvar
+                missing.append((i, (phrase, cache_key, deadline)))
+        if not missing:
+            return results
+
+        if self.batcher is None:
+            fetched = self._fetch_batch([item for _, item in missing])
+            for (i, _), result in zip(missing, fetched):
+                results[i] = result
+            return results
+
+        if deadline is not None:
+            timeout = deadline.remaining()
+        else:
+            connect_timeout, read_timeout = request_timeouts()
+            timeout = connect_timeout + read_timeout + self.batcher.window
+        futures = [(i, self.batcher.submit((self.base_url, item[1]), item)) for i, item in missing]
+        for i, future in futures:
+            try:
+                # Future có thể dùng chung giữa các request -> mỗi bên một bản sao
+                results[i] = copy.deepcopy(future.result(timeout=timeout))
+            except Exception as exc:
+                results[i] = self._empty_result(str(exc) or type(exc).__name__)
+        return results
+
+    def _fetch_batch(self, items: List[Tuple[str, str, Optional[Deadline]]]) -> List[Dict[str, Any]]:
+        """
+        Một lần gọi cho list (cụm món, cache key, deadline của caller); cache item DeepSeek trả về.
+        Chạy trong deadline sớm nhất của các caller: không giữ slot "food" sau khi họ đã bỏ cuộc.
+        """
+        deadlines = [deadline for _, _, deadline in items if deadline is not None]
+        deadline = min(deadlines, key=lambda d: d.expires_at) if deadlines else None
+        user_input = json.dumps(
+            {"items": [{"id": i, "text": phrase} for i, (phrase, _, _) in enumerate(items)]},
+            ensure_ascii=False,
+        )
+        max_tokens = min(MAX_BATCH_OUTPUT_TOKENS, self.max_tokens * len(items))
+        url, payload, headers = self._build_request(user_input, BATCH_SYSTEM_PROMPT, max_tokens)
+        try:
+            data = self._post(url, payload, headers, deadline)
+        except Overloaded as exc:
+            return [self._empty_result(str(exc), overloaded=True) for _ in items]
+        except Exception as exc:
+            return [self._empty_result(str(exc) or type(exc).__name__) for _ in items]  # không cache
+        results = self._parse_batch_response(data, len(items))
+        for (_, cache_key, _), result in zip(items, results):
+            # Thiếu id / cả batch không parse được (vd bị cắt ở MAX_BATCH_OUTPUT_TOKENS) là lỗi
+            # của lần gọi gộp, không phải câu trả lời cho cụm món này: không cache
+            if result["success"]:
+                self._store(cache_key, result)
+        return results
+
+    def _parse_batch_response(self, data: Dict[str, Any], count: int) -> List[Dict[str, Any]]:
+        parsed = self._extract_json(self._message_content(data))
+        items = parsed.get("items") if isinstance(parsed, dict) else None
+        if not isinstance(items, list):
+            return [self._empty_result("Cannot parse DeepSeek batch response") for _ in range(count)]
+
+        by_id: Dict[int, Dict[str, Any]] = {}
+        for item in items:
+            try:
+                by_id[int(item.get("id"))] = item
+            except (AttributeError, TypeError, ValueError):
+                continue
+
+        results = []
+        for i in range(count):
+            item = by_id.get(i)
+            if item is None:
+                results.append(self._empty_result("Item missing from DeepSeek batch response"))
+                continue
+            foods = item.get("foods")
+            results.append({
+                "success": True,
+                "error": None,
+                "foods": foods if isinstance(foods, list) else [],
+                "analysis": "",
+                "suggestions": [],
+                "raw_content": json.dumps(item, ensure_ascii=False),
+            })
+        return results
+
     def _extract_json(self, content: str) -> Optional[Dict[str, Any]]:
         """Tìm và parse JSON trong nội dung trả về."""
         if not content:
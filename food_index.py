@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Artifact index món ăn dựng sẵn (dataset đã merge + index của FoodNameMatcher).
+
+Build:  python food_index.py build [path]
+
+Worker đầu tiên tạo FoodNameMatcher sẽ mmap file này thay vì load_learned_foods() +
+build_index(). File lệch phiên bản, lệch source `vietnamese_foods_extended.py` hoặc
+lệch dữ liệu learned trong SQLite thì bị bỏ qua và dùng đường build cũ.
+"""
+import hashlib
+import mmap
+import os
+import pickle
+import sqlite3
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from config import Config
+from dbs import DB_PATH
+
+MAGIC = b"VNFOODIX"
+ARTIFACT_VERSION = 1
+_FINGERPRINT_LEN = 64  # sha256 hex
+_HEADER_LEN = len(MAGIC) + 2 + _FINGERPRINT_LEN
+SOURCE_PATH = Path(__file__).resolve().parent / "vietnamese_foods_extended.py"
+
+
+def artifact_path() -> Optional[Path]:
+    """Configured artifact path, or None when disabled (FOOD_INDEX_PATH="")."""
+    path = Config.FOOD_INDEX_PATH
+    return Path(path) if path else None
+
+
+def _learned_state(db_path: Path) -> str:
+    """Cheap summary of the learned tables; changes whenever an approval is written."""
+    if not Path(db_path).exists():
+        return "no-db"
+    try:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    except sqlite3.Error:
+        return "no-db"
+    try:
+        parts = []
+        for table in ("learned_foods", "learned_aliases"):
+            try:
+                count, last_updated = conn.execute(
+                    f"SELECT COUNT(*), MAX(updated_at) FROM {table}"
+                ).fetchone()
+            except sqlite3.Error:
+                count, last_updated = 0, None
+            parts.append(f"{table}:{count}:{last_updated}")
+        return "|".join(parts)
+    finally:
+        conn.close()
+
+
+def compute_fingerprint(db_path: Path = DB_PATH) -> str:
+    digest = hashlib.sha256()
+    digest.update(f"v{ARTIFACT_VERSION}|py{sys.version_info[:2]}|".encode())
+    digest.update(SOURCE_PATH.read_bytes())
+    digest.update(_learned_state(db_path).encode())
+    return digest.hexdigest()
+
+
+def build_artifact(path: Optional[Path] = None, db_path: Path = DB_PATH) -> Path:
+    """Merge learned foods, build the matcher index and write the artifact atomically."""
+    from vietnamese_foods_extended import VIETNAMESE_FOODS_NUTRITION, FoodNameMatcher, load_learned_foods
+
+    path = Path(path) if path else artifact_path()
+    if path is None:
+        raise ValueError("FOOD_INDEX_PATH is disabled")
+
+    # Fingerprint first: an approval landing during the build makes the file stale, not wrong.
+    fingerprint = compute_fingerprint(db_path)
+    load_learned_foods(force=True)
+    matcher = FoodNameMatcher(use_prebuilt=False)
+    payload = pickle.dumps(
+        {"dataset": VIETNAMESE_FOODS_NUTRITION, "index": matcher._index},
+        protocol=pickle.HIGHEST_PROTOCOL,
+    )
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(prefix=path.name, dir=path.parent)
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(MAGIC)
+            fh.write(ARTIFACT_VERSION.to_bytes(2, "big"))
+            fh.write(fingerprint.encode("ascii"))
+            fh.write(payload)
+        os.replace(tmp_name, path)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+    return path
+
+
+def load_artifact(path: Optional[Path] = None, db_path: Path = DB_PATH) -> Optional[Dict[str, Any]]:
+    """
+    Return {"dataset", "index"} from a fresh artifact, or None if it is missing/stale.
+    The header is checked on the mapped file before anything is unpickled.
+    """
+    path = Path(path) if path else artifact_path()
+    if path is None or not path.exists():
+        return None
+
+    with open(path, "rb") as fh:
+        if os.fstat(fh.fileno()).st_size <= _HEADER_LEN:
+            return None
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(MAGIC)] != MAGIC:
+                return None
+            version = int.from_bytes(mapped[len(MAGIC):len(MAGIC) + 2], "big")
+            fingerprint = mapped[len(MAGIC) + 2:_HEADER_LEN].decode("ascii", "replace")
+            if version != ARTIFACT_VERSION or fingerprint != compute_fingerprint(db_path):
+                return None
+            with memoryview(mapped) as view, view[_HEADER_LEN:] as body:
+                return pickle.loads(body)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "build":
+        print(__doc__.strip())
+        sys.exit(1)
+    target = build_artifact(Path(sys.argv[2]) if len(sys.argv) > 2 else None)
+    print(f"Wrote {target} ({target.stat().st_size} bytes)")
@@ -0,0 +1,180 @@
+"""
+Shared HTTP clients for DeepSeek calls (food analysis + lab-report matching).
+
+- Sync: one requests.Session per process with a bounded keep-alive pool, so
+  consecutive calls reuse the TCP/TLS connection instead of handshaking each time.
+- Async: httpx.AsyncClient (optional dependency) with the same limits, one per event
+  loop; without httpx the sync session runs on the "pipeline" thread pool.
+
+Timeouts are (Config.REQUEST_CONNECT_TIMEOUT, Config.REQUEST_READ_TIMEOUT).
+Streaming completions (server-sent events) use the same session: open_event_stream +
+iter_sse_data; the read timeout then bounds the gap between two chunks.
+"""
+import asyncio
+import os
+import threading
+import urllib.request
+import weakref
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import Config
+from concurrency import run_blocking
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Any]" = weakref.WeakKeyDictionary()
+
+
+def request_timeouts() -> Tuple[float, float]:
+    return float(Config.REQUEST_CONNECT_TIMEOUT), float(Config.REQUEST_READ_TIMEOUT)
+
+
+def get_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=Config.HTTP_POOL_HOSTS,
+                    pool_maxsize=Config.HTTP_POOL_SIZE,
+                    pool_block=True,  # wait for a free connection instead of opening extras
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                # requests re-reads proxy/CA env vars on every call (~0.5 ms with a large
+                # environment); skip that when none are configured.
+                if not (urllib.request.getproxies() or os.getenv("REQUESTS_CA_BUNDLE") or os.getenv("CURL_CA_BUNDLE")):
+                    session.trust_env = False
+                _session = session
+    return _session
+
+
+def post_json(
+    url: str,
+    payload: Dict[str, Any],
+    headers: Dict[str, str],
+    timeout: Optional[Tuple[float, float]] = None,
+) -> Dict[str, Any]:
+    """
+    POST JSON on the pooled session; raises for HTTP errors, returns the decoded body.
+    timeout: (connect, read) override, e.g. capped by a request deadline.
+    """
+    response = get_session().post(url, json=payload, headers=headers, timeout=timeout or request_timeouts())
+    response.raise_for_status()
+    return response.json()
+
+
+def open_event_stream(
+    url: str,
+    payload: Dict[str, Any],
+    headers: Dict[str, str],
+    timeout: Optional[Tuple[float, float]] = None,
+) -> requests.Response:
+    """POST on the pooled session with stream=True; raises for HTTP errors (body not read yet)."""
+    response = get_session().post(
+        url,
+        json=payload,
+        headers={**headers, "Accept": "text/event-stream"},
+        timeout=timeout or request_timeouts(),
+        stream=True,
+    )
+    try:
+        response.raise_for_status()
+    except Exception:
+        response.close()
+        raise
+    return response
+
+
+def iter_sse_data(response: requests.Response) -> Iterator[str]:
+    """
+    Yield the data of each server-sent event until "[DONE]" or end of body; multi-line
+    data is joined with "\\n". Reads the body to the end (so the keep-alive connection
+    goes back to the pool) and always closes the response.
+    """
+    data_lines = []
+    done = False
+    try:
+        for raw in response.iter_lines():
+            line = raw.decode("utf-8")
+            if done:
+                continue
+            if line.startswith("data:"):
+                data_lines.append(line[5:].lstrip(" "))
+                continue
+            if line or not data_lines:
+                continue  # comment/other field, or blank line without data
+            data = "\n".join(data_lines)
+            data_lines = []
+            if data == "[DONE]":
+                done = True
+                continue
+            yield data
+        if data_lines and data_lines != ["[DONE]"]:
+            yield "\n".join(data_lines)
+    finally:
+        response.close()
+
+
+def _get_async_client():
+    try:
+        import httpx  # type: ignore
+    except ImportError:
+        return None
+
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        connect_timeout, read_timeout = request_timeouts()
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=Config.HTTP_POOL_SIZE,
+                max_keepalive_connections=Config.HTTP_POOL_SIZE,
+            ),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def apost_json(
+    url: str,
+    payload: Dict[str, Any],
+    headers: Dict[str, str],
+    timeout: Optional[Tuple[float, float]] = None,
+) -> Dict[str, Any]:
+    """Async post_json: native httpx when installed, else the sync session on a worker thread."""
+    client = _get_async_client()
+    if client is None:
+        return await run_blocking(post_json, url, payload, headers, timeout, pool="pipeline")
+    if timeout is None:
+        response = await client.post(url, json=payload, headers=headers)
+    else:
+        import httpx  # type: ignore  # present: _get_async_client returned a client
+
+        connect_timeout, read_timeout = timeout
+        response = await client.post(
+            url, json=payload, headers=headers, timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+        )
+    response.raise_for_status()
+    return response.json()
+
+
+def close_clients() -> None:
+    """Close the shared session (async clients are closed with their loop)."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+    _async_clients.clear()
+
+
+async def aclose_clients() -> None:
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
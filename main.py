@@ -1,25 +1,46 @@
+from contextlib import asynccontextmanager
 from datetime import datetime
 from collections import defaultdict
 from typing import Any, Dict, List, Optional, Tuple
 
+import json
+import os
+
 import uvicorn
 from fastapi import FastAPI, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 
 from nutrition_pipeline_advanced import NutritionPipelineAdvanced
-from dbs import DailyLogDB, DEFAULT_TOTALS
+from dbs import DailyLogDB, DayUnitOfWork, DEFAULT_TOTALS, connection_stats
 from server_ai import router as server_ai_router
+from concurrency import get_executor, iterate_blocking, offload, pool_stats
+from config import Config
+from deepseek_client import (
+    ainflight as deepseek_ainflight,
+    breaker as deepseek_breaker,
+    inflight as deepseek_inflight,
+)
+from resilience import Deadline, deadline_scope, limiter_stats
 from vietnamese_foods_extended import (
     UNIT_CONVERSION,
     VIETNAMESE_FOODS_NUTRITION,
     calculate_nutrition,
     estimate_weight,
-    load_learned_foods,
+    estimate_weight_range,
+    get_dataset_version,
 )
 
 
-app = FastAPI(title="Nutrition Chat API", version="2.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Entry còn enrichmentPending do worker trước bị restart/kill: chạy lại hoặc đánh dấu failed
+    recover_pending_enrichments()
+    yield
+
+
+app = FastAPI(title="Nutrition Chat API", version="2.0.0", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -128,6 +149,10 @@ def to_spec_foods(foods: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     for idx, food in enumerate(foods, start=1):
         qty = food.get("quantity_info", food.get("quantityInfo", {})) or {}
         no_sugar = bool(food.get("no_sugar") or food.get("noSugar"))
+        weight_range = food.get("weightRange")
+        if weight_range is None and food.get("estimated_weight_range_g"):
+            low, high = food["estimated_weight_range_g"]
+            weight_range = {"min": round(low, 1), "max": round(high, 1)}
         mapped.append(
             {
                 "foodId": food.get("foodId") or f"tmp_{idx}",
@@ -139,6 +164,7 @@ def to_spec_foods(foods: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
                     "confidence": qty.get("confidence", 1.0),
                 },
                 "nutrition": food.get("nutrition", {}),
+                **({"weightRange": weight_range} if weight_range else {}),
                 **({"noSugar": True} if no_sugar else {}),
             }
         )
@@ -183,24 +209,15 @@ def recalc_food_nutrition(food: Dict[str, Any]) -> Dict[str, Any]:
     if no_sugar and isinstance(nutrition, dict):
         nutrition["sugar"] = 0.0
     food["nutrition"] = nutrition
+    if "weightRange" in food:
+        low, high = estimate_weight_range(quantity_info, category)
+        food["weightRange"] = {"min": round(low, 1), "max": round(high, 1)}
     return food
 
 
 def find_day_for_entry(patient_id: str, entry_id: str) -> Optional[str]:
     """Locate which day contains an entry id for a patient."""
-    logs = daily_log_db.get_patient_logs(patient_id)
-    for log in logs:
-        for entry in log.get("entries", []):
-            if entry.get("entryId") == entry_id:
-                return log.get("day")
-    return None
-
-
-def get_entry_by_id(log: Dict[str, Any], entry_id: str) -> Optional[Dict[str, Any]]:
-    for entry in log.get("entries", []):
-        if entry.get("entryId") == entry_id:
-            return entry
-    return None
+    return daily_log_db.locate_entry(patient_id, entry_id)
 
 
 def _run_analyze(
@@ -211,12 +228,34 @@ def _run_analyze(
     locale: Optional[str],
 ) -> Dict[str, Any]:
     """Shared analyze handler so different endpoints can save to a specific date."""
+    invalid = _validate_analyze(patient_id, date_key)
+    if invalid:
+        return invalid
+
+    # async: không chờ DeepSeek, worker nền cập nhật entry sau (xem enrich_entry)
+    # Mọi lần gọi DeepSeek (kể cả retry) nằm trong ngân sách của request
+    with deadline_scope(Config.ANALYZE_DEADLINE_SECONDS):
+        result = pipeline.process_input(text, defer_llm=Config.LLM_ENRICHMENT_MODE == "async")
+    return _save_analysis(patient_id, user_id, text, date_key, result)
+
+
+def _validate_analyze(patient_id: str, date_key: str) -> Optional[Dict[str, Any]]:
     if not patient_id:
         return error_response("VALIDATION_ERROR", "patientId is required")
     if not date_key:
         return error_response("VALIDATION_ERROR", "dateKey is required")
+    return None
+
 
-    result = pipeline.process_input(text)
+def _save_analysis(
+    patient_id: str,
+    user_id: Optional[str],
+    text: str,
+    date_key: str,
+    result: Dict[str, Any],
+) -> Dict[str, Any]:
+    """Append the analysed meal as a draft entry and build the /analyze response."""
+    enrichment_pending = bool(result.get("enrichment_pending"))
     entry_id = str(int(datetime.utcnow().timestamp() * 1000))
     mapped_foods = to_spec_foods(result.get("foods", []))
     meal_summary = to_meal_summary(result.get("meal_summary", {}))
@@ -240,6 +279,7 @@ def _run_analyze(
         "available": bool(result.get("deepseek_available")),
         "success": bool(result.get("deepseek_success")),
         "trigger": result.get("deepseek_trigger"),
+        "input": result.get("deepseek_input"),
         "error": result.get("deepseek_error"),
         "analysis": result.get("deepseek_analysis"),
         "suggestions": result.get("deepseek_suggestions") or [],
@@ -254,8 +294,11 @@ def _run_analyze(
         "mealSummary": meal_summary,
         "createdAt": now_utc(),
         "status": "draft",
+        **({"enrichmentPending": True, "enrichment": _enrichment_claim()} if enrichment_pending else {}),
     }
-    daily_log_db.append_entry(patient_id, date_key, entry)
+    daily_log_db.append_entry(patient_id, date_key, entry, return_log=False)
+    if enrichment_pending:
+        schedule_enrichment(patient_id, date_key, entry_id, text, mapped_foods)
 
     return {
         "success": True,
@@ -269,12 +312,136 @@ def _run_analyze(
             "entryId": entry_id,
             "createdAt": entry["createdAt"],
             "processingMethod": result.get("processing_method"),
+            **({"enrichmentPending": True} if enrichment_pending else {}),
             **({"confidence": confidence_meta} if confidence_meta else {}),
             "deepseek": deepseek_meta,
         },
     }
 
 
+def schedule_enrichment(
+    patient_id: str,
+    date_key: str,
+    entry_id: str,
+    text: str,
+    local_foods: List[Dict[str, Any]],
+):
+    """Run the deferred DeepSeek analysis for a stored entry on the enrichment pool."""
+    return get_executor("enrichment").submit(enrich_entry, patient_id, date_key, entry_id, text, local_foods)
+
+
+def enrich_entry(
+    patient_id: str,
+    date_key: str,
+    entry_id: str,
+    text: str,
+    local_foods: List[Dict[str, Any]],
+) -> Optional[Dict[str, Any]]:
+    """
+    Patch an enrichmentPending entry with the DeepSeek result (update_entry recalculates
+    the day totals). Entries edited or confirmed meanwhile keep the user's version.
+    """
+    try:
+        with deadline_scope(Config.ENRICHMENT_DEADLINE_SECONDS):
+            result = pipeline.analyze_text(text)
+        error = None if result.get("deepseek_success") else (
+            result.get("deepseek_error") or "DeepSeek did not return recognizable foods"
+        )
+    except Exception as exc:  # pragma: no cover - defensive, runs off the request path
+        result, error = {}, str(exc)
+
+    def updater(entry: Dict[str, Any]) -> Dict[str, Any]:
+        if not entry.get("enrichmentPending"):
+            return entry
+        entry["enrichmentPending"] = False
+        enrichment = {"completedAt": now_utc()}
+        if entry.get("foods") != local_foods or entry.get("status") != "draft":
+            enrichment["status"] = "skipped"
+        elif error:
+            enrichment.update(status="failed", error=error)
+        else:
+            entry["foods"] = to_spec_foods(result.get("foods", []))
+            entry["mealSummary"] = to_meal_summary(result.get("meal_summary", {}))
+            enrichment.update(status="done", processingMethod=result.get("processing_method"))
+        entry["enrichment"] = enrichment
+        return entry
+
+    return daily_log_db.update_entry(patient_id, date_key, entry_id, updater, return_log=False)
+
+
+def _parse_utc(value: Any) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(str(value).rstrip("Z"))
+    except ValueError:
+        return None
+
+
+def _enrichment_claim() -> Dict[str, Any]:
+    """Mark a pending entry's enrichment job as owned by this worker process."""
+    return {"status": "pending", "claimedBy": os.getpid(), "claimedAt": now_utc()}
+
+
+def _claim_is_live(enrichment: Any, now: datetime) -> bool:
+    """A claim holds while its job may still run: recent, and the claiming process is alive."""
+    if not isinstance(enrichment, dict):
+        return False
+    claimed_at = _parse_utc(enrichment.get("claimedAt"))
+    if claimed_at is None or (now - claimed_at).total_seconds() >= Config.ENRICHMENT_DEADLINE_SECONDS:
+        return False
+    try:
+        os.kill(int(enrichment.get("claimedBy")), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # exists, owned by another user
+    except (TypeError, ValueError, OSError):
+        return False
+    return True
+
+
+def recover_pending_enrichments() -> Dict[str, int]:
+    """
+    Enrichment jobs live only in the worker's executor: after a restart, deploy or timeout
+    kill their entries would stay enrichmentPending forever. Runs in every worker at startup,
+    so each entry is resolved in one transaction: entries whose claim is still live (job
+    running in another worker) are skipped, ones created within ENRICHMENT_DEADLINE_SECONDS
+    are claimed by this worker and re-enqueued, older ones are marked failed so /history
+    shows them resolved.
+    """
+    counts = {"requeued": 0, "expired": 0, "skipped": 0}
+    now = datetime.utcnow()
+    for patient_id, day, entry in daily_log_db.pending_enrichments():
+        outcome = {"action": "skipped"}
+
+        def resolve(entry: Dict[str, Any]) -> Dict[str, Any]:
+            outcome["action"] = "skipped"
+            if not entry.get("enrichmentPending") or _claim_is_live(entry.get("enrichment"), now):
+                return entry
+            created_at = _parse_utc(entry.get("createdAt"))
+            if created_at is not None and (now - created_at).total_seconds() < Config.ENRICHMENT_DEADLINE_SECONDS:
+                entry["enrichment"] = _enrichment_claim()
+                outcome["action"] = "requeued"
+            else:
+                entry["enrichmentPending"] = False
+                entry["enrichment"] = {
+                    "status": "failed",
+                    "error": "enrichment interrupted (worker restarted)",
+                    "completedAt": now_utc(),
+                }
+                outcome["action"] = "expired"
+            return entry
+
+        claimed = daily_log_db.update_entry(patient_id, day, entry.get("entryId"), resolve, return_log=False)
+        if claimed is None:  # deleted meanwhile
+            outcome["action"] = "skipped"
+        elif outcome["action"] == "requeued":
+            schedule_enrichment(
+                patient_id, day, claimed.get("entryId"), claimed.get("text") or "", claimed.get("foods") or []
+            )
+        counts[outcome["action"]] += 1
+    return counts
+
+
 # ----------------------------
 # Routes
 # ----------------------------
@@ -283,8 +450,31 @@ def health():
     return {"message": "Nutrition Chat API", "status": "running"}
 
 
+@app.get("/metrics")
+def metrics():
+    cache = pipeline.extractor.cache
+    response_cache = pipeline.deepseek_client.response_cache
+    batcher = pipeline.deepseek_client.batcher
+    return {
+        "success": True,
+        "data": {
+            "datasetVersion": get_dataset_version(),
+            "extractCache": cache.stats() if cache is not None else None,
+            "threadPools": pool_stats(),
+            "deepseekCache": response_cache.stats() if response_cache is not None else None,
+            "deepseekInflight": {"sync": deepseek_inflight.stats(), "async": deepseek_ainflight.stats()},
+            "deepseekBatcher": batcher.stats() if batcher is not None else None,
+            "deepseekBreaker": deepseek_breaker.stats(),
+            "llmAdmission": limiter_stats(),
+            "sqliteConnections": connection_stats(),
+            "knownPatients": daily_log_db.known_patients.stats() if daily_log_db.known_patients else None,
+        },
+    }
+
+
 @app.post("/analyze")
-async def analyze(request: AnalyzeRequest):
+@offload("pipeline")
+def analyze(request: AnalyzeRequest):
     return _run_analyze(
         request.patientId,
         request.userId,
@@ -295,7 +485,8 @@ async def analyze(request: AnalyzeRequest):
 
 
 @app.post("/analyze-with-date")
-async def analyze_with_date(request: AnalyzeWithDateRequest):
+@offload("pipeline")
+def analyze_with_date(request: AnalyzeWithDateRequest):
     return _run_analyze(
         request.patientId,
         request.userId,
@@ -305,27 +496,40 @@ async def analyze_with_date(request: AnalyzeWithDateRequest):
     )
 
 
+@app.post("/analyze-stream")
+async def analyze_stream(request: AnalyzeRequest):
+    """
+    Same as /analyze, streamed as NDJSON: one {"type": "food", "source", "food"} line per food
+    as soon as it is known (DeepSeek foods as their JSON object completes), then one
+    {"type": "done", ...} line carrying the full /analyze response. Always waits for DeepSeek.
+    """
+    invalid = _validate_analyze(request.patientId, request.dateKey)
+    if invalid:
+        return invalid
+
+    def events():
+        deadline = Deadline(Config.ANALYZE_DEADLINE_SECONDS)
+        for event in pipeline.process_input_stream(request.text, deadline):
+            if event["type"] == "food":
+                food = to_spec_foods([event["food"]])[0]
+                food.pop("foodId")  # tmp ids follow the final order, see the done line
+                event = {"type": "food", "source": event["source"], "food": food}
+            else:
+                response = _save_analysis(
+                    request.patientId, request.userId, request.text, request.dateKey, event["result"]
+                )
+                event = {"type": "done", **response}
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(iterate_blocking(events(), pool="pipeline"), media_type="application/x-ndjson")
+
+
 @app.post("/update-quantity")
-async def update_quantity(request: UpdateQuantityRequest):
+@offload("db")
+def update_quantity(request: UpdateQuantityRequest):
     if not request.patientId:
         return error_response("VALIDATION_ERROR", "patientId is required")
 
-    log = daily_log_db.get_daily_log(request.patientId, request.dateKey)
-    if not log:
-        return error_response("NOT_FOUND", "No records found for this date")
-
-    target_entry_id: Optional[str] = None
-    for entry in reversed(log.get("entries", [])):
-        for food in entry.get("foods", []):
-            if str(food.get("foodName", "")).lower() == request.foodName.lower():
-                target_entry_id = entry.get("entryId")
-                break
-        if target_entry_id:
-            break
-
-    if not target_entry_id:
-        return error_response("NOT_FOUND", "Food not found for this patient/date")
-
     saved_unit = request.newUnit
 
     def updater(entry: Dict[str, Any]) -> Dict[str, Any]:
@@ -343,13 +547,20 @@ async def update_quantity(request: UpdateQuantityRequest):
         entry["mealSummary"] = calc_meal_summary_from_foods(entry.get("foods", []))
         return entry
 
-    updated_log = daily_log_db.update_entry(
-        request.patientId, request.dateKey, target_entry_id, updater
-    )
-    if not updated_log:
-        return error_response("NOT_FOUND", "Entry not found")
+    def work(unit: DayUnitOfWork) -> Tuple[Optional[str], Dict[str, Any]]:
+        # Tìm entry và sửa trong cùng một transaction: không ghi đè thay đổi xen giữa
+        if not unit.exists:
+            return "No records found for this date", {}
+        for entry in reversed(unit.entries()):
+            if any(str(food.get("foodName", "")).lower() == request.foodName.lower()
+                   for food in entry.get("foods", [])):
+                return None, unit.update(entry.get("entryId"), updater) or {}
+        return "Food not found for this patient/date", {}
+
+    missing, updated_entry = daily_log_db.unit_of_work(request.patientId, request.dateKey, work)
+    if missing:
+        return error_response("NOT_FOUND", missing)
 
-    updated_entry = get_entry_by_id(updated_log, target_entry_id) or {}
     for food in updated_entry.get("foods", []):
         if str(food.get("foodName", "")).lower() == request.foodName.lower():
             saved_unit = food.get("quantityInfo", {}).get("unit", saved_unit)
@@ -368,7 +579,8 @@ async def update_quantity(request: UpdateQuantityRequest):
 
 
 @app.post("/update-food")
-async def update_food(request: UpdateFoodRequest):
+@offload("db")
+def update_food(request: UpdateFoodRequest):
     if not request.patientId:
         return error_response("VALIDATION_ERROR", "patientId is required")
 
@@ -402,10 +614,10 @@ async def update_food(request: UpdateFoodRequest):
         entry["updatedAt"] = updated_at
         return entry
 
-    updated_log = daily_log_db.update_entry(
-        request.patientId, day, request.entryId, updater
+    updated_entry = daily_log_db.update_entry(
+        request.patientId, day, request.entryId, updater, return_log=False
     )
-    if not updated_log or not changed["ok"]:
+    if updated_entry is None or not changed["ok"]:
         return error_response("NOT_FOUND", "Food not found in entry")
 
     return {
@@ -420,7 +632,8 @@ async def update_food(request: UpdateFoodRequest):
 
 
 @app.post("/delete-food")
-async def delete_food(request: DeleteFoodRequest):
+@offload("db")
+def delete_food(request: DeleteFoodRequest):
     if not request.patientId:
         return error_response("VALIDATION_ERROR", "patientId is required")
 
@@ -443,14 +656,12 @@ async def delete_food(request: DeleteFoodRequest):
             entry["updatedAt"] = updated_at
         return entry
 
-    updated_log = daily_log_db.update_entry(
-        request.patientId, day, request.entryId, updater
+    updated_entry = daily_log_db.update_entry(
+        request.patientId, day, request.entryId, updater, return_log=False
     )
-    if not updated_log or not removed["ok"]:
+    if updated_entry is None or not removed["ok"]:
         return error_response("NOT_FOUND", "Food not found in entry")
 
-    updated_entry = get_entry_by_id(updated_log, request.entryId) or {}
-
     return {
         "success": True,
         "data": {
@@ -463,7 +674,8 @@ async def delete_food(request: DeleteFoodRequest):
 
 
 @app.post("/confirm-meal")
-async def confirm_meal(request: ConfirmMealRequest):
+@offload("db")
+def confirm_meal(request: ConfirmMealRequest):
     if not request.patientId:
         return error_response("VALIDATION_ERROR", "patientId is required")
 
@@ -487,10 +699,10 @@ async def confirm_meal(request: ConfirmMealRequest):
         entry["updatedAt"] = now_utc()
         return entry
 
-    updated_log = daily_log_db.update_entry(
-        request.patientId, day, request.entryId, updater
+    updated_entry = daily_log_db.update_entry(
+        request.patientId, day, request.entryId, updater, return_log=False
     )
-    if not updated_log:
+    if updated_entry is None:
         return error_response("NOT_FOUND", "Entry not found for patient")
 
     return {
@@ -505,7 +717,8 @@ async def confirm_meal(request: ConfirmMealRequest):
 
 
 @app.get("/history")
-async def history(
+@offload("db")
+def history(
     patientId: str = Query(..., description="Patient id"),
     from_date: Optional[str] = Query(None, alias="from"),
     to_date: Optional[str] = Query(None, alias="to"),
@@ -526,7 +739,8 @@ async def list_foods(
     query = (q or "").strip().lower()
 
     foods = []
-    for food_name, data in VIETNAMESE_FOODS_NUTRITION.items():
+    # list(): approvals may add foods while this request iterates.
+    for food_name, data in list(VIETNAMESE_FOODS_NUTRITION.items()):
         if query and query not in str(food_name).lower():
             continue
         data = data or {}
@@ -564,7 +778,8 @@ async def list_foods(
 
 
 @app.get("/admin/pending-foods")
-async def admin_pending_foods(
+@offload("db")
+def admin_pending_foods(
     status: str = Query("pending", description="pending|approved|rejected"),
     action: Optional[str] = Query(None, description="alias|new_food"),
     q: Optional[str] = Query(None, description="Search raw/canonical names"),
@@ -582,7 +797,8 @@ async def admin_pending_foods(
 
 
 @app.post("/admin/review-pending-food")
-async def admin_review_pending_food(request: ReviewPendingFoodRequest):
+@offload("db")
+def admin_review_pending_food(request: ReviewPendingFoodRequest):
     decision = (request.decision or "").strip().lower()
     if decision not in {"approve", "reject"}:
         return error_response("VALIDATION_ERROR", "decision must be approve|reject")
@@ -613,15 +829,22 @@ async def admin_review_pending_food(request: ReviewPendingFoodRequest):
     if not approved:
         return error_response("NOT_FOUND", "Pending food not found")
 
-    # Refresh in-memory dataset & matcher so approval takes effect without restart.
-    load_learned_foods(force=True)
-    pipeline.extractor.matcher.build_index()
+    # Apply only this approval to the in-memory dataset & matcher (no full reload/rebuild),
+    # so it takes effect without restart and /analyze keeps using a complete index.
+    canonical = (request.canonicalName or pending.get("canonicalName") or "").strip()
+    raw_name = (pending.get("rawName") or "").strip()
+    pipeline.extractor.matcher.learn(
+        canonical,
+        pipeline.learning_db.get_learned_food(canonical),
+        aliases=[raw_name] if raw_name else [],
+    )
 
     return {"success": True, "data": {"pending": approved}}
 
 
 @app.get("/analytics/food-trends")
-async def analytics_food_trends(
+@offload("db")
+def analytics_food_trends(
     from_date: Optional[str] = Query(None, alias="from"),
     to_date: Optional[str] = Query(None, alias="to"),
     limit: int = Query(20, ge=1, le=200),
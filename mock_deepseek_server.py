@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Mock DeepSeek /chat/completions server (HTTP/1.1 keep-alive) cho test và benchmark.
+
+Chạy:  python mock_deepseek_server.py [port] [delay_seconds] [seconds_per_completion_token]
+Sau đó đặt DEEPSEEK_BASE_URL=http://127.0.0.1:<port> và DEEPSEEK_API_KEY=bất kỳ.
+
+Câu trả lời là JSON hợp lệ theo prompt: mỗi đoạn cách nhau bởi dấu phẩy/"và" thành
+một món; payload batch ({"items": [...]}) nhận lại món theo từng id; payload của /match
+(có "A") nhận lại matches rỗng. Trường "usage" ước lượng
+số token (~4 byte UTF-8 / token) và được cộng dồn vào prompt_tokens/completion_tokens.
+
+Request có "stream": true nhận server-sent events (chunked) như API thật: mỗi event một
+mảnh content ~stream_chunk_chars ký tự trong choices[0].delta, token_delay tính theo mảnh,
+cuối cùng "data: [DONE]".
+
+Giả lập sự cố: server.inject(503, 2.5, "drop") -> request kế tiếp nhận HTTP 503, request
+sau chờ thêm 2.5 giây, request sau nữa bị đóng kết nối không trả lời. "omit" bỏ item cuối
+của câu trả lời batch, "truncate" cắt đôi content (như bị chặn ở max_tokens).
+"""
+import json
+import re
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+
+_SPLIT_RE = re.compile(r"\s*(?:,|\bvà\b|\bvới\b)\s*")
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough BPE token count (no tokenizer dependency)."""
+    return (len(text.encode("utf-8")) + 3) // 4
+
+
+def fake_content(user_content: str) -> Dict[str, Any]:
+    """Deterministic answer for a user message."""
+    try:
+        payload = json.loads(user_content)
+    except (TypeError, ValueError):
+        payload = None
+    if isinstance(payload, dict) and "A" in payload:
+        return {"lab_items": [], "matches": [], "records_template": []}
+    if isinstance(payload, dict) and isinstance(payload.get("items"), list):
+        return {"items": [{"id": item.get("id"), "foods": fake_foods(item.get("text", ""))}
+                          for item in payload["items"]]}
+    return {"foods": fake_foods(user_content), "analysis": "mock", "suggestions": []}
+
+
+def fake_foods(text: str) -> List[Dict[str, Any]]:
+    foods = []
+    for part in filter(None, _SPLIT_RE.split(text.strip())):
+        foods.append({
+            "food_name": part,
+            "canonicalName": part,
+            "alias": part,
+            "aliases": [],
+            "category": "custom",
+            "quantity": {"amount": 1, "unit": "phần", "confidence": 0.6},
+            "confidence": 0.7,
+            "nutrition_hint": {"calories_per_100g": 150, "carbs_per_100g": 20, "sugar_per_100g": 2,
+                               "protein_per_100g": 6, "fat_per_100g": 5, "fiber_per_100g": 1},
+        })
+    return foods
+
+
+class MockDeepSeekServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int] = ("127.0.0.1", 0), delay: float = 0.0, token_delay: float = 0.0):
+        super().__init__(address, _Handler)
+        self.delay = delay
+        # Thời gian sinh mỗi token output (câu trả lời dài hơn -> chậm hơn, như model thật)
+        self.token_delay = token_delay
+        self.stream_chunk_chars = 12
+        self.requests = 0
+        self.connections = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self._faults: Deque[Union[int, float, str]] = deque()
+        self._counter_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, field: str, amount: int = 1) -> None:
+        with self._counter_lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+    def inject(self, *faults: Union[int, float, str]) -> None:
+        """Queue faults for the next requests: HTTP status (int), extra delay (float), "drop", "omit" or "truncate"."""
+        with self._counter_lock:
+            self._faults.extend(faults)
+
+    def next_fault(self) -> Optional[Union[int, float, str]]:
+        with self._counter_lock:
+            return self._faults.popleft() if self._faults else None
+
+    def handle_error(self, request, client_address):
+        pass  # client gave up (timeout) before the delayed answer: broken pipe is expected
+
+    def start(self) -> "MockDeepSeekServer":
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+    def setup(self):
+        super().setup()
+        self.server.count("connections")
+
+    def log_message(self, format, *args):  # noqa: A002 - silence per-request logs
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"{}")
+        self.server.count("requests")
+        fault = self.server.next_fault()
+        if fault == "drop":
+            self.close_connection = True
+            return
+        if isinstance(fault, int):
+            data = json.dumps({"error": {"message": f"injected {fault}"}}).encode("utf-8")
+            self.send_response(fault)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        if isinstance(fault, float):
+            time.sleep(fault)
+
+        messages = body.get("messages") or [{}]
+        answer = fake_content(messages[-1].get("content", ""))
+        if fault == "omit" and "items" in answer:
+            answer["items"] = answer["items"][:-1]
+        content = json.dumps(answer, ensure_ascii=False)
+        if fault == "truncate":
+            content = content[: len(content) // 2]
+        usage = {
+            "prompt_tokens": sum(estimate_tokens(m.get("content", "")) for m in messages),
+            "completion_tokens": estimate_tokens(content),
+        }
+        self.server.count("prompt_tokens", usage["prompt_tokens"])
+        self.server.count("completion_tokens", usage["completion_tokens"])
+        if body.get("stream"):
+            self._send_stream(content, usage, body.get("model"))
+            return
+        delay = self.server.delay + self.server.token_delay * usage["completion_tokens"]
+        if delay:
+            time.sleep(delay)
+        data = json.dumps({
+            "id": "mock",
+            "object": "chat.completion",
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                         "finish_reason": "stop"}],
+            "usage": usage,
+        }, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def _send_stream(self, content: str, usage: Dict[str, int], model: Optional[str]) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        size = self.server.stream_chunk_chars
+        for start in range(0, len(content), size):
+            piece = content[start:start + size]
+            if self.server.token_delay:
+                time.sleep(self.server.token_delay * estimate_tokens(piece))
+            self._write_event({"id": "mock", "object": "chat.completion.chunk", "model": model,
+                               "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]})
+        self._write_event({"id": "mock", "object": "chat.completion.chunk", "model": model,
+                           "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage})
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_event(self, event: Dict[str, Any]) -> None:
+        self._write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8088
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    token_delay = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    server = MockDeepSeekServer(("127.0.0.1", port), delay=delay, token_delay=token_delay)
+    print(f"Mock DeepSeek listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -1,13 +1,13 @@
 import re
 import json
-import time
-import sqlite3
+import threading
 from datetime import datetime
-from typing import Dict, List, Any, Optional, Tuple
+from typing import Dict, Iterator, List, Any, Optional, Tuple
 from collections import deque
 from config import Config
 from deepseek_client import DeepSeekClient
-from dbs import FoodLearningDB, DB_PATH
+from resilience import Deadline
+from dbs import FoodLearningDB, DB_PATH, get_connection
 
 # Import các class và functions từ chính module này
 try:
@@ -18,6 +18,7 @@ try:
         QuantityParser,
         FoodExtractor,
         estimate_weight,
+        estimate_weight_range,
         calculate_nutrition
     )
 except ImportError:
@@ -143,8 +144,13 @@ class ConversationMemory:
 class NutritionPipelineAdvanced:
     """Pipeline xử lý dinh dưỡng nâng cao"""
     
-    def __init__(self):
-        self.extractor = FoodExtractor()
+    def __init__(self, extraction_mode: Optional[str] = None, deterministic_weight: Optional[bool] = None):
+        self.extractor = FoodExtractor(
+            mode=extraction_mode or Config.EXTRACTION_MODE,
+            cache_size=Config.EXTRACT_CACHE_SIZE,
+        )
+        # None = theo Config.DETERMINISTIC_WEIGHT
+        self.deterministic_weight = deterministic_weight
         self.deepseek_client = DeepSeekClient()
         self.learning_db = FoodLearningDB()
         self.memory = ConversationMemory(max_messages=3)
@@ -156,6 +162,7 @@ class NutritionPipelineAdvanced:
             'fat': 0,
             'fiber': 0
         }
+        self._totals_lock = threading.Lock()
         # Lưu/persist tổng ngày để không mất khi restart
         self.daily_date = datetime.now().date().isoformat()
         self._ensure_daily_totals_table()
@@ -165,76 +172,218 @@ class NutritionPipelineAdvanced:
             self.confidence_threshold = float(getattr(Config, "MIN_CONFIDENCE_FOR_API", 0.6) or 0.6)
         except Exception:
             self.confidence_threshold = 0.6
-        # Cache ngắn để đảm bảo mỗi input chỉ gọi DeepSeek 1 lần trong cửa sổ TTL
-        self.deepseek_cache_ttl = getattr(Config, "DEEPSEEK_CACHE_TTL_SECONDS", 5)
-        self._deepseek_cache: Dict[str, Any] = {"key": None, "ts": 0.0, "result": None}
+        # Dưới ngưỡng vẫn coi là chắc chắn nếu top-1 bỏ xa phương án kế tiếp (<= 0 để tắt)
+        try:
+            self.candidate_margin = float(getattr(Config, "CANDIDATE_MARGIN", 0.2) or 0.0)
+        except Exception:
+            self.candidate_margin = 0.2
+        # "segment" (mặc định) hoặc "sentence", xem Config.LLM_FALLBACK_SCOPE
+        self.llm_fallback_scope = str(getattr(Config, "LLM_FALLBACK_SCOPE", "segment") or "segment").lower()
     
-    def process_input(self, user_input: str) -> Dict[str, Any]:
-        """Xử lý input chính"""
-        extracted_foods = self.extractor.extract(user_input)
-
-        analyzed_foods = []
-        for food_info in extracted_foods:
-            analysis = self._analyze_food(food_info)
-            if analysis:
-                analyzed_foods.append(analysis)
-
-        use_deepseek, trigger_reason = self._should_use_deepseek(
-            extracted_foods, analyzed_foods
-        )
-        deepseek_result = {
-            'deepseek_used': use_deepseek,
-            'deepseek_available': self.deepseek_client.is_available(),
-            'deepseek_success': False,
-            'deepseek_trigger': trigger_reason,
-            'deepseek_error': None,
-            'deepseek_analysis': None,
-            'deepseek_suggestions': []
-        }
+    def process_input(self, user_input: str, defer_llm: bool = False) -> Dict[str, Any]:
+        """
+        Xử lý input chính.
+        defer_llm=True: không chờ DeepSeek, trả kết quả local với enrichment_pending=True
+        (gọi analyze_text(user_input) sau, ở background, để lấy kết quả đầy đủ).
+        """
+        result = self.analyze_text(user_input, defer_llm=defer_llm)
+        return self._record_result(user_input, result)
+
+    def process_input_stream(
+        self, user_input: str, deadline: Optional[Deadline] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """process_input theo từng món (xem analyze_text_stream); event "done" mang kết quả đầy đủ."""
+        for event in self.analyze_text_stream(user_input, deadline):
+            if event["type"] == "done":
+                event["result"] = self._record_result(user_input, event["result"])
+            yield event
+
+    def _record_result(self, user_input: str, result: Dict[str, Any]) -> Dict[str, Any]:
+        """Ghi kết quả vào memory/tổng ngày và tạo câu trả lời."""
+        self.memory.add_message(user_input, result)
+        
+        self._update_daily_totals(result['meal_summary'])
+        
+        result['memory_summary'] = self.memory.get_summary()
+        result['daily_totals'] = self.daily_totals.copy()
+        
+        response = self._generate_response(result)
+        
+        result['response'] = response
+        
+        return result
+
+    def analyze_text(self, user_input: str, defer_llm: bool = False) -> Dict[str, Any]:
+        """Tách món + DeepSeek fallback, không ghi vào memory/tổng ngày của pipeline."""
+        plan = self._plan_analysis(user_input)
+        analyzed_foods = plan['analyzed_foods']
         processing_method = "local"
 
-        if use_deepseek:
-            ds_output = self._analyze_with_deepseek(user_input)
-            deepseek_result.update({
-                'deepseek_success': ds_output.get('success', False),
-                'deepseek_error': ds_output.get('error'),
-                'deepseek_analysis': ds_output.get('analysis'),
-                'deepseek_suggestions': ds_output.get('suggestions', []),
-                'deepseek_raw': ds_output.get('raw_content', "")
-            })
+        if plan['use_deepseek'] and defer_llm:
+            plan['deepseek_result'].update({'deepseek_used': False, 'enrichment_pending': True})
+        elif plan['use_deepseek']:
+            unresolved, deepseek_input = self._deepseek_target(plan, user_input)
+            if plan['segment_scope'] and self.deepseek_client.batcher is not None:
+                # Mỗi đoạn (hoặc cả câu) là một item riêng, gom chung batch với các request khác
+                segments = plan['segments']
+                texts = [segments[i]['text'] for i in unresolved] if unresolved is not None else [user_input]
+                ds_output = self._analyze_segments_with_deepseek(texts, example_input=user_input)
+            else:
+                ds_output = self._analyze_with_deepseek(deepseek_input, example_input=user_input)
+            analyzed_foods, processing_method = self._apply_deepseek_output(
+                plan, unresolved, deepseek_input, ds_output
+            )
 
-            if ds_output.get('success'):
-                analyzed_foods = ds_output.get('foods', analyzed_foods)
-                processing_method = "deepseek"
+        return self._build_analysis_result(user_input, plan, analyzed_foods, processing_method)
 
-        is_update = self._check_if_update(analyzed_foods)
-        meal_summary = self._calculate_meal_summary(analyzed_foods)
+    def analyze_text_stream(
+        self, user_input: str, deadline: Optional[Deadline] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Như analyze_text nhưng là generator: yield {"type": "food", "source": "local"|"deepseek",
+        "food": ...} ngay khi có từng món (món DeepSeek khi object JSON của nó vừa đóng),
+        cuối cùng {"type": "done", "result": <cùng format analyze_text>}.
+        Món local chỉ ra trước khi chắc chắn được giữ; còn lại ra sau nếu DeepSeek không thay.
+        """
+        plan = self._plan_analysis(user_input)
+        analyzed_foods = plan['analyzed_foods']
+        processing_method = "local"
+        emitted = set()
+
+        if plan['use_deepseek']:
+            unresolved, deepseek_input = self._deepseek_target(plan, user_input)
+            if unresolved is not None:
+                for i, analysis in enumerate(plan['analyses']):
+                    if analysis and i not in unresolved:
+                        emitted.add(id(analysis))
+                        yield {"type": "food", "source": "local", "food": analysis}
+
+            streamed: List[Dict] = []
+            stream = self.deepseek_client.analyze_stream(deepseek_input, deadline)
+            while True:
+                try:
+                    raw_food = next(stream)
+                except StopIteration as stop:
+                    ds_raw = stop.value
+                    break
+                for food in self._normalize_deepseek_foods([raw_food]):
+                    streamed.append(food)
+                    emitted.add(id(food))
+                    yield {"type": "food", "source": "deepseek", "food": food}
+            ds_output = self._deepseek_output(ds_raw, user_input, foods=streamed)
+            analyzed_foods, processing_method = self._apply_deepseek_output(
+                plan, unresolved, deepseek_input, ds_output
+            )
 
-        result = {
+        for food in analyzed_foods:
+            if id(food) not in emitted:
+                yield {"type": "food", "source": "local", "food": food}
+        yield {"type": "done", "result": self._build_analysis_result(
+            user_input, plan, analyzed_foods, processing_method
+        )}
+
+    def _plan_analysis(self, user_input: str) -> Dict[str, Any]:
+        """Phần local của analyze_text: tách đoạn, phân tích từng đoạn, quyết định gọi DeepSeek."""
+        segments = self.extractor.extract_segments(user_input)
+        extracted_foods = [seg['food'] for seg in segments if seg['food'] is not None]
+
+        # Giữ phân tích theo đúng vị trí đoạn (None = đoạn không match được món)
+        analyses = [
+            self._analyze_food(seg['food']) if seg['food'] is not None else None
+            for seg in segments
+        ]
+        analyzed_foods = [analysis for analysis in analyses if analysis]
+
+        segment_scope = self.llm_fallback_scope == "segment"
+        # Đoạn không match được món chỉ được gửi kèm khi đã có trigger (low_confidence/no_foods):
+        # câu có đoạn không phải món ("ngon lắm", "rồi đi làm") vẫn trả lời local
+        use_deepseek, trigger_reason = self._should_use_deepseek(extracted_foods, analyzed_foods)
+        if use_deepseek and self.deepseek_client.breaker.is_open():
+            # DeepSeek đang lỗi liên tục: trả kết quả local ngay, không chờ timeout
+            use_deepseek, trigger_reason = False, "circuit_open"
+        return {
+            'segments': segments,
+            'extracted_foods': extracted_foods,
+            'analyses': analyses,
+            'analyzed_foods': analyzed_foods,
+            'segment_scope': segment_scope,
+            'use_deepseek': use_deepseek,
+            'deepseek_result': {
+                'deepseek_used': use_deepseek,
+                'deepseek_available': self.deepseek_client.is_available(),
+                'deepseek_success': False,
+                'deepseek_trigger': trigger_reason,
+                'deepseek_input': None,
+                'deepseek_error': None,
+                'deepseek_analysis': None,
+                'deepseek_suggestions': [],
+                'enrichment_pending': False
+            },
+        }
+
+    def _deepseek_target(self, plan: Dict[str, Any], user_input: str) -> Tuple[Optional[List[int]], str]:
+        """(chỉ số các đoạn gửi DeepSeek hoặc None = cả câu, nội dung gửi đi)."""
+        analyses = plan['analyses']
+        # Không có món local nào để giữ -> gửi cả câu như chế độ "sentence"
+        if not (plan['segment_scope'] and plan['analyzed_foods']):
+            return None, user_input
+        unresolved = [
+            i for i, analysis in enumerate(analyses)
+            if analysis is None or not self._is_confident(analysis)[0]
+        ]
+        return unresolved, ", ".join(plan['segments'][i]['text'] for i in unresolved)
+
+    def _apply_deepseek_output(
+        self,
+        plan: Dict[str, Any],
+        unresolved: Optional[List[int]],
+        deepseek_input: str,
+        ds_output: Dict[str, Any]
+    ) -> Tuple[List[Dict], str]:
+        """Ghi thông tin DeepSeek vào plan, trả về (món cuối cùng, processing_method)."""
+        deepseek_result = plan['deepseek_result']
+        if ds_output.get('overloaded'):
+            # Hết hạn mức gọi LLM: giữ kết quả local như khi breaker mở
+            deepseek_result.update({'deepseek_used': False, 'deepseek_trigger': "overloaded"})
+        deepseek_result.update({
+            'deepseek_success': ds_output.get('success', False),
+            'deepseek_input': deepseek_input,
+            'deepseek_error': ds_output.get('error'),
+            'deepseek_analysis': ds_output.get('analysis'),
+            'deepseek_suggestions': ds_output.get('suggestions', []),
+            'deepseek_raw': ds_output.get('raw_content', "")
+        })
+
+        if not ds_output.get('success'):
+            return plan['analyzed_foods'], "local"
+        if unresolved is None:
+            return ds_output.get('foods', plan['analyzed_foods']), "deepseek"
+        if 'segment_foods' in ds_output:
+            assigned = dict(zip(unresolved, ds_output['segment_foods']))
+        else:
+            assigned = self._assign_to_segments(plan['segments'], unresolved, ds_output.get('foods', []))
+        analyzed_foods, kept_local = self._merge_segment_foods(plan['analyses'], assigned)
+        return analyzed_foods, "hybrid" if kept_local else "deepseek"
+
+    def _build_analysis_result(
+        self,
+        user_input: str,
+        plan: Dict[str, Any],
+        analyzed_foods: List[Dict],
+        processing_method: str
+    ) -> Dict[str, Any]:
+        return {
             'timestamp': datetime.now().isoformat(),
             'user_input': user_input,
             'foods': analyzed_foods,
-            'meal_summary': meal_summary,
-            'is_update': is_update,
-            'extracted_count': len(extracted_foods),
+            'meal_summary': self._calculate_meal_summary(analyzed_foods),
+            'is_update': self._check_if_update(analyzed_foods),
+            'extracted_count': len(plan['extracted_foods']),
             'analyzed_count': len(analyzed_foods),
             'processing_method': processing_method,
-            **deepseek_result
+            **plan['deepseek_result']
         }
 
-        self.memory.add_message(user_input, result)
-        
-        self._update_daily_totals(meal_summary)
-        
-        result['memory_summary'] = self.memory.get_summary()
-        result['daily_totals'] = self.daily_totals.copy()
-        
-        response = self._generate_response(result)
-        
-        result['response'] = response
-        
-        return result
-    
     def _analyze_food(self, food_info: Dict) -> Optional[Dict]:
         """Phân tích chi tiết một món ăn"""
         food_name = food_info['food_name']
@@ -250,7 +399,8 @@ class NutritionPipelineAdvanced:
             return None
         
         # Ước lượng trọng lượng
-        weight = estimate_weight(quantity_info, food_data.get('category'))
+        weight = estimate_weight(quantity_info, food_data.get('category'), self.deterministic_weight)
+        weight_range = estimate_weight_range(quantity_info, food_data.get('category'))
         
         # Tính dinh dưỡng
         nutrition = calculate_nutrition(food_name, weight) or {}
@@ -262,13 +412,46 @@ class NutritionPipelineAdvanced:
             'original_text': food_info['original_text'],
             'quantity_info': quantity_info,
             'estimated_weight_g': weight,
+            'estimated_weight_range_g': weight_range,
             'nutrition': nutrition,
             'category': food_data.get('category'),
             'confidence': combined_confidence,
             'match_confidence': match_confidence,
+            'match_candidates': food_info.get('match_candidates', []),
+            'extracted_food_text': food_info.get('extracted_food_text'),
             'no_sugar': no_sugar
         }
 
+    def _has_clear_margin(self, food: Dict) -> bool:
+        """
+        Top-1 candidate is far enough ahead of the runner-up and explains the whole
+        food text (only filler words left over). Keyword fallbacks never qualify.
+        """
+        candidates = food.get('match_candidates') or []
+        if self.candidate_margin <= 0 or not candidates:
+            return False
+        top = candidates[0]
+        if top.get('provenance') == 'keyword' or top.get('food_name') != food.get('food_name'):
+            return False
+        runner_up = candidates[1]['confidence'] if len(candidates) > 1 else 0.0
+        if top['confidence'] - runner_up < self.candidate_margin:
+            return False
+        food_text = food.get('extracted_food_text') or ""
+        return not self.extractor.unexplained_tokens(food_text, top.get('matched_text'))
+
+    def _is_confident(self, food: Dict) -> Tuple[bool, bool]:
+        """(đủ tin cậy để xử lý local, nhờ margin chứ không nhờ ngưỡng)."""
+        # Dùng độ tin cậy match (không nhân với quantity để tránh tụt quá thấp)
+        try:
+            conf = float(food.get('match_confidence', food.get('confidence', 0)) or 0)
+        except Exception:
+            conf = 0.0
+        if conf >= self.confidence_threshold:
+            return True, False
+        if self._has_clear_margin(food):
+            return True, True
+        return False, False
+
     def _should_use_deepseek(
         self,
         extracted_foods: List[Dict],
@@ -281,52 +464,100 @@ class NutritionPipelineAdvanced:
         if not extracted_foods or not analyzed_foods:
             return True, "no_foods_detected"
 
-        # Dùng độ tin cậy match (không nhân với quantity để tránh tụt quá thấp)
-        confidences: List[float] = []
+        clear_margin = False
         for food in analyzed_foods:
-            try:
-                conf = float(food.get('match_confidence', food.get('confidence', 0)) or 0)
-            except Exception:
-                conf = 0.0
-            confidences.append(conf)
-
-        if confidences and min(confidences) < self.confidence_threshold:
-            return True, "low_confidence"
+            confident, via_margin = self._is_confident(food)
+            if not confident:
+                return True, "low_confidence"
+            clear_margin = clear_margin or via_margin
 
+        if clear_margin:
+            return False, "clear_margin"
         return False, "confidence_ok"
 
-    def _analyze_with_deepseek(self, user_input: str) -> Dict[str, Any]:
-        """Gọi DeepSeek và chuẩn hóa kết quả về cấu trúc nội bộ."""
-        cache_key = f"{self.deepseek_client.model}:{user_input.strip()}"
-        now = time.time()
-        if (
-            self._deepseek_cache.get("key") == cache_key
-            and now - float(self._deepseek_cache.get("ts", 0)) <= float(self.deepseek_cache_ttl or 0)
-            and self._deepseek_cache.get("result") is not None
-        ):
-            cached = self._deepseek_cache["result"]
-            return dict(cached)
-
+    def _assign_to_segments(
+        self,
+        segments: List[Dict],
+        unresolved: List[int],
+        llm_foods: List[Dict]
+    ) -> Dict[int, List[Dict]]:
+        """
+        Gán món DeepSeek (trả về cho các đoạn đã nối lại) vào đúng đoạn chưa chắc chắn:
+        theo từ trùng với đoạn, không có thì theo thứ tự nhắc tới.
+        """
+        normalize = self.extractor.matcher.normalize_text
+        segment_tokens = [set(normalize(segments[i]['text']).split()) for i in unresolved]
+        assigned: Dict[int, List[Dict]] = {i: [] for i in unresolved}
+        cursor = 0
+        for food in llm_foods:
+            food_tokens = set(normalize(
+                f"{food.get('original_text') or ''} {food.get('food_name') or ''}"
+            ).split())
+            scores = [len(food_tokens & tokens) for tokens in segment_tokens]
+            best = max(range(len(unresolved)), key=lambda k: (scores[k], k >= cursor, -k))
+            if scores[best] == 0:
+                best = cursor
+            assigned[unresolved[best]].append(food)
+            cursor = best
+        return assigned
+
+    def _merge_segment_foods(
+        self,
+        analyses: List[Optional[Dict]],
+        assigned: Dict[int, List[Dict]]
+    ) -> Tuple[List[Dict], int]:
+        """
+        Ghép món theo thứ tự câu: đoạn có món DeepSeek dùng món đó, đoạn còn lại (hoặc
+        DeepSeek không trả món nào) giữ kết quả local. Trả về (món, số món local được giữ).
+        """
+        merged: List[Dict] = []
+        kept_local = 0
+        for i, analysis in enumerate(analyses):
+            if assigned.get(i):
+                merged.extend(assigned[i])
+            elif analysis:
+                merged.append(analysis)
+                kept_local += 1
+        return merged, kept_local
+
+    def _analyze_segments_with_deepseek(self, texts: List[str], example_input: str) -> Dict[str, Any]:
+        """Như _analyze_with_deepseek nhưng mỗi đoạn một item (segment_foods cùng thứ tự texts)."""
         try:
-            ds_raw = self.deepseek_client.analyze(user_input)
-            foods = self._normalize_deepseek_foods(ds_raw.get("foods", []))
-
-            success = ds_raw.get("success", False) and bool(foods)
-            error = ds_raw.get("error")
-            if ds_raw.get("success") and not foods:
-                error = "DeepSeek did not return recognizable foods"
+            raw_results = self.deepseek_client.analyze_phrases(texts)
+        except Exception as exc:  # pragma: no cover - defensive fallback
+            raw_results = [{"success": False, "error": str(exc)} for _ in texts]
+
+        segment_foods = [
+            self._normalize_deepseek_foods(raw.get("foods", [])) if raw.get("success") else []
+            for raw in raw_results
+        ]
+        foods = [food for seg_foods in segment_foods for food in seg_foods]
+        errors = [raw.get("error") for raw in raw_results if raw.get("error")]
+        success = bool(foods)
+        overloaded = not success and any(raw.get("overloaded") for raw in raw_results)
+        if success:
+            self._persist_deepseek_pending(example_input, foods)
 
-            if success:
-                self._persist_deepseek_pending(user_input, foods)
+        return {
+            "success": success,
+            "foods": foods,
+            "segment_foods": segment_foods,
+            "analysis": "",
+            "suggestions": [],
+            "raw_content": "",
+            "error": None if success else (errors[0] if errors else "DeepSeek did not return recognizable foods"),
+            "overloaded": overloaded
+        }
 
-            return {
-                "success": success,
-                "foods": foods,
-                "analysis": ds_raw.get("analysis", ""),
-                "suggestions": ds_raw.get("suggestions", []),
-                "raw_content": ds_raw.get("raw_content", ""),
-                "error": error
-            }
+    def _analyze_with_deepseek(self, user_input: str, example_input: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Gọi DeepSeek và chuẩn hóa kết quả về cấu trúc nội bộ.
+        Câu trả lời thô được cache trong DeepSeekClient (LRU + SQLite dùng chung).
+        example_input: câu gốc lưu kèm món pending (khi chỉ gửi một phần câu).
+        """
+        try:
+            ds_raw = self.deepseek_client.analyze(user_input)
+            return self._deepseek_output(ds_raw, example_input or user_input)
         except Exception as exc:  # pragma: no cover - defensive fallback
             return {
                 "success": False,
@@ -336,9 +567,34 @@ class NutritionPipelineAdvanced:
                 "raw_content": "",
                 "error": str(exc)
             }
-        # Cache kết quả (kể cả lỗi) để tránh double-call
-        self._deepseek_cache = {"key": cache_key, "ts": now, "result": dict(result)}
-        return result
+
+    def _deepseek_output(
+        self,
+        ds_raw: Dict[str, Any],
+        example_input: str,
+        foods: Optional[List[Dict]] = None
+    ) -> Dict[str, Any]:
+        """Kết quả thô của DeepSeekClient -> format nội bộ (foods: món đã chuẩn hóa sẵn, nếu có)."""
+        if foods is None:
+            foods = self._normalize_deepseek_foods(ds_raw.get("foods", []))
+
+        success = ds_raw.get("success", False) and bool(foods)
+        error = ds_raw.get("error")
+        if ds_raw.get("success") and not foods:
+            error = "DeepSeek did not return recognizable foods"
+
+        if success:
+            self._persist_deepseek_pending(example_input, foods)
+
+        return {
+            "success": success,
+            "foods": foods,
+            "analysis": ds_raw.get("analysis", ""),
+            "suggestions": ds_raw.get("suggestions", []),
+            "raw_content": ds_raw.get("raw_content", ""),
+            "error": error,
+            "overloaded": bool(ds_raw.get("overloaded"))
+        }
 
     def _normalize_deepseek_foods(self, deepseek_foods: List[Dict[str, Any]]) -> List[Dict]:
         """Chuẩn hóa output DeepSeek thành format pipeline."""
@@ -428,7 +684,8 @@ class NutritionPipelineAdvanced:
             nutrition_hint = nutrition_hint if isinstance(nutrition_hint, dict) else None
 
             category = raw.get('category') or VIETNAMESE_FOODS_NUTRITION.get(matched_name, {}).get('category') or "custom"
-            weight = estimate_weight(quantity_info, category)
+            weight = estimate_weight(quantity_info, category, self.deterministic_weight)
+            weight_range = estimate_weight_range(quantity_info, category)
             nutrition = {}
             if matched_name in VIETNAMESE_FOODS_NUTRITION:
                 nutrition = calculate_nutrition(matched_name, weight) or {}
@@ -450,6 +707,7 @@ class NutritionPipelineAdvanced:
                 'original_text': surface_text or raw_label,
                 'quantity_info': quantity_info,
                 'estimated_weight_g': weight,
+                'estimated_weight_range_g': weight_range,
                 'nutrition': nutrition,
                 'category': category,
                 'confidence': combined_confidence,
@@ -685,10 +943,12 @@ class NutritionPipelineAdvanced:
     
     def _update_daily_totals(self, meal_summary: Dict):
         """Cập nhật tổng ngày"""
-        self._rollover_daily_date_if_needed()
-        for key in self.daily_totals:
-            self.daily_totals[key] += meal_summary.get(key, 0)
-        self._persist_daily_totals()
+        # process_input có thể chạy song song trên thread pool của API
+        with self._totals_lock:
+            self._rollover_daily_date_if_needed()
+            for key in self.daily_totals:
+                self.daily_totals[key] += meal_summary.get(key, 0)
+            self._persist_daily_totals()
     
     def _generate_response(self, result: Dict) -> str:
         """Tạo phản hồi thông minh"""
@@ -799,7 +1059,7 @@ class NutritionPipelineAdvanced:
     def _ensure_daily_totals_table(self) -> None:
         """Create lightweight table để lưu tổng ngày của pipeline."""
         try:
-            with sqlite3.connect(DB_PATH) as conn:
+            with get_connection(DB_PATH) as conn:
                 conn.execute(
                     """
                     CREATE TABLE IF NOT EXISTS daily_totals_state (
@@ -819,7 +1079,7 @@ class NutritionPipelineAdvanced:
         today = datetime.now().date().isoformat()
         self.daily_date = today
         try:
-            with sqlite3.connect(DB_PATH) as conn:
+            with get_connection(DB_PATH) as conn:
                 cur = conn.execute(
                     "SELECT totals FROM daily_totals_state WHERE day = ?", (today,)
                 )
@@ -841,7 +1101,7 @@ class NutritionPipelineAdvanced:
         try:
             payload = json.dumps(self.daily_totals, ensure_ascii=False)
             now = datetime.utcnow().isoformat() + "Z"
-            with sqlite3.connect(DB_PATH) as conn:
+            with get_connection(DB_PATH) as conn:
                 conn.execute(
                     """
                     INSERT INTO daily_totals_state (day, totals, updated_at)
@@ -865,7 +1125,7 @@ class NutritionPipelineAdvanced:
         self.daily_date = today
         # Thử load tổng đã lưu của ngày mới; nếu chưa có thì reset về 0
         try:
-            with sqlite3.connect(DB_PATH) as conn:
+            with get_connection(DB_PATH) as conn:
                 cur = conn.execute(
                     "SELECT totals FROM daily_totals_state WHERE day = ?", (today,)
                 )
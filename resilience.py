@@ -0,0 +1,440 @@
+"""
+Resilience helpers for LLM calls: per-request deadlines, bounded retries with jittered
+backoff, and a circuit breaker.
+
+- Deadline: time budget set once by the endpoint (deadline_scope) and read by the
+  client (current_deadline), so nested calls never wait longer than the request can.
+- call_with_retries / acall_with_retries: retry transient failures (connection errors,
+  timeouts, HTTP 429/5xx) with "full jitter" backoff, only while the budget allows.
+- CircuitBreaker: after N consecutive failures stop calling for reset_timeout seconds,
+  then let one probe through (half-open) before closing again.
+- AdmissionLimiter: per caller class (food extraction vs lab matching) cap on concurrent
+  LLM calls with a bounded FIFO wait queue; callers that cannot get a slot in time are
+  rejected with Overloaded so they can degrade (local-only result, HTTP 503).
+"""
+import asyncio
+import contextlib
+import contextvars
+import math
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+import requests
+
+from config import Config
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class DeadlineExceeded(Exception):
+    """The request's time budget ran out before the call could (re)start."""
+
+
+class CircuitOpenError(Exception):
+    """The breaker is open: the call was short-circuited without touching the network."""
+
+
+class Overloaded(Exception):
+    """No LLM slot for this caller class within the allowed wait (or the queue is full)."""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Deadline:
+    def __init__(self, seconds: float, clock: Callable[[], float] = time.monotonic):
+        self._clock = clock
+        self.expires_at = clock() + max(0.0, seconds)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - self._clock())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def timeouts(self, connect: float, read: float) -> Tuple[float, float]:
+        """(connect, read) socket timeouts capped by the remaining budget."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded("deadline exceeded")
+        return min(connect, remaining), min(read, remaining)
+
+
+_current_deadline: "contextvars.ContextVar[Optional[Deadline]]" = contextvars.ContextVar(
+    "current_deadline", default=None
+)
+
+
+@contextlib.contextmanager
+def deadline_scope(seconds: Optional[float]):
+    """Set the deadline for calls made in this block (an outer, earlier deadline wins)."""
+    if seconds is None or seconds <= 0:
+        yield current_deadline()
+        return
+    deadline = Deadline(seconds)
+    outer = _current_deadline.get()
+    if outer is not None and outer.expires_at <= deadline.expires_at:
+        deadline = outer
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.trips = 0
+        self.short_circuited = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self._state
+
+    def is_open(self) -> bool:
+        """True while calls are being short-circuited (read-only, unlike allow())."""
+        with self._lock:
+            state = self._current_state()
+            return state == self.OPEN or (state == self.HALF_OPEN and self._probing)
+
+    def allow(self) -> bool:
+        return self.admit() is not None
+
+    def admit(self) -> Optional[bool]:
+        """None: short-circuited; True: this call is the half-open probe (see release_probe); False: closed."""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return False
+            if state == self.HALF_OPEN and not self._probing:
+                self._state = self.HALF_OPEN
+                self._probing = True  # one probe at a time
+                return True
+            self.short_circuited += 1
+            return None
+
+    def release_probe(self) -> None:
+        """
+        The probe ended without a verdict (cancelled, deadline hit): let the next call
+        probe instead of short-circuiting forever. No-op once success/failure was recorded.
+        """
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._probing = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.trips += 1
+                self._state = self.OPEN
+                self._opened_at = self._clock()
+                self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self._current_state(),
+                "consecutiveFailures": self._failures,
+                "trips": self.trips,
+                "shortCircuited": self.short_circuited,
+            }
+
+
+def is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code in RETRYABLE_STATUS
+    try:
+        import httpx  # type: ignore
+    except ImportError:
+        return False
+    if isinstance(exc, httpx.TransportError):
+        return True
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRYABLE_STATUS
+    return False
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float, rng: random.Random = random) -> float:
+    """Full jitter: uniform(0, min(max_delay, base_delay * 2**attempt))."""
+    return rng.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def _next_delay(exc: BaseException, attempt: int, attempts: int, deadline: Deadline,
+                base_delay: float, max_delay: float) -> Optional[float]:
+    """Backoff before the next attempt, or None when the error must be raised."""
+    if not is_retryable(exc) or attempt + 1 >= attempts:
+        return None
+    delay = backoff_delay(attempt, base_delay, max_delay)
+    if delay >= deadline.remaining():
+        return None
+    return delay
+
+
+def _begin_attempt(deadline: Deadline, breaker: Optional[CircuitBreaker]) -> bool:
+    """Raise if the attempt may not run; True if it holds the breaker's half-open probe."""
+    if deadline.expired():
+        raise DeadlineExceeded("deadline exceeded")
+    if breaker is None:
+        return False
+    probe = breaker.admit()
+    if probe is None:
+        raise CircuitOpenError("DeepSeek circuit breaker is open")
+    return probe
+
+
+def _record(breaker: Optional[CircuitBreaker], exc: Optional[BaseException]) -> None:
+    if breaker is None or isinstance(exc, DeadlineExceeded):
+        return
+    if exc is None or not is_retryable(exc):
+        breaker.record_success()  # a 4xx answer still means the upstream is up
+    else:
+        breaker.record_failure()
+
+
+def call_with_retries(
+    func: Callable[[Deadline], Any],
+    deadline: Deadline,
+    attempts: int = 3,
+    base_delay: float = 0.2,
+    max_delay: float = 2.0,
+    breaker: Optional[CircuitBreaker] = None,
+) -> Any:
+    """Call func(deadline) until it succeeds, fails permanently or the budget runs out."""
+    for attempt in range(max(1, attempts)):
+        probe = _begin_attempt(deadline, breaker)
+        try:
+            result = func(deadline)
+        except Exception as exc:
+            _record(breaker, exc)
+            delay = _next_delay(exc, attempt, attempts, deadline, base_delay, max_delay)
+            if delay is None:
+                raise
+            time.sleep(delay)
+        else:
+            _record(breaker, None)
+            return result
+        finally:
+            if probe:  # BaseException (KeyboardInterrupt...) or DeadlineExceeded: no verdict
+                breaker.release_probe()
+    raise DeadlineExceeded("deadline exceeded")  # pragma: no cover - loop always returns/raises
+
+
+async def acall_with_retries(
+    func: Callable[[Deadline], Awaitable[Any]],
+    deadline: Deadline,
+    attempts: int = 3,
+    base_delay: float = 0.2,
+    max_delay: float = 2.0,
+    breaker: Optional[CircuitBreaker] = None,
+) -> Any:
+    """Async call_with_retries (backoff with asyncio.sleep)."""
+    for attempt in range(max(1, attempts)):
+        probe = _begin_attempt(deadline, breaker)
+        try:
+            result = await func(deadline)
+        except Exception as exc:
+            _record(breaker, exc)
+            delay = _next_delay(exc, attempt, attempts, deadline, base_delay, max_delay)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+        else:
+            _record(breaker, None)
+            return result
+        finally:
+            if probe:  # CancelledError (a BaseException) or DeadlineExceeded: no verdict
+                breaker.release_probe()
+    raise DeadlineExceeded("deadline exceeded")  # pragma: no cover - loop always returns/raises
+
+
+class _Waiter:
+    __slots__ = ("granted", "wake")
+
+    def __init__(self, wake: Callable[[], None]):
+        self.granted = False
+        self.wake = wake
+
+
+class AdmissionLimiter:
+    """
+    At most max_concurrent holders; up to max_queue callers wait (FIFO) for at most
+    max_wait seconds, anyone else is rejected at once. Works for threads (slot) and
+    coroutines (aslot); a released slot is handed straight to the oldest waiter.
+    """
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.max_wait = max(0.0, max_wait)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._waiters: Deque[_Waiter] = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _overloaded(self, reason: str) -> Overloaded:
+        return Overloaded(
+            f"LLM capacity for '{self.name}' exhausted ({reason})",
+            retry_after=max(1, math.ceil(self.max_wait)),
+        )
+
+    def _enter(self, wake: Callable[[], None]) -> Optional[_Waiter]:
+        """Take a free slot (None) or queue a waiter; raises when the queue is full."""
+        with self._lock:
+            if self._active < self.max_concurrent and not self._waiters:
+                self._active += 1
+                self.admitted += 1
+                return None
+            if len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                raise self._overloaded("queue full")
+            waiter = _Waiter(wake)
+            self._waiters.append(waiter)
+            return waiter
+
+    def _leave_queue(self, waiter: _Waiter, started: float) -> bool:
+        """After waiting: True if the slot was granted, else dequeue and count a timeout."""
+        with self._lock:
+            if waiter.granted:
+                self.admitted += 1
+                waited = time.monotonic() - started
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+                return True
+            self._waiters.remove(waiter)
+            self.rejected += 1
+            self.timed_out += 1
+            return False
+
+    def _wait_budget(self, timeout: Optional[float]) -> float:
+        return self.max_wait if timeout is None else max(0.0, min(self.max_wait, timeout))
+
+    def acquire(self, timeout: Optional[float] = None) -> None:
+        event = threading.Event()
+        waiter = self._enter(event.set)
+        if waiter is None:
+            return
+        started = time.monotonic()
+        event.wait(self._wait_budget(timeout))
+        if not self._leave_queue(waiter, started):
+            raise self._overloaded("wait timed out")
+
+    async def aacquire(self, timeout: Optional[float] = None) -> None:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake() -> None:
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        waiter = self._enter(wake)
+        if waiter is None:
+            return
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self._wait_budget(timeout))
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if self._leave_queue(waiter, started):
+                self.release()
+            raise
+        if not self._leave_queue(waiter, started):
+            raise self._overloaded("wait timed out")
+
+    def release(self) -> None:
+        with self._lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.granted = True  # slot passes to the waiter, _active unchanged
+                waiter.wake()
+            else:
+                self._active = max(0, self._active - 1)
+
+    @contextlib.contextmanager
+    def slot(self, timeout: Optional[float] = None):
+        self.acquire(timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, timeout: Optional[float] = None):
+        await self.aacquire(timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waited = self.admitted or 1
+            return {
+                "active": self._active,
+                "queued": len(self._waiters),
+                "maxConcurrent": self.max_concurrent,
+                "maxQueue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timedOut": self.timed_out,
+                "avgWaitMs": round(self._wait_total / waited * 1e3, 2),
+                "maxWaitMs": round(self._wait_max * 1e3, 2),
+            }
+
+
+# Một limiter cho mỗi loại caller: burst /match không chiếm hết chỗ của /analyze
+llm_limiters: Dict[str, AdmissionLimiter] = {
+    "food": AdmissionLimiter(
+        "food", Config.LLM_FOOD_MAX_CONCURRENT, Config.LLM_FOOD_MAX_QUEUE, Config.LLM_FOOD_MAX_WAIT_SECONDS
+    ),
+    "lab": AdmissionLimiter(
+        "lab", Config.LLM_LAB_MAX_CONCURRENT, Config.LLM_LAB_MAX_QUEUE, Config.LLM_LAB_MAX_WAIT_SECONDS
+    ),
+}
+
+
+def limiter_stats() -> Dict[str, Dict[str, Any]]:
+    return {name: limiter.stats() for name, limiter in llm_limiters.items()}
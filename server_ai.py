@@ -5,13 +5,15 @@ import io
 import json
 import time
 import os
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 
-import requests
 from fastapi import APIRouter, FastAPI, File, Form, UploadFile, HTTPException
 from fastapi.responses import JSONResponse
 
 from config import Config
+from concurrency import run_blocking
+from http_client import apost_json, post_json
+from resilience import Overloaded, llm_limiters
 
 
 # -----------------------------
@@ -85,10 +87,8 @@ def pdf_bytes_to_text(pdf_bytes: bytes) -> str:
         raise RuntimeError("Cannot extract text from PDF (maybe scanned image). OCR needed.") from exc
 
 
-def deepseek_one_shot(A: List[Dict[str, Any]], pdf_text: str) -> Dict[str, Any]:
-    """
-    Call DeepSeek via HTTP. Output includes records_template ready for origin API.
-    """
+def _one_shot_request(A: List[Dict[str, Any]], pdf_text: str) -> Tuple[str, Dict[str, Any], Dict[str, str]]:
+    """Build (url, body, headers) for the DeepSeek matching call."""
     api_key = getattr(Config, "DEEPSEEK_API_KEY", None) or None
     base_url = getattr(Config, "DEEPSEEK_BASE_URL", "https://api.deepseek.com").rstrip("/")
     model = getattr(Config, "MODEL", "deepseek-chat")
@@ -187,19 +187,10 @@ def deepseek_one_shot(A: List[Dict[str, Any]], pdf_text: str) -> Dict[str, Any]:
         f"Calling DeepSeek model={model} A={len(A)} pdf_chars={len(pdf_text)} "
         f"url={url} t_connect={connect_timeout}s t_read={read_timeout}s t_total={total_timeout}s"
     )
+    return url, body, {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
 
-    t0 = time.time()
-    resp = requests.post(
-        url,
-        headers={"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"},
-        json=body,
-        timeout=(connect_timeout, read_timeout),
-    )
-    elapsed = time.time() - t0
-    log(f"DeepSeek HTTP status={resp.status_code} elapsed={elapsed:.2f}s")
-    resp.raise_for_status()
-    data = resp.json()
 
+def _parse_one_shot(data: Dict[str, Any]) -> Dict[str, Any]:
     content = (data.get("choices", [{}])[0].get("message", {}) or {}).get("content", "") or ""
     content = content.strip()
     if not content:
@@ -207,6 +198,29 @@ def deepseek_one_shot(A: List[Dict[str, Any]], pdf_text: str) -> Dict[str, Any]:
     return json.loads(content)
 
 
+def deepseek_one_shot(A: List[Dict[str, Any]], pdf_text: str) -> Dict[str, Any]:
+    """
+    Call DeepSeek via HTTP. Output includes records_template ready for origin API.
+    Raises Overloaded when the "lab" LLM limiter has no slot within its wait budget.
+    """
+    url, body, headers = _one_shot_request(A, pdf_text)
+    t0 = time.time()
+    with llm_limiters["lab"].slot():
+        data = post_json(url, body, headers)
+    log(f"DeepSeek HTTP done elapsed={time.time() - t0:.2f}s")
+    return _parse_one_shot(data)
+
+
+async def adeepseek_one_shot(A: List[Dict[str, Any]], pdf_text: str) -> Dict[str, Any]:
+    """Async deepseek_one_shot on the shared keep-alive pool."""
+    url, body, headers = _one_shot_request(A, pdf_text)
+    t0 = time.time()
+    async with llm_limiters["lab"].aslot():
+        data = await apost_json(url, body, headers)
+    log(f"DeepSeek HTTP done elapsed={time.time() - t0:.2f}s")
+    return _parse_one_shot(data)
+
+
 router = APIRouter(tags=["serverAI"])
 
 
@@ -250,7 +264,7 @@ async def match_metrics(
     # Extract text (limited)
     t1 = time.time()
     try:
-        pdf_text = pdf_bytes_to_text(pdf_bytes)
+        pdf_text = await run_blocking(pdf_bytes_to_text, pdf_bytes, pool="pipeline")
     except Exception as exc:
         raise HTTPException(status_code=500, detail=f"PDF text extraction failed: {exc}")
 
@@ -267,7 +281,14 @@ async def match_metrics(
     # Call DeepSeek
     t2 = time.time()
     try:
-        result = deepseek_one_shot(A, pdf_text)
+        result = await adeepseek_one_shot(A, pdf_text)
+    except Overloaded as exc:
+        log(f"DeepSeek overloaded: {exc}")
+        return JSONResponse(
+            {"success": False, "error": "overloaded", "detail": str(exc)},
+            status_code=503,
+            headers={"Retry-After": str(exc.retry_after)},
+        )
     except Exception as exc:
         log(f"DeepSeek error: {exc}")
         raise HTTPException(status_code=500, detail=f"DeepSeek call failed: {exc}")
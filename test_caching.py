@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Tests cho caching.LRUCache, cache kết quả FoodExtractor và cache câu trả lời DeepSeek
+"""
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from caching import LRUCache, TieredResponseCache
+from dbs import ResponseCacheDB
+from vietnamese_foods_extended import VIETNAMESE_FOODS_NUTRITION, FoodExtractor, get_dataset_version
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "a" becomes most recent
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats() == {
+        "size": 2, "maxsize": 2, "hits": 2, "misses": 1, "evictions": 1, "hit_rate": 0.6667,
+    }
+
+
+def test_lru_is_thread_safe():
+    cache = LRUCache(64)
+
+    def worker(offset):
+        for i in range(2000):
+            cache.put((offset, i % 100), i)
+            cache.get((offset, (i * 7) % 100))
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats["size"] == 64
+    assert stats["hits"] + stats["misses"] == 8 * 2000
+
+
+def test_extract_cache_hits_and_returns_copies():
+    extractor = FoodExtractor(cache_size=16)
+    first = extractor.extract("1 ly cà phê sữa")
+    first[0]["food_name"] = "mutated"
+    second = extractor.extract("  1 LY cà phê sữa ")
+    assert second == FoodExtractor().extract("1 ly cà phê sữa")
+    assert extractor.cache.stats()["hits"] == 1
+
+
+def test_extract_cache_invalidated_by_learned_alias():
+    extractor = FoodExtractor(cache_size=16)
+    assert extractor.extract("mon cache moi") == []
+    version = get_dataset_version()
+    try:
+        extractor.matcher.learn("phở bò", None, aliases=["mon cache moi"])
+        assert get_dataset_version() > version
+        assert [f["food_name"] for f in extractor.extract("mon cache moi")] == ["phở bò"]
+    finally:
+        VIETNAMESE_FOODS_NUTRITION["phở bò"]["aliases"].remove("mon cache moi")
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_tiered_cache_ttl_negative_ttl_and_shared_store(tmp_path):
+    clock = _Clock()
+    store = ResponseCacheDB(tmp_path / "cache.db")
+    worker_a = TieredResponseCache(memory_size=8, store=store, ttl=100, negative_ttl=10, clock=clock)
+    worker_b = TieredResponseCache(memory_size=8, store=ResponseCacheDB(tmp_path / "cache.db"),
+                                   ttl=100, negative_ttl=10, clock=clock)
+    worker_a.put("ok", {"success": True, "foods": [{"food_name": "pizza"}]})
+    worker_a.put("bad", {"success": False}, negative=True)
+
+    hit = worker_a.get("ok")
+    hit["foods"].clear()  # callers get copies
+    assert worker_a.get("ok")["foods"] == [{"food_name": "pizza"}]
+    assert worker_b.get("ok")["success"]  # other worker: SQLite tier, then promoted
+    assert worker_b.get("ok") and worker_b.stats()["storeHits"] == 1 and worker_b.stats()["memoryHits"] == 1
+
+    clock.now += 11
+    assert worker_a.get("bad") is None and worker_b.get("bad") is None
+    assert worker_a.get("ok") is not None
+    clock.now += 90
+    assert worker_a.get("ok") is None and worker_b.get("ok") is None
+    assert store.stats()["entries"] == 0
+
+
+def test_response_store_evicts_least_recently_hit(tmp_path):
+    store = ResponseCacheDB(tmp_path / "cache.db", max_entries=3)
+    for i in range(5):
+        store.put(f"k{i}", {"i": i}, expires_at=1e12, negative=False, now=float(i))
+    store.get("k0", now=10.0)
+    assert store.evict(now=11.0) == 2
+    assert [key for key in ("k0", "k1", "k2", "k3", "k4") if store.get(key, now=12.0)] == ["k0", "k3", "k4"]
+
+
+def test_deepseek_client_serves_repeats_from_cache(tmp_path):
+    from deepseek_client import DeepSeekClient
+    from mock_deepseek_server import MockDeepSeekServer
+
+    server = MockDeepSeekServer().start()
+    try:
+        def worker():
+            client = DeepSeekClient()
+            client.api_key = "test-key"
+            client.base_url = server.base_url
+            client.response_cache = TieredResponseCache(store=ResponseCacheDB(tmp_path / "cache.db"))
+            return client
+
+        first, second = worker(), worker()
+        answer = first.analyze("Pizza  phô mai")
+        assert answer["success"]
+        assert first.analyze("pizza phô mai") == answer
+        assert second.analyze(" PIZZA phô mai ") == answer  # shared SQLite tier
+        assert first.analyze("pizza pho mai")["success"]  # diacritics are part of the key
+        assert server.requests == 2
+        assert first.response_cache.stats()["hitRate"] == 0.3333
+    finally:
+        server.stop()
+
+
+def test_deepseek_failures_are_not_cached_only_real_answers(tmp_path):
+    from deepseek_client import DeepSeekClient
+    from mock_deepseek_server import MockDeepSeekServer
+
+    server = MockDeepSeekServer().start()
+    try:
+        store = ResponseCacheDB(tmp_path / "cache.db")
+
+        def worker():
+            client = DeepSeekClient()
+            client.api_key = "test-key"
+            client.base_url = server.base_url
+            client.max_attempts = 2
+            client.retry_base_delay = client.retry_max_delay = 0.01
+            client.response_cache = TieredResponseCache(store=store)
+            return client
+
+        first, second = worker(), worker()
+        server.inject(503, 503)  # outage outlasting the retries
+        assert not first.analyze("pizza phô mai")["success"]
+        assert second.analyze("pizza phô mai")["success"]  # shared tier not poisoned
+        assert server.requests == 3
+
+        refused = worker()
+        refused.base_url = "http://127.0.0.1:9"  # connection refused
+        assert not refused.analyze("bánh tacos")["success"]
+        assert first.analyze("bánh tacos")["success"] and server.requests == 4
+
+        # DeepSeek answered but nothing parseable: a negative entry, served from cache
+        unparseable = worker()
+        unparseable._parse_response = lambda data: {**unparseable._empty_result("Cannot parse"), "raw_content": "?"}
+        assert not unparseable.analyze("xin chào")["success"]
+        assert not second.analyze("xin chào")["success"] and server.requests == 5
+    finally:
+        server.stop()
+
+
+def test_deepseek_batch_failures_are_not_cached_per_phrase(tmp_path):
+    from deepseek_client import DeepSeekClient
+    from mock_deepseek_server import MockDeepSeekServer
+
+    server = MockDeepSeekServer().start()
+    try:
+        client = DeepSeekClient()
+        client.api_key = "test-key"
+        client.base_url = server.base_url
+        client.batcher = None
+        client.response_cache = TieredResponseCache(store=ResponseCacheDB(tmp_path / "cache.db"))
+
+        server.inject("omit")  # the model drops the last id
+        results = client.analyze_phrases(["cơm tấm", "bún chả"])
+        assert results[0]["success"] and not results[1]["success"]
+        assert client.analyze("cơm tấm")["success"] and server.requests == 1  # real answer cached
+        assert client.analyze("bún chả")["success"] and server.requests == 2  # still reaches DeepSeek
+
+        server.inject("truncate")  # combined reply cut off: nothing parseable for anyone
+        assert not any(r["success"] for r in client.analyze_phrases(["bánh mì", "chè"]))
+        assert client.analyze("bánh mì")["success"] and client.analyze("chè")["success"]
+        assert server.requests == 5
+    finally:
+        server.stop()
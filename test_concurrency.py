@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Tests cho execution model của API (thread pool cho pipeline/SQLite, single-flight)
+"""
+import asyncio
+import inspect
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from config import Config
+from concurrency import AsyncSingleFlight, MicroBatcher, SingleFlight
+from dbs import DailyLogDB
+
+SLOW_DEEPSEEK_SECONDS = 0.6
+
+
+def test_requests_served_while_analyze_waits_on_deepseek(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "daily_log_db", DailyLogDB(tmp_path / "logs.db"))
+    monkeypatch.setattr(main.pipeline, "_persist_daily_totals", lambda: None)
+    client = main.pipeline.deepseek_client
+    monkeypatch.setattr(client, "is_available", lambda: True)
+
+    def slow_analyze(user_input):
+        time.sleep(SLOW_DEEPSEEK_SECONDS)  # blocking requests.post stand-in
+        return {"success": False, "error": "timeout"}
+
+    monkeypatch.setattr(client, "analyze", slow_analyze)
+    finished = {}
+
+    async def timed(name, coro):
+        result = await coro
+        finished[name] = time.perf_counter()
+        return result
+
+    async def scenario():
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            timed("analyze", main.analyze(main.AnalyzeRequest(
+                patientId="p1", text="pizza phô mai", dateKey="2025-01-01"))),
+            *[timed(f"history{i}", main.history(patientId="p1", from_date=None, to_date=None))
+              for i in range(5)],
+            timed("foods", main.list_foods(q="phở", limit=10, offset=0)),
+        )
+        return started, results
+
+    started, results = asyncio.run(scenario())
+    assert results[0]["success"] and results[0]["meta"]["deepseek"]["used"]
+    assert all(r["success"] for r in results[1:])
+    assert finished["analyze"] - started >= SLOW_DEEPSEEK_SECONDS
+    for name, at in finished.items():
+        if name != "analyze":
+            assert at - started < SLOW_DEEPSEEK_SECONDS / 2, name
+
+
+def test_async_enrichment_returns_local_result_then_patches_entry(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, "LLM_ENRICHMENT_MODE", "async")
+    monkeypatch.setattr(main, "daily_log_db", DailyLogDB(tmp_path / "logs.db"))
+    monkeypatch.setattr(main.pipeline, "_persist_daily_totals", lambda: None)
+    monkeypatch.setattr(main.pipeline, "_persist_deepseek_pending", lambda *args: None)
+    client = main.pipeline.deepseek_client
+    monkeypatch.setattr(client, "is_available", lambda: True)
+    release = threading.Event()
+
+    def slow_analyze(user_input):
+        release.wait(5)
+        return {"success": True, "analysis": "", "suggestions": [], "foods": [{
+            "food_name": user_input, "quantity": {"amount": 1, "unit": "phần", "confidence": 0.8},
+            "confidence": 0.8, "nutrition_hint": {"calories_per_100g": 250}}]}
+
+    monkeypatch.setattr(client, "analyze", slow_analyze)
+    started = time.perf_counter()
+    response = main._run_analyze("p1", "u1", "2 tô phở bò, salad cá ngừ", "2025-01-02", "vi-VN")
+    assert time.perf_counter() - started < SLOW_DEEPSEEK_SECONDS
+    assert response["meta"]["enrichmentPending"] and response["meta"]["processingMethod"] == "local"
+    assert [f["foodName"] for f in response["data"]["foods"]] == ["phở bò", "cá chiên"]
+    local_calories = main.daily_log_db.get_daily_log("p1", "2025-01-02")["totals"]["calories"]
+
+    release.set()
+    deadline = time.time() + 5
+    while True:
+        log = main.daily_log_db.get_daily_log("p1", "2025-01-02")
+        entry = log["entries"][0]
+        if not entry["enrichmentPending"] or time.time() > deadline:
+            break
+        time.sleep(0.02)
+    assert entry["enrichment"]["status"] == "done"
+    assert entry["enrichment"]["processingMethod"] == "hybrid"
+    assert [f["foodName"] for f in entry["foods"]] == ["phở bò", "salad cá ngừ"]
+    assert log["totals"]["calories"] == entry["mealSummary"]["calories"] > local_calories
+
+
+def test_startup_resolves_enrichments_orphaned_by_a_restart(tmp_path, monkeypatch):
+    from datetime import datetime, timedelta
+
+    from dbs import ENRICHMENT_PENDING_SQL, connection_manager
+
+    monkeypatch.setattr(main, "daily_log_db", DailyLogDB(tmp_path / "logs.db"))
+    monkeypatch.setattr(Config, "ENRICHMENT_DEADLINE_SECONDS", 120)
+    scheduled = []
+    monkeypatch.setattr(main, "schedule_enrichment", lambda *args: scheduled.append(args))
+
+    exited = subprocess.Popen([sys.executable, "-c", ""])
+    exited.wait()
+
+    def entry(entry_id, age_seconds, pending=True, claimed_by=None):
+        created_at = (datetime.utcnow() - timedelta(seconds=age_seconds)).isoformat() + "Z"
+        claim = {"status": "pending", "claimedBy": claimed_by, "claimedAt": created_at} if claimed_by else None
+        return {"entryId": entry_id, "text": "salad cá ngừ", "foods": [{"foodId": "f1"}],
+                "mealSummary": {"calories": 100}, "createdAt": created_at, "status": "draft",
+                **({"enrichmentPending": True} if pending else {}),
+                **({"enrichment": claim} if claim else {})}
+
+    main.daily_log_db.append_entry("p1", "2025-01-01", entry("old", 600))
+    main.daily_log_db.append_entry("p1", "2025-01-02", entry("recent", 5))
+    main.daily_log_db.append_entry("p1", "2025-01-02", entry("done", 600, pending=False))
+    # job still running in a live worker vs. one killed mid-job
+    main.daily_log_db.append_entry("p1", "2025-01-03", entry("running", 5, claimed_by=os.getppid()))
+    main.daily_log_db.append_entry("p1", "2025-01-03", entry("killed", 5, claimed_by=exited.pid))
+
+    assert main.recover_pending_enrichments() == {"requeued": 2, "expired": 1, "skipped": 1}
+    assert [args[2] for args in scheduled] == ["recent", "killed"]
+    assert scheduled[0] == ("p1", "2025-01-02", "recent", "salad cá ngừ", [{"foodId": "f1"}])
+    old = main.daily_log_db.get_daily_log("p1", "2025-01-01")["entries"][0]
+    assert not old["enrichmentPending"] and old["enrichment"]["status"] == "failed"
+    assert old["foods"] == [{"foodId": "f1"}]  # local result kept
+    assert [e[2]["entryId"] for e in main.daily_log_db.pending_enrichments()] == ["recent", "running", "killed"]
+    killed = main.daily_log_db.get_daily_log("p1", "2025-01-03")["entries"][1]
+    assert killed["enrichment"]["claimedBy"] == os.getpid()
+
+    # Second worker starting up: every pending job is claimed by a live process
+    assert main.recover_pending_enrichments() == {"requeued": 0, "expired": 0, "skipped": 3}
+    assert len(scheduled) == 2
+
+    conn = connection_manager(main.daily_log_db.db_path).connection()
+    plan = " ".join(row[-1] for row in conn.execute(
+        f"EXPLAIN QUERY PLAN SELECT id FROM entries e WHERE {ENRICHMENT_PENDING_SQL.format(alias='e.')}"))
+    assert "idx_entries_enrichment_pending" in plan
+
+
+def test_offloaded_routes_keep_fastapi_signature():
+    assert inspect.iscoroutinefunction(main.history)
+    params = inspect.signature(main.history).parameters
+    assert list(params) == ["patientId", "from_date", "to_date"]
+    assert params["from_date"].default.alias == "from"
+
+
+def test_single_flight_shares_errors_and_forgets_finished_calls():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def failing():
+        calls.append(1)
+        started.set()
+        release.wait()
+        raise RuntimeError("upstream 503")
+
+    errors = []
+
+    def call():
+        try:
+            flight.do("k", failing)
+        except RuntimeError as exc:
+            errors.append(str(exc))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=call) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.stats()["followers"] < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join()
+    assert calls == [1] and errors == ["upstream 503"] * 4
+    assert flight.do("k", lambda: "fresh") == "fresh"  # nothing cached after completion
+
+
+def test_async_single_flight_propagates_errors():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def failing():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        raise RuntimeError("boom")
+
+    async def scenario():
+        return await asyncio.gather(*[flight.do("k", failing) for _ in range(4)], return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert calls == [1]
+    assert [str(r) for r in results] == ["boom"] * 4
+    assert flight.stats() == {"leaders": 1, "followers": 3, "inFlight": 0}
+
+
+def test_micro_batcher_flushes_on_size_and_shares_errors():
+    batches = []
+
+    def batch_func(items):
+        batches.append(list(items))
+        if "bad" in items:
+            raise RuntimeError("upstream 500")
+        return [item.upper() for item in items]
+
+    batcher = MicroBatcher(batch_func, window=5.0, max_items=3)
+    started = time.perf_counter()
+    futures = [batcher.submit(item, item) for item in ("a", "b", "a", "c")]
+    assert [f.result(timeout=1) for f in futures] == ["A", "B", "A", "C"]
+    assert time.perf_counter() - started < 1  # a full batch does not wait for the window
+    assert batches == [["a", "b", "c"]]
+
+    batcher.window = 0.05
+    failing = [batcher.submit(item, item) for item in ("bad", "d")]
+    for future in failing:
+        try:
+            future.result(timeout=1)
+        except RuntimeError as exc:
+            assert str(exc) == "upstream 500"
+        else:
+            raise AssertionError("expected the batch error")
+    assert batcher.stats()["batches"] == 2 and batcher.stats()["deduplicated"] == 1
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Tests cho lớp lưu trữ SQLite (dbs.py): connection dùng chung theo thread, nhật ký theo ngày
+"""
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dbs import DailyLogDB, FoodLearningDB, connection_manager
+
+
+def test_each_thread_reuses_one_tuned_connection(tmp_path):
+    db_path = tmp_path / "logs.db"
+    logs = DailyLogDB(db_path)
+    FoodLearningDB(db_path)
+    manager = connection_manager(db_path)
+    for i in range(5):
+        logs.append_entry("p1", "2025-01-01", {"entryId": str(i), "mealSummary": {"calories": 100}})
+    assert manager.opened == 1  # schema setup of both classes + 5 writes on one connection
+
+    conn = manager.connection()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+    assert conn.execute("PRAGMA busy_timeout").fetchone()[0] > 0
+
+    seen = []
+    thread = threading.Thread(target=lambda: seen.append(manager.connection()))
+    thread.start()
+    thread.join()
+    assert seen[0] is not conn and manager.opened == 2
+    assert logs.get_daily_log("p1", "2025-01-01")["totals"]["calories"] == 500
+
+    manager.close_all()
+    assert manager.stats()["open"] == 0
+    assert len(logs.get_daily_log("p1", "2025-01-01")["entries"]) == 5  # reopens on demand
+
+
+def _entry(entry_id, *foods):
+    return {
+        "entryId": entry_id,
+        "foods": [{"foodId": f"{entry_id}-{i}", "nutrition": {"calories": c}} for i, c in enumerate(foods)],
+        "mealSummary": {"foodCount": len(foods), "calories": float(sum(foods))},
+        "enrichmentPending": False,
+    }
+
+
+def test_entries_round_trip_and_edits_rewrite_only_changed_rows(tmp_path):
+    logs = DailyLogDB(tmp_path / "logs.db")
+    logs.append_entry("p1", "2025-01-01", _entry("a", 100, 200))
+    logs.append_entry("p1", "2025-01-01", _entry("b", 50, 60, 70))
+    log = logs.get_daily_log("p1", "2025-01-01")
+    assert log["entries"] == [_entry("a", 100, 200), _entry("b", 50, 60, 70)]
+    assert list(log["entries"][0]) == ["entryId", "foods", "mealSummary", "enrichmentPending"]
+    assert log["totals"]["calories"] == 480
+
+    conn = connection_manager(logs.db_path).connection()
+    before = conn.total_changes
+    updated = logs.delete_food_in_entry("p1", "2025-01-01", "b", "b-2")
+    # food row deleted + entry row (new mealSummary) + day row (totals)
+    assert conn.total_changes - before == 3
+    assert [f["foodId"] for f in updated["entries"][1]["foods"]] == ["b-0", "b-1"]
+    assert updated["totals"]["calories"] == 410 == updated["entries"][0]["mealSummary"]["calories"] + 110
+
+    def tweak(entry):
+        entry["foods"][0]["nutrition"]["calories"] = 120
+        return entry
+
+    before = conn.total_changes
+    logs.update_entry("p1", "2025-01-01", "a", tweak)
+    assert conn.total_changes - before == 2  # the one food row + totals; entry row unchanged
+    assert logs.update_entry("p1", "2025-01-01", "missing", tweak) is None
+
+    history = logs.get_history("p1", "2025-01-01", "2025-01-01")
+    assert list(history["days"]) == ["2025-01-01"]
+    assert history["days"]["2025-01-01"]["entries"][0]["foods"][0]["nutrition"]["calories"] == 120
+    assert [(p, d, len(e)) for p, d, e in logs.iter_entries_all_patients()] == [("p1", "2025-01-01", 2)]
+    assert logs.delete_daily_log("p1", "2025-01-01") and logs.get_daily_log("p1", "2025-01-01") is None
+    assert conn.execute("SELECT COUNT(*) FROM entry_foods").fetchone()[0] == 0
+
+
+def test_writes_can_skip_re_reading_the_day(tmp_path, monkeypatch):
+    logs = DailyLogDB(tmp_path / "logs.db")
+    logs.append_entry("p1", "2025-01-01", _entry("a", 100))
+    reads = []
+    real_read_day = DailyLogDB._read_day
+    monkeypatch.setattr(
+        DailyLogDB, "_read_day", lambda self, *args: reads.append(args[1:]) or real_read_day(self, *args)
+    )
+
+    assert logs.append_entry("p1", "2025-01-01", _entry("b", 50), return_log=False) == _entry("b", 50)
+
+    def tweak(entry):
+        entry["foods"][0]["nutrition"]["calories"] = 70
+        return entry
+
+    updated = logs.update_entry("p1", "2025-01-01", "b", tweak, return_log=False)
+    assert updated["entryId"] == "b" and updated["foods"][0]["nutrition"]["calories"] == 70
+    assert logs.update_entry("p1", "2025-01-01", "missing", tweak, return_log=False) is None
+    assert reads == []
+
+    assert logs.get_daily_log("p1", "2025-01-01")["totals"]["calories"] == 150
+    assert reads == [("p1", "2025-01-01")]
+
+
+def test_legacy_meals_blobs_are_migrated(tmp_path):
+    import json
+    import sqlite3
+
+    db_path = tmp_path / "legacy.db"
+    with sqlite3.connect(db_path) as conn:
+        conn.execute(
+            "CREATE TABLE daily_logs (patient_id TEXT NOT NULL, day TEXT NOT NULL, daily_totals TEXT NOT NULL,"
+            " meals TEXT NOT NULL, last_updated TEXT NOT NULL, PRIMARY KEY (patient_id, day))"
+        )
+        for i in range(5):
+            meals = [_entry(f"{i}-a", 100), _entry(f"{i}-b", 30, 20)]
+            conn.execute(
+                "INSERT INTO daily_logs VALUES (?, ?, ?, ?, ?)",
+                (f"p{i}", "2025-01-01", json.dumps({"calories": 150}), json.dumps(meals), "2025-01-01T08:00:00"),
+            )
+    conn.close()
+
+    logs = DailyLogDB(db_path)
+    conn = connection_manager(db_path).connection()
+    assert conn.execute("SELECT COUNT(*) FROM daily_logs WHERE meals != '[]'").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM entry_foods").fetchone()[0] == 15
+    log = logs.get_daily_log("p3", "2025-01-01")
+    assert log["entries"] == [_entry("3-a", 100), _entry("3-b", 30, 20)]
+    assert log["totals"]["calories"] == 150
+
+    # A blob written by an older process after startup is still read, and folded in on the next write
+    conn.execute("UPDATE daily_logs SET meals = ? WHERE patient_id = 'p3'", (json.dumps([_entry("3-c", 5)]),))
+    conn.commit()
+    assert [e["entryId"] for e in logs.get_daily_log("p3", "2025-01-01")["entries"]] == ["3-a", "3-b", "3-c"]
+    log = logs.append_entry("p3", "2025-01-01", _entry("3-d", 1))
+    assert [e["entryId"] for e in log["entries"]] == ["3-a", "3-b", "3-c", "3-d"]
+    assert log["totals"]["calories"] == 156
+
+
+def test_locate_entry_is_an_index_lookup(tmp_path):
+    import json
+
+    logs = DailyLogDB(tmp_path / "logs.db")
+    for day in range(1, 29):
+        logs.append_entry("p1", f"2025-02-{day:02d}", _entry(f"e{day}", 100))
+    logs.append_entry("p2", "2025-02-03", _entry("e5", 100))
+    assert logs.locate_entry("p1", "e5") == "2025-02-05"
+    assert logs.locate_entry("p2", "e5") == "2025-02-03"
+    assert logs.locate_entry("p1", "missing") is None
+
+    conn = connection_manager(logs.db_path).connection()
+    plan = " ".join(row[-1] for row in conn.execute(
+        "EXPLAIN QUERY PLAN SELECT day FROM entries WHERE patient_id = ? AND entry_id = ? ORDER BY day DESC LIMIT 1",
+        ("p1", "e5"),
+    ))
+    assert "COVERING INDEX idx_entries_entry_id" in plan
+
+    # Kept in step with writes: moved by save_day, gone with the day
+    logs.save_day("p1", "2025-03-01", [_entry("moved", 1)])
+    assert logs.locate_entry("p1", "moved") == "2025-03-01"
+    logs.delete_daily_log("p1", "2025-03-01")
+    assert logs.locate_entry("p1", "moved") is None
+
+    conn.execute(
+        "UPDATE daily_logs SET meals = ? WHERE patient_id = 'p1' AND day = '2025-02-10'",
+        (json.dumps([_entry("legacy", 1)]),),
+    )
+    conn.commit()
+    assert logs.locate_entry("p1", "legacy") == "2025-02-10"  # not yet migrated blob
+
+
+def test_concurrent_read_modify_writes_lose_no_updates(tmp_path):
+    logs = DailyLogDB(tmp_path / "logs.db")
+    logs.append_entry("p1", "2025-01-01", {**_entry("shared", 0), "edits": 0})
+    threads, edits = 8, 40
+
+    def bump(entry):
+        entry["edits"] += 1
+        entry["foods"][0]["nutrition"]["calories"] += 1
+        entry["mealSummary"]["calories"] += 1
+        return entry
+
+    def writer(i):
+        for n in range(edits):
+            assert logs.update_entry("p1", "2025-01-01", "shared", bump)
+            if n % 10 == 0:
+                logs.append_entry("p1", "2025-01-01", _entry(f"w{i}-{n}", 1))
+
+    workers = [threading.Thread(target=writer, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    log = logs.get_daily_log("p1", "2025-01-01")
+    shared = log["entries"][0]
+    assert shared["edits"] == threads * edits
+    assert shared["foods"][0]["nutrition"]["calories"] == threads * edits
+    assert len(log["entries"]) == 1 + threads * edits // 10
+    assert log["totals"]["calories"] == threads * edits + threads * edits // 10
+    assert logs.day_version("p1", "2025-01-01") == len(log["entries"]) + threads * edits
+
+
+def test_unit_of_work_checks_versions_and_retries_when_busy(tmp_path, monkeypatch):
+    import sqlite3
+
+    import pytest
+
+    from config import Config
+    from dbs import VersionConflict
+
+    logs = DailyLogDB(tmp_path / "logs.db")
+    logs.append_entry("p1", "2025-01-01", _entry("a", 100))
+    version = logs.day_version("p1", "2025-01-01")
+    logs.append_entry("p1", "2025-01-01", _entry("b", 50))
+    with pytest.raises(VersionConflict):  # read before the second append: stale
+        logs.unit_of_work("p1", "2025-01-01", lambda unit: unit.append(_entry("c", 1)), expected_version=version)
+    assert [e["entryId"] for e in logs.get_daily_log("p1", "2025-01-01")["entries"]] == ["a", "b"]
+
+    def move(unit):  # whole cycle on one transaction: read, decide, write
+        moved = [e for e in unit.entries() if e["entryId"] != "a"]
+        unit.replace(moved)
+        return unit.log()["totals"]["calories"]
+
+    assert logs.unit_of_work("p1", "2025-01-01", move, expected_version=version + 1) == 50
+
+    # Another process holds the write lock longer than the busy timeout: retried, not failed
+    monkeypatch.setattr(Config, "SQLITE_BUSY_TIMEOUT_MS", 50)
+    connection_manager(logs.db_path).close_all()
+    other = sqlite3.connect(logs.db_path, isolation_level=None, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    threading.Timer(0.15, other.execute, args=("COMMIT",)).start()
+    logs.append_entry("p1", "2025-01-01", _entry("c", 1))
+    assert logs.write_retries > 0
+    assert logs.get_daily_log("p1", "2025-01-01")["totals"]["calories"] == 51
+    other.close()
+    connection_manager(logs.db_path).close_all()
+
+
+def test_reads_never_write_and_patients_are_created_on_first_write(tmp_path):
+    import sqlite3
+
+    logs = DailyLogDB(tmp_path / "logs.db")
+    conn = connection_manager(logs.db_path).connection()
+
+    # Another process holds the write lock: reads of a new patient still answer at once
+    other = sqlite3.connect(logs.db_path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    before = conn.total_changes
+    assert logs.get_history("new")["days"] == {}
+    assert logs.get_daily_log("new", "2025-01-01") is None
+    assert logs.get_patient_logs("new") == []
+    assert conn.total_changes == before
+    other.execute("COMMIT")
+    other.close()
+    assert not logs.delete_daily_log("new", "2025-01-01")
+    assert conn.execute("SELECT COUNT(*) FROM patients").fetchone()[0] == 0
+
+    logs.append_entry("new", "2025-01-01", _entry("a", 1))
+    assert conn.execute("SELECT patient_id FROM patients").fetchall() == [("new",)]
+    before = conn.total_changes
+    logs.append_entry("new", "2025-01-02", _entry("b", 1))
+    # day row insert + entry + food + totals; the patient INSERT OR IGNORE is skipped
+    assert conn.total_changes - before == 4
+    assert logs.known_patients.stats()["hits"] >= 1
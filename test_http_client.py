@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+"""
+Tests cho client DeepSeek dùng chung pool keep-alive (chạy với mock_deepseek_server)
+"""
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import http_client
+from config import Config
+from deepseek_client import DeepSeekClient, FoodStreamParser
+from mock_deepseek_server import MockDeepSeekServer
+
+
+@pytest.fixture
+def mock_server():
+    http_client.close_clients()
+    server = MockDeepSeekServer().start()
+    yield server
+    server.stop()
+    http_client.close_clients()
+
+
+def _client(server):
+    client = DeepSeekClient()
+    client.api_key = "test-key"
+    client.base_url = server.base_url
+    client.response_cache = None  # count real upstream calls
+    return client
+
+
+def test_sync_calls_reuse_one_connection(mock_server):
+    client = _client(mock_server)
+    results = [client.analyze(f"món thử {i} và trà đá") for i in range(5)]
+    assert all(r["success"] for r in results)
+    assert [f["food_name"] for f in results[0]["foods"]] == ["món thử 0", "trà đá"]
+    assert mock_server.requests == 5
+    assert mock_server.connections == 1
+
+
+def test_async_calls_share_pool(mock_server):
+    client = _client(mock_server)
+
+    async def scenario():
+        first = await asyncio.gather(*[client.aanalyze(f"món async {i}") for i in range(4)])
+        second = [await client.aanalyze(f"món tuần tự {i}") for i in range(4)]
+        await http_client.aclose_clients()
+        return first + second
+
+    results = asyncio.run(scenario())
+    assert all(r["success"] for r in results)
+    assert mock_server.requests == 8
+    assert mock_server.connections <= 4  # sequential round reuses the pooled connections
+
+
+def test_lab_match_uses_shared_session(mock_server, monkeypatch):
+    import server_ai
+
+    monkeypatch.setattr(Config, "DEEPSEEK_API_KEY", "test-key")
+    monkeypatch.setattr(Config, "DEEPSEEK_BASE_URL", mock_server.base_url)
+    A = [{"metric_id": 6, "name": "HbA1c", "unit": "%"}]
+    assert server_ai.deepseek_one_shot(A, "HbA1c 6.1 %")["matches"] == []
+    assert asyncio.run(server_ai.adeepseek_one_shot(A, "HbA1c 6.2 %"))["records_template"] == []
+    assert server_ai.deepseek_one_shot(A, "HbA1c 6.3 %")["matches"] == []
+    assert mock_server.requests == 3
+
+
+def test_concurrent_identical_sync_requests_coalesce(mock_server):
+    mock_server.delay = 0.2
+    client = _client(mock_server)
+    results = [None] * 8
+    barrier = threading.Barrier(8)
+
+    def call(i):
+        barrier.wait()
+        results[i] = client.analyze("pizza phô mai" if i % 2 else "  Pizza phô MAI")
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert mock_server.requests == 1
+    assert all(r == results[0] and r["success"] for r in results)
+    results[1]["foods"].clear()  # followers get their own copy
+    assert results[2]["foods"]
+
+
+def test_concurrent_identical_async_requests_coalesce(mock_server):
+    mock_server.delay = 0.2
+    client = _client(mock_server)
+
+    async def scenario():
+        results = await asyncio.gather(
+            *[client.aanalyze("pizza phô mai") for _ in range(8)],
+            client.aanalyze("salad cá ngừ"),
+        )
+        await http_client.aclose_clients()
+        return results
+
+    results = asyncio.run(scenario())
+    assert mock_server.requests == 2  # one per distinct input
+    assert all(r == results[0] for r in results[:8])
+
+
+def _pipeline(server, monkeypatch, scope):
+    from nutrition_pipeline_advanced import NutritionPipelineAdvanced
+
+    monkeypatch.setattr(Config, "LLM_FALLBACK_SCOPE", scope)
+    pipeline = NutritionPipelineAdvanced(deterministic_weight=True)
+    pipeline.deepseek_client = _client(server)
+    monkeypatch.setattr(pipeline, "_persist_deepseek_pending", lambda *args: None)
+    monkeypatch.setattr(pipeline, "_persist_daily_totals", lambda: None)
+    return pipeline
+
+
+def test_segment_fallback_sends_only_unresolved_segments(mock_server, monkeypatch):
+    pipeline = _pipeline(mock_server, monkeypatch, "segment")
+    result = pipeline.process_input("2 tô phở bò, salad cá ngừ, pizza hải sản và 1 ly trà đá")
+    assert result["deepseek_trigger"] == "low_confidence"
+    # the unmatched segment rides along once a trigger fired
+    assert result["deepseek_input"] == "salad cá ngừ, pizza hải sản"
+    assert result["processing_method"] == "hybrid"
+    assert [f["food_name"] for f in result["foods"]] == ["phở bò", "salad cá ngừ", "pizza hải sản", "trà đá"]
+    assert result["foods"][0]["quantity_info"]["amount"] == 2  # local result kept as is
+    assert mock_server.requests == 1
+
+    # Confident foods next to a segment that is no food (or unknown): answered locally
+    for text in ("sáng nay ăn phở bò, ngon lắm", "tôi ăn phở bò rồi đi làm", "2 tô phở bò, pizza hải sản"):
+        result = pipeline.process_input(text)
+        assert result["deepseek_trigger"] == "confidence_ok" and not result["deepseek_used"], text
+    assert mock_server.requests == 1
+
+
+def test_low_confidence_segment_vs_sentence_scope(mock_server, monkeypatch):
+    text = "2 tô phở bò, 250g cá và 1 ly trà đá"
+    segment = _pipeline(mock_server, monkeypatch, "segment").process_input(text)
+    assert segment["deepseek_trigger"] == "low_confidence"
+    assert segment["deepseek_input"] == "250g cá"
+    assert [f["food_name"] for f in segment["foods"]] == ["phở bò", "250g cá", "trà đá"]
+
+    sentence = _pipeline(mock_server, monkeypatch, "sentence").process_input(text)
+    assert sentence["deepseek_input"] == text
+    assert sentence["processing_method"] == "deepseek"  # local results discarded
+    assert [f["food_name"] for f in sentence["foods"]] == ["2 tô phở bò", "250g cá", "1 ly trà đá"]
+    # A segment without a food is no trigger in either scope
+    assert _pipeline(mock_server, monkeypatch, "sentence").process_input(
+        "phở bò, pizza hải sản")["deepseek_used"] is False
+
+
+def test_batcher_sends_concurrent_phrases_in_one_call(mock_server, monkeypatch):
+    monkeypatch.setattr(Config, "DEEPSEEK_BATCH_WINDOW_MS", 100)
+    pipeline = _pipeline(mock_server, monkeypatch, "segment")
+    texts = ["2 tô phở bò, salad cá ngừ", "250g cá và 1 ly trà đá", "salad cá ngừ"]
+    results = [None] * len(texts)
+    barrier = threading.Barrier(len(texts))
+
+    def call(i):
+        barrier.wait()
+        results[i] = pipeline.process_input(texts[i])
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(len(texts))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert mock_server.requests == 1
+    assert [[f["food_name"] for f in r["foods"]] for r in results] == [
+        ["phở bò", "salad cá ngừ"], ["250g cá", "trà đá"], ["salad cá ngừ"]]
+    assert all(r["processing_method"] == "hybrid" for r in results[:2])
+    stats = pipeline.deepseek_client.batcher.stats()
+    assert stats["batches"] == 1 and stats["items"] == 2 and stats["deduplicated"] == 1
+
+
+def test_food_stream_parser_emits_each_food_when_its_object_closes():
+    content = ('```json\n{"foods": [{"food_name": "a}\\"b", "quantity": {"amount": [1]}}, '
+               '{"food_name": "c"}], "analysis": "{\\"foods\\": [{}]}"}\n```')
+    parser = FoodStreamParser()
+    emitted = [(len(parser.content), food) for char in content for food in parser.feed(char)]
+    assert [food["food_name"] for _, food in emitted] == ['a}"b', "c"]
+    assert emitted[0][0] == content.index(', {"food_name": "c"') and emitted[1][0] < content.index("analysis")
+
+
+def test_streaming_analyze_yields_foods_before_completion(mock_server):
+    mock_server.token_delay = 0.004
+    client = _client(mock_server)
+    started = time.perf_counter()
+    stream = client.analyze_stream("pizza hải sản, trà sữa và bánh tacos")
+    arrivals = []
+    while True:
+        try:
+            arrivals.append((time.perf_counter() - started, next(stream)["food_name"]))
+        except StopIteration as stop:
+            result, finished = stop.value, time.perf_counter() - started
+            break
+    assert [name for _, name in arrivals] == ["pizza hải sản", "trà sữa", "bánh tacos"]
+    assert arrivals[0][0] < finished / 2  # first food long before the completion ends
+    assert result["success"] and len(result["foods"]) == 3
+    assert client.analyze("pizza phô mai")["success"]
+    assert mock_server.requests == 2 and mock_server.connections == 1  # stream drained -> reused
+
+
+def test_analyze_stream_endpoint_emits_local_then_llm_foods(mock_server, monkeypatch, tmp_path):
+    import main
+    from dbs import DailyLogDB
+
+    pipeline = _pipeline(mock_server, monkeypatch, "segment")
+    monkeypatch.setattr(main, "pipeline", pipeline)
+    monkeypatch.setattr(main, "daily_log_db", DailyLogDB(tmp_path / "logs.db"))
+    request = main.AnalyzeRequest(patientId="p1", text="2 tô phở bò, salad cá ngừ và 1 ly trà đá",
+                                  dateKey="2025-01-03")
+
+    async def scenario():
+        response = await main.analyze_stream(request)
+        lines = [line async for line in response.body_iterator]
+        return response.media_type, [json.loads(line) for line in lines]
+
+    media_type, events = asyncio.run(scenario())
+    assert media_type == "application/x-ndjson"
+    assert [(e["type"], e.get("source"), e.get("food", {}).get("foodName")) for e in events] == [
+        ("food", "local", "phở bò"), ("food", "local", "trà đá"),
+        ("food", "deepseek", "salad cá ngừ"), ("done", None, None)]
+    done = events[-1]
+    assert done["success"] and done["meta"]["processingMethod"] == "hybrid"
+    assert [f["foodName"] for f in done["data"]["foods"]] == ["phở bò", "salad cá ngừ", "trà đá"]
+    entry = main.daily_log_db.get_daily_log("p1", "2025-01-03")["entries"][0]
+    assert entry["entryId"] == done["meta"]["entryId"] and len(entry["foods"]) == 3
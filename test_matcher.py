@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+Tests cho FoodNameMatcher / FoodExtractor
+"""
+import random
+import re
+import sys
+import os
+import threading
+import unicodedata
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from vietnamese_foods_extended import (
+    VIETNAMESE_FOODS_NUTRITION,
+    FoodExtractor,
+    FoodNameMatcher,
+    normalize_vietnamese,
+)
+from test_cases_extended import EXTENDED_TEST_CASES
+
+
+def _regex_normalize(text):
+    """Reference: the original multi-pass re.sub normalizer."""
+    if not text:
+        return ""
+    text = text.lower()
+    text = re.sub(r'[àáảãạăắằẳẵặâấầẩẫậ]', 'a', text)
+    text = re.sub(r'[đ]', 'd', text)
+    text = re.sub(r'[èéẻẽẹêếềểễệ]', 'e', text)
+    text = re.sub(r'[ìíỉĩị]', 'i', text)
+    text = re.sub(r'[òóỏõọôốồổỗộơớờởỡợ]', 'o', text)
+    text = re.sub(r'[ùúủũụưứừửữự]', 'u', text)
+    text = re.sub(r'[ỳýỷỹỵ]', 'y', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def _normalizer_corpus():
+    texts = [text for text, _ in EXTENDED_TEST_CASES]
+    for food_name, data in VIETNAMESE_FOODS_NUTRITION.items():
+        texts.append(food_name)
+        texts.extend(data.get("aliases", []))
+    return texts
+
+
+def test_normalizer_matches_regex_reference():
+    matcher = FoodNameMatcher()
+    for text in _normalizer_corpus():
+        for variant in (text, text.upper(), f"  {text}\t\n{text} "):
+            assert matcher.normalize_text(variant) == _regex_normalize(variant), variant
+
+
+def test_normalizer_handles_decomposed_input():
+    for text in _normalizer_corpus():
+        decomposed = unicodedata.normalize("NFD", text)
+        assert normalize_vietnamese(decomposed) == _regex_normalize(text), text
+    assert normalize_vietnamese("PHỞ BÒ") == "pho bo"
+
+
+def _linear_token_match(matcher, text):
+    """Reference implementation: full scan over alias_map then food_map."""
+    input_tokens = matcher.normalize_text(text).split()
+    best = (None, 0.0)
+    for name_map in (matcher.alias_map, matcher.food_map):
+        for key, food_name in name_map.items():
+            key_tokens = key.split()
+            if all(tok in input_tokens for tok in key_tokens):
+                confidence = matcher._token_confidence(len(key_tokens), len(input_tokens))
+                if confidence > best[1]:
+                    best = (food_name, confidence)
+        if best[0]:
+            break
+    return best
+
+
+def test_token_index_matches_linear_scan():
+    matcher = FoodNameMatcher()
+    inputs = [text for text, _ in EXTENDED_TEST_CASES]
+    inputs += [f"2 to {alias} va tra" for alias in list(matcher.alias_map)[:300]]
+    for text in inputs:
+        normalized = matcher.normalize_text(text)
+        if not normalized or normalized in matcher.alias_map or normalized in matcher.food_map:
+            continue
+        input_tokens = normalized.split()
+        index = matcher._index
+        indexed = matcher._match_token_subset(
+            input_tokens, index.alias_token_index, index.alias_map, index.alias_rank, index.key_tokens
+        )
+        if not indexed[0]:
+            indexed = matcher._match_token_subset(
+                input_tokens, index.food_token_index, index.food_map, index.food_rank, index.key_tokens
+            )
+        assert indexed == _linear_token_match(matcher, text), text
+
+
+def test_add_alias_is_searchable():
+    matcher = FoodNameMatcher()
+    matcher.add_alias("mon thu nghiem dac biet", "phở bò")
+    assert matcher.find_food("mon thu nghiem dac biet") == ("phở bò", 0.95)
+    assert matcher.find_food("2 bat mon thu nghiem dac biet")[0] == "phở bò"
+
+
+def test_learn_applies_approval_without_rebuild():
+    extractor = FoodExtractor(mode="scan")
+    matcher = extractor.matcher
+    extractor.extract("phở bò")  # build the scanner before the update
+    index = matcher._index
+    try:
+        matcher.learn("món duyệt thử", {"calories_per_100g": 100, "aliases": ["mon duyet thu a"]},
+                      aliases=["mon duyet thu b"])
+        matcher.learn("phở bò", None, aliases=["pho duyet thu"])
+        assert matcher._index is index  # delta applied in place, no rebuild
+        assert matcher.find_food("mon duyet thu a") == ("món duyệt thử", 0.95)
+        assert matcher.find_food("mon duyet thu b") == ("món duyệt thử", 0.95)
+        assert matcher.find_food("pho duyet thu") == ("phở bò", 0.95)
+        foods = extractor.extract("trà đá mon duyet thu b")
+        assert [f['food_name'] for f in foods] == ["trà đá", "món duyệt thử"]
+    finally:
+        VIETNAMESE_FOODS_NUTRITION.pop("món duyệt thử", None)
+        VIETNAMESE_FOODS_NUTRITION["phở bò"]["aliases"].remove("pho duyet thu")
+
+
+def test_lookups_during_concurrent_updates():
+    matcher = FoodNameMatcher()
+    errors = []
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            try:
+                for text in ("2 to pho bo", "com tam suon", "phoo bo", "alias dong thoi 7"):
+                    matcher.find_food(text)
+            except Exception as exc:  # pragma: no cover - reported below
+                errors.append(exc)
+                return
+
+    threads = [threading.Thread(target=reader) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for i in range(2000):
+        matcher.add_alias(f"alias dong thoi {i}", "phở bò")
+        if i % 500 == 0:
+            matcher.build_index()
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert matcher.find_food("alias dong thoi 1999") == ("phở bò", 0.95)
+
+
+def test_prebuilt_artifact_matches_built_index(tmp_path, monkeypatch):
+    import food_index
+    import vietnamese_foods_extended
+
+    path = food_index.build_artifact(tmp_path / "food_index.pkl")
+    built = FoodNameMatcher(use_prebuilt=False)
+    original_load = food_index.load_artifact
+    loaded = []
+
+    def spy_load():
+        loaded.append(original_load(path))
+        return loaded[-1]
+
+    monkeypatch.setattr(food_index, "load_artifact", spy_load)
+    monkeypatch.setattr(vietnamese_foods_extended, "_LEARNED_LOADED", False)
+    matcher = FoodNameMatcher()
+    assert loaded and matcher._index is loaded[0]["index"]
+    assert matcher.alias_map == built.alias_map
+    for text, _ in EXTENDED_TEST_CASES[:100]:
+        assert matcher.find_food(text) == built.find_food(text), text
+
+    # Stale when the learned tables change after the build.
+    monkeypatch.setattr(food_index, "_learned_state", lambda db_path: "changed")
+    assert original_load(path) is None
+
+
+def test_find_candidates_top_is_find_food():
+    matcher = FoodNameMatcher()
+    for text, _ in EXTENDED_TEST_CASES:
+        candidates = matcher.find_candidates(text, k=3)
+        top = (candidates[0]["food_name"], candidates[0]["confidence"]) if candidates else (None, 0.0)
+        assert top == matcher.find_food(text), text
+        assert len(candidates) <= 3
+        assert len({c["food_name"] for c in candidates}) == len(candidates)
+        assert [c["confidence"] for c in candidates[1:]] == sorted((c["confidence"] for c in candidates[1:]), reverse=True)
+
+    assert matcher.find_candidates("phở bò")[0]["provenance"] in ("exact_alias", "exact_name")
+    assert matcher.find_candidates("phoo bo")[0]["provenance"] == "typo"
+    near_tie = matcher.find_candidates("cơm rang dưa bò")
+    assert [c["food_name"] for c in near_tie[:2]] == ["cơm trắng", "thịt bò"]
+    assert near_tie[0]["confidence"] == near_tie[1]["confidence"]
+
+
+def test_clear_margin_avoids_deepseek():
+    from nutrition_pipeline_advanced import NutritionPipelineAdvanced
+
+    pipeline = NutritionPipelineAdvanced()
+    pipeline.deepseek_client.is_available = lambda: True
+
+    def decide(text):
+        extracted = pipeline.extractor.extract(text)
+        analyzed = [pipeline._analyze_food(food) for food in extracted]
+        return pipeline._should_use_deepseek(extracted, analyzed)
+
+    assert decide("ba tô phở") == (False, "clear_margin")  # only quantity words left over
+    assert decide("pizza phô mai") == (True, "low_confidence")  # unexplained tokens
+    assert decide("cơm rang dưa bò") == (True, "low_confidence")  # near-tie
+    assert decide("salad cá ngừ") == (True, "low_confidence")  # keyword fallback
+    pipeline.candidate_margin = 0
+    assert decide("ba tô phở") == (True, "low_confidence")
+
+
+def test_deterministic_weight_is_repeatable(monkeypatch):
+    from config import Config
+    from vietnamese_foods_extended import estimate_weight, estimate_weight_range
+
+    bowl = {"type": "relative", "amount": 2, "unit": "tô", "confidence": 0.8}
+    assert estimate_weight(bowl, "noodle", deterministic=True) == 500 * 0.8 * 2
+    assert estimate_weight_range(bowl, "noodle") == (400 * 0.8 * 2, 600 * 0.8 * 2)
+    assert estimate_weight_range({"type": "exact", "amount": 150, "unit": "g"}) == (150, 150)
+    low, high = estimate_weight_range(bowl, "noodle")
+    assert all(low <= estimate_weight(bowl, "noodle", deterministic=False) <= high for _ in range(50))
+
+    monkeypatch.setattr(Config, "DETERMINISTIC_WEIGHT", True)
+    extractor = FoodExtractor()
+    runs = [[(f["food_name"], estimate_weight(f["quantity_info"], VIETNAMESE_FOODS_NUTRITION[f["food_name"]].get("category")))
+             for f in extractor.extract(text)] for text in ("2 tô phở bò và 1 ly trà đá",) * 5]
+    assert all(run == runs[0] for run in runs)
+
+
+def _per_word_sub(text, words, repl):
+    """Reference: the original one-re.sub-per-word loop."""
+    for word in words:
+        text = re.sub(rf'\b{re.escape(word)}\b', repl, text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def test_word_alternations_match_per_word_loop():
+    extractor = FoodExtractor()
+    rng = random.Random(3)
+    vocab = [*FoodExtractor.STOP_WORDS, *FoodExtractor.UNNECESSARY_WORDS,
+             "phở", "bò", "cơm", "2", "bát", "hôm", "nay", "ănn", ",", "miếngg"]
+    texts = [text.lower() for text, _ in EXTENDED_TEST_CASES]
+    for _ in range(3000):
+        words = [rng.choice(vocab) for _ in range(rng.randint(1, 8))]
+        texts.append("".join(word + rng.choice(["", " ", "  ", ","]) for word in words))
+
+    def collapse(text):
+        return extractor.WHITESPACE_RE.sub(' ', text).strip()
+
+    for text in texts:
+        assert collapse(extractor.stop_words_re.sub(' ', text)) == \
+            _per_word_sub(text, FoodExtractor.STOP_WORDS, ' '), text
+        assert collapse(extractor.unnecessary_words_re.sub('', text)) == \
+            _per_word_sub(text, FoodExtractor.UNNECESSARY_WORDS, ''), text
+
+
+def test_scan_mode_finds_foods_without_separators():
+    extractor = FoodExtractor(mode="scan")
+    foods = extractor.extract("hôm nay ăn 2 tô phở bò trà đá 1 ổ bánh mì")
+    assert [f['food_name'] for f in foods] == ["phở bò", "trà đá", "bánh mì"]
+    assert foods[0]['quantity_info']['amount'] == 2
+    assert foods[0]['quantity_info']['unit'] == "tô"
+    assert foods[2]['quantity_info']['unit'] == "ổ"
+
+
+def test_scan_mode_assigns_trailing_quantity_and_no_sugar():
+    extractor = FoodExtractor(mode="scan")
+    foods = extractor.extract("cà phê sữa không đường ức gà 150g")
+    assert [f['food_name'] for f in foods] == ["cà phê sữa", "ức gà"]
+    assert foods[0]['no_sugar'] and not foods[1]['no_sugar']
+    assert foods[1]['quantity_info']['type'] == "exact"
+    assert foods[1]['quantity_info']['amount'] == 150
+
+
+def test_typo_correction_resolves_above_deepseek_threshold():
+    matcher = FoodNameMatcher()
+    for text, expected in [("phoo bo", "phở bò"), ("bun chaa", "bún chả"), ("banh mii", "bánh mì")]:
+        food_name, confidence = matcher.find_food(text)
+        assert food_name == expected, text
+        assert 0.6 <= confidence < 0.95, text
+
+
+def test_typo_correction_ignores_noise():
+    matcher = FoodNameMatcher()
+    assert matcher.find_food("xyz abc") == (None, 0.0)
+    assert matcher.typo_candidates("pho") == [("pho", 0)]
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Tests cho deadline, retry, circuit breaker và admission limiter của client DeepSeek
+(mock có giả lập sự cố)
+"""
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import http_client
+from deepseek_client import DeepSeekClient
+from mock_deepseek_server import MockDeepSeekServer
+from resilience import AdmissionLimiter, CircuitBreaker, Overloaded, current_deadline, deadline_scope
+
+
+@pytest.fixture
+def mock_server():
+    http_client.close_clients()
+    server = MockDeepSeekServer().start()
+    yield server
+    server.stop()
+    http_client.close_clients()
+
+
+def _client(server, breaker=None):
+    client = DeepSeekClient()
+    client.api_key = "test-key"
+    client.base_url = server.base_url
+    client.response_cache = None
+    client.retry_base_delay = 0.01
+    client.retry_max_delay = 0.05
+    client.breaker = breaker or CircuitBreaker(failure_threshold=5, reset_timeout=30)
+    return client
+
+
+def test_transient_errors_are_retried(mock_server):
+    client = _client(mock_server)
+    mock_server.inject(503, "drop")
+    result = client.analyze("pizza phô mai")
+    assert result["success"] and mock_server.requests == 3
+    assert client.breaker.stats()["state"] == "closed"
+
+
+def test_client_errors_are_not_retried(mock_server):
+    client = _client(mock_server)
+    mock_server.inject(400)
+    result = client.analyze("pizza phô mai")
+    assert not result["success"] and "400" in result["error"]
+    assert mock_server.requests == 1
+    assert client.breaker.stats()["consecutiveFailures"] == 0  # upstream answered
+
+
+def test_deadline_bounds_a_hanging_upstream(mock_server):
+    client = _client(mock_server)
+    mock_server.inject(2.0)
+    started = time.perf_counter()
+    with deadline_scope(0.4):
+        result = client.analyze("pizza phô mai")
+    assert time.perf_counter() - started < 1.0
+    assert not result["success"]
+    assert mock_server.requests == 1  # no budget left for a retry
+
+
+def test_read_timeout_capped_by_the_deadline_is_not_cached(mock_server):
+    from caching import TieredResponseCache
+
+    client = _client(mock_server)
+    client.response_cache = TieredResponseCache(memory_size=8)
+    mock_server.inject(1.5)
+    with deadline_scope(0.5):
+        assert not client.analyze("pizza phô mai")["success"]  # requests.ReadTimeout
+    result = client.analyze("pizza phô mai")  # healthy upstream, no deadline
+    assert result["success"] and mock_server.requests == 2
+
+
+def test_batched_call_runs_under_the_callers_deadline(mock_server, monkeypatch):
+    from config import Config
+
+    monkeypatch.setattr(Config, "DEEPSEEK_BATCH_WINDOW_MS", 20)
+    client = _client(mock_server)
+    client.limiter = AdmissionLimiter("food", max_concurrent=2, max_queue=2, max_wait=1)
+    mock_server.inject(3.0)
+    started = time.perf_counter()
+    with deadline_scope(0.5):
+        results = client.analyze_phrases(["salad cá ngừ", "bánh tacos"])
+    assert not any(r["success"] for r in results)
+    # the batch thread gave up with the caller (not after REQUEST_TIMEOUT) and freed its slot
+    while client.limiter.stats()["active"] and time.perf_counter() - started < 2:
+        time.sleep(0.02)
+    assert client.limiter.stats()["active"] == 0 and time.perf_counter() - started < 1.5
+    assert mock_server.requests == 1 and client.batcher.stats()["batches"] == 1
+
+
+def test_deadline_scope_keeps_the_earlier_deadline():
+    with deadline_scope(5) as outer:
+        with deadline_scope(60) as inner:
+            assert inner is outer and current_deadline() is outer
+        with deadline_scope(1) as tighter:
+            assert tighter.expires_at < outer.expires_at
+    assert current_deadline() is None
+
+
+def test_breaker_trips_short_circuits_and_recovers(mock_server):
+    now = [0.0]
+    client = _client(mock_server, CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0]))
+    client.max_attempts = 1
+    mock_server.inject(503, 503)
+    assert not client.analyze("món 1")["success"]
+    assert not client.analyze("món 2")["success"]
+    assert client.breaker.stats()["state"] == "open" and client.breaker.trips == 1
+
+    result = client.analyze("món 3")
+    assert "circuit breaker is open" in result["error"]
+    assert mock_server.requests == 2 and client.breaker.stats()["shortCircuited"] == 1
+
+    now[0] += 10  # half-open: one probe goes through and closes the breaker
+    assert client.breaker.state == "half_open"
+    assert client.analyze("món 4")["success"]
+    assert client.breaker.state == "closed" and mock_server.requests == 3
+
+
+def test_probe_without_a_verdict_does_not_wedge_the_breaker():
+    from resilience import Deadline, DeadlineExceeded, acall_with_retries, call_with_retries
+
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=lambda: now[0])
+    breaker.record_failure()
+    now[0] += 10
+
+    async def hang(deadline):
+        await asyncio.sleep(10)
+
+    async def cancelled_probe():
+        task = asyncio.ensure_future(acall_with_retries(hang, Deadline(30), breaker=breaker))
+        await asyncio.sleep(0.05)
+        assert breaker.is_open()  # probe in flight: others short-circuit
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancelled_probe())
+    assert breaker.state == "half_open" and breaker.allow()  # next call may probe
+    breaker.release_probe()
+
+    def out_of_budget(deadline):
+        raise DeadlineExceeded("deadline exceeded")
+
+    with pytest.raises(DeadlineExceeded):
+        call_with_retries(out_of_budget, Deadline(30), breaker=breaker)
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_pipeline_is_local_only_while_breaker_open(mock_server, monkeypatch):
+    from nutrition_pipeline_advanced import NutritionPipelineAdvanced
+
+    pipeline = NutritionPipelineAdvanced(deterministic_weight=True)
+    monkeypatch.setattr(pipeline, "_persist_daily_totals", lambda: None)
+    pipeline.deepseek_client = _client(mock_server, CircuitBreaker(failure_threshold=1, reset_timeout=30))
+    pipeline.deepseek_client.breaker.record_failure()
+    result = pipeline.process_input("2 tô phở bò, salad cá ngừ")
+    assert result["deepseek_trigger"] == "circuit_open" and not result["deepseek_used"]
+    assert result["processing_method"] == "local"
+    assert [f["food_name"] for f in result["foods"]] == ["phở bò", "cá chiên"]
+    assert mock_server.requests == 0
+
+
+def test_async_path_retries(mock_server):
+    client = _client(mock_server)
+    mock_server.inject(502)
+
+    async def scenario():
+        result = await client.aanalyze("salad cá ngừ")
+        await http_client.aclose_clients()
+        return result
+
+    assert asyncio.run(scenario())["success"]
+    assert mock_server.requests == 2
+
+
+def test_limiter_queues_hands_off_and_rejects():
+    limiter = AdmissionLimiter("t", max_concurrent=1, max_queue=1, max_wait=2.0)
+    limiter.acquire()
+    order = []
+
+    def waiter():
+        with limiter.slot():
+            order.append("waiter")
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    while limiter.stats()["queued"] < 1:
+        time.sleep(0.01)
+    started = time.perf_counter()
+    with pytest.raises(Overloaded) as exc:
+        limiter.acquire()  # queue full: rejected without waiting
+    assert time.perf_counter() - started < 0.1 and exc.value.retry_after == 2
+    limiter.release()  # slot goes straight to the queued waiter
+    thread.join()
+    assert order == ["waiter"]
+    stats = limiter.stats()
+    assert stats["active"] == 0 and stats["queued"] == 0
+    assert stats["admitted"] == 2 and stats["rejected"] == 1 and stats["maxWaitMs"] > 0
+
+
+def test_limiter_wait_is_bounded_by_deadline_and_async_waiters_get_slots():
+    limiter = AdmissionLimiter("t", max_concurrent=1, max_queue=4, max_wait=5.0)
+    limiter.acquire()
+    started = time.perf_counter()
+    with pytest.raises(Overloaded):
+        limiter.acquire(timeout=0.1)
+    assert time.perf_counter() - started < 1.0
+    assert limiter.stats()["timedOut"] == 1 and limiter.stats()["queued"] == 0
+
+    async def scenario():
+        async def use(i):
+            async with limiter.aslot():
+                await asyncio.sleep(0.01)
+                return i
+
+        tasks = [asyncio.ensure_future(use(i)) for i in range(3)]
+        await asyncio.sleep(0.05)
+        assert limiter.stats()["queued"] == 3
+        threading.Timer(0.01, limiter.release).start()  # released from another thread
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(scenario()) == [0, 1, 2]
+    assert limiter.stats()["active"] == 0
+
+
+def test_pipeline_is_local_only_when_llm_overloaded(mock_server, monkeypatch):
+    from nutrition_pipeline_advanced import NutritionPipelineAdvanced
+
+    pipeline = NutritionPipelineAdvanced(deterministic_weight=True)
+    monkeypatch.setattr(pipeline, "_persist_daily_totals", lambda: None)
+    pipeline.deepseek_client = _client(mock_server)
+    pipeline.deepseek_client.limiter = AdmissionLimiter("food", max_concurrent=1, max_queue=0, max_wait=1)
+    pipeline.deepseek_client.limiter.acquire()
+    result = pipeline.process_input("2 tô phở bò, salad cá ngừ")
+    assert result["deepseek_trigger"] == "overloaded" and not result["deepseek_used"]
+    assert [f["food_name"] for f in result["foods"]] == ["phở bò", "cá chiên"]
+    assert mock_server.requests == 0
+
+    pipeline.deepseek_client.limiter.release()  # overload is not cached
+    assert pipeline.process_input("2 tô phở bò, salad cá ngừ")["deepseek_used"]
+    assert mock_server.requests == 1
+
+
+def test_match_returns_503_with_retry_after_when_lab_pool_is_full(mock_server, monkeypatch):
+    import io
+
+    from starlette.datastructures import Headers, UploadFile
+
+    import main
+    import server_ai
+    from config import Config
+
+    monkeypatch.setattr(Config, "DEEPSEEK_API_KEY", "test-key")
+    monkeypatch.setattr(Config, "DEEPSEEK_BASE_URL", mock_server.base_url)
+    monkeypatch.setattr(server_ai, "pdf_bytes_to_text", lambda data: "HbA1c 6.1 %")
+    limiter = AdmissionLimiter("lab", max_concurrent=1, max_queue=0, max_wait=3)
+    monkeypatch.setitem(server_ai.llm_limiters, "lab", limiter)
+    metrics_json = '{"data": [{"metric_id": 6, "name": "HbA1c", "unit": "%"}]}'
+
+    async def match():
+        pdf = UploadFile(io.BytesIO(b"%PDF-1.4"), filename="lab.pdf",
+                         headers=Headers({"content-type": "application/pdf"}))
+        response = await server_ai.match_metrics(metrics_json=metrics_json, pdf=pdf)
+        await http_client.aclose_clients()
+        return response
+
+    limiter.acquire()
+    response = asyncio.run(match())
+    assert response.status_code == 503 and response.headers["Retry-After"] == "3"
+    assert mock_server.requests == 0
+    limiter.release()
+    assert asyncio.run(match()).status_code == 200
+    assert limiter.stats()["rejected"] == 1 and limiter.stats()["admitted"] == 2
+    assert set(main.metrics()["data"]["llmAdmission"]) == {"food", "lab"}
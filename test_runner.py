@@ -25,7 +25,8 @@ except ImportError as e:
 
 class AdvancedTestRunner:
     def __init__(self):
-        self.pipeline = NutritionPipelineAdvanced()
+        # Gram ước lượng cố định để test_results.json so sánh được giữa các lần chạy
+        self.pipeline = NutritionPipelineAdvanced(deterministic_weight=True)
         self.results = []
         self.summary = {
             "total": 0,
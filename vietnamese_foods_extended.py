@@ -1,11 +1,36 @@
 import re
 import json
+import copy
+import unicodedata
+from functools import lru_cache
 from typing import Dict, List, Tuple, Optional, Any
 import random
+import threading
+from collections import deque
+from itertools import islice, product
+
+from caching import LRUCache
+from config import Config
 
 # Prevent repeated DB reads when multiple matchers are created.
 _LEARNED_LOADED = False
 
+# Bumped whenever the dataset or a matcher index changes (learned foods/aliases,
+# add_food/add_alias/learn, rebuilds); caches of derived results key on it.
+_DATASET_VERSION = 0
+_DATASET_VERSION_LOCK = threading.Lock()
+
+
+def get_dataset_version() -> int:
+    return _DATASET_VERSION
+
+
+def bump_dataset_version() -> int:
+    global _DATASET_VERSION
+    with _DATASET_VERSION_LOCK:
+        _DATASET_VERSION += 1
+        return _DATASET_VERSION
+
 # Database món ăn với nhiều biến thể chính tả
 VIETNAMESE_FOODS_NUTRITION = {
     # === CƠM VÀ MÓN CHÍNH ===
@@ -2690,64 +2715,245 @@ def load_learned_foods(force: bool = False) -> None:
 
     # Merge learned foods into the in-memory dataset.
     for food_name, food_data in (learned_foods or {}).items():
-        if not food_name:
-            continue
-        if not isinstance(food_data, dict):
-            food_data = {}
-
-        existing = VIETNAMESE_FOODS_NUTRITION.get(food_name)
-        if isinstance(existing, dict):
-            existing_aliases = existing.get("aliases")
-            if not isinstance(existing_aliases, list):
-                existing_aliases = []
-            incoming_aliases = food_data.get("aliases", [])
-            if isinstance(incoming_aliases, list):
-                for alias in incoming_aliases:
-                    if alias and alias not in existing_aliases:
-                        existing_aliases.append(alias)
-            if food_name not in existing_aliases:
-                existing_aliases.append(food_name)
-            existing["aliases"] = existing_aliases
-            if not existing.get("category") and food_data.get("category"):
-                existing["category"] = food_data["category"]
-            VIETNAMESE_FOODS_NUTRITION[food_name] = existing
-        else:
-            data = dict(food_data)
-            aliases = data.get("aliases")
-            if not isinstance(aliases, list):
-                aliases = []
-            if food_name not in aliases:
-                aliases.append(food_name)
-            data["aliases"] = aliases
-            data.setdefault("category", "custom")
-            VIETNAMESE_FOODS_NUTRITION[food_name] = data
+        merge_learned_food(food_name, food_data)
 
     # Merge learned aliases into canonical foods.
     for mapping in learned_aliases or []:
-        alias = (mapping.get("alias") or "").strip()
-        canonical = (mapping.get("canonical_name") or "").strip()
-        if not alias or not canonical:
-            continue
-        if canonical not in VIETNAMESE_FOODS_NUTRITION:
-            continue
-        canonical_data = VIETNAMESE_FOODS_NUTRITION.get(canonical, {})
-        if not isinstance(canonical_data, dict):
-            continue
-        aliases = canonical_data.get("aliases")
+        merge_learned_alias(mapping.get("alias"), mapping.get("canonical_name"))
+
+    _LEARNED_LOADED = True
+    bump_dataset_version()
+
+
+def merge_learned_food(food_name: str, food_data: Optional[dict]) -> None:
+    """
+    Merge one learned food into `VIETNAMESE_FOODS_NUTRITION`.
+
+    Existing foods only gain aliases (and a missing category); new foods are added as-is.
+    """
+    if not food_name:
+        return
+    if not isinstance(food_data, dict):
+        food_data = {}
+
+    existing = VIETNAMESE_FOODS_NUTRITION.get(food_name)
+    if isinstance(existing, dict):
+        existing_aliases = existing.get("aliases")
+        if not isinstance(existing_aliases, list):
+            existing_aliases = []
+        incoming_aliases = food_data.get("aliases", [])
+        if isinstance(incoming_aliases, list):
+            for alias in incoming_aliases:
+                if alias and alias not in existing_aliases:
+                    existing_aliases.append(alias)
+        if food_name not in existing_aliases:
+            existing_aliases.append(food_name)
+        existing["aliases"] = existing_aliases
+        if not existing.get("category") and food_data.get("category"):
+            existing["category"] = food_data["category"]
+        VIETNAMESE_FOODS_NUTRITION[food_name] = existing
+    else:
+        data = dict(food_data)
+        aliases = data.get("aliases")
         if not isinstance(aliases, list):
             aliases = []
-        if alias not in aliases:
-            aliases.append(alias)
-        canonical_data["aliases"] = aliases
-        VIETNAMESE_FOODS_NUTRITION[canonical] = canonical_data
+        if food_name not in aliases:
+            aliases.append(food_name)
+        data["aliases"] = aliases
+        data.setdefault("category", "custom")
+        VIETNAMESE_FOODS_NUTRITION[food_name] = data
+
+
+def merge_learned_alias(alias: str, canonical: str) -> bool:
+    """Attach a learned alias to an existing canonical food. Returns False if skipped."""
+    alias = (alias or "").strip()
+    canonical = (canonical or "").strip()
+    if not alias or not canonical:
+        return False
+    canonical_data = VIETNAMESE_FOODS_NUTRITION.get(canonical)
+    if not isinstance(canonical_data, dict):
+        return False
+    aliases = canonical_data.get("aliases")
+    if not isinstance(aliases, list):
+        aliases = []
+    if alias not in aliases:
+        aliases.append(alias)
+    canonical_data["aliases"] = aliases
+    VIETNAMESE_FOODS_NUTRITION[canonical] = canonical_data
+    return True
+
+
+# Bảng bỏ dấu tiếng Việt (chữ thường) cho str.translate
+_VIETNAMESE_DIACRITICS = {
+    "a": "àáảãạăắằẳẵặâấầẩẫậ",
+    "d": "đ",
+    "e": "èéẻẽẹêếềểễệ",
+    "i": "ìíỉĩị",
+    "o": "òóỏõọôốồổỗộơớờởỡợ",
+    "u": "ùúủũụưứừửữự",
+    "y": "ỳýỷỹỵ",
+}
+_DIACRITIC_TABLE = str.maketrans(
+    {char: base for base, chars in _VIETNAMESE_DIACRITICS.items() for char in chars}
+)
+NORMALIZE_CACHE_SIZE = 16384
 
-    _LEARNED_LOADED = True
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_vietnamese(text: str) -> str:
+    """
+    Lowercase, strip Vietnamese diacritics and collapse whitespace in one pass.
+
+    Decomposed (NFD) input is recomposed first so it normalizes like NFC text.
+    """
+    text = text.lower()
+    if not text.isascii():
+        text = unicodedata.normalize("NFC", text).translate(_DIACRITIC_TABLE)
+    return " ".join(text.split())
+
+
+@lru_cache(maxsize=1024)
+def _compile_cached(pattern: str) -> "re.Pattern":
+    """Private cache for per-(amount, unit) patterns, independent of `re`'s shared cache."""
+    return re.compile(pattern)
+
+
+def _delete_variants(word: str, max_distance: int) -> set:
+    """All strings obtained by deleting up to `max_distance` characters (SymSpell)."""
+    variants = set()
+    frontier = {word}
+    for _ in range(max_distance):
+        next_frontier = set()
+        for item in frontier:
+            if len(item) <= 1:
+                continue
+            for i in range(len(item)):
+                next_frontier.add(item[:i] + item[i + 1:])
+        next_frontier -= variants
+        variants |= next_frontier
+        frontier = next_frontier
+    return variants
+
+
+def _edit_distance(a: str, b: str) -> int:
+    """Optimal string alignment (Damerau-Levenshtein with adjacent transpositions)."""
+    prev2: List[int] = []
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        prev2, prev = prev, cur
+    return prev[len(b)]
+
+
+class _MatcherIndex:
+    """
+    Search structures of a FoodNameMatcher.
+
+    A rebuild fills a fresh instance and swaps it in with a single assignment.
+    Incremental updates go into the live instance copy-on-write: posting lists
+    and delete sets are replaced, never mutated, and a key gets its rank and
+    tokens before it appears in any posting list.
+    """
+
+    def __init__(self, typo_max_distance: int):
+        self.typo_max_distance = typo_max_distance
+        # Off while a rebuild fills a private instance (appending is cheaper).
+        self.copy_on_write = False
+        self.food_map: Dict[str, str] = {}
+        self.alias_map: Dict[str, str] = {}
+        # Inverted index token -> normalized keys, so fuzzy lookups only score
+        # keys sharing at least one token with the input.
+        self.food_token_index: Dict[str, List[str]] = {}
+        self.alias_token_index: Dict[str, List[str]] = {}
+        # Insertion rank of each key; ties are broken by it so results match
+        # the original linear scan over `food_map` / `alias_map`.
+        self.food_rank: Dict[str, int] = {}
+        self.alias_rank: Dict[str, int] = {}
+        self.key_tokens: Dict[str, Tuple[str, ...]] = {}
+        # SymSpell: delete-variant -> vocabulary tokens (vocabulary = indexed tokens)
+        self.typo_deletes: Dict[str, set] = {}
+
+    def add_food(self, normalized_name: str, food_name: str) -> None:
+        is_new = normalized_name not in self.food_map
+        self.food_map[normalized_name] = food_name
+        if is_new:
+            self._add_key(normalized_name, self.food_token_index, self.food_rank)
+
+    def add_alias(self, normalized_alias: str, food_name: str) -> None:
+        is_new = normalized_alias not in self.alias_map
+        self.alias_map[normalized_alias] = food_name
+        if is_new:
+            self._add_key(normalized_alias, self.alias_token_index, self.alias_rank)
+
+    def _add_key(self, key: str, token_index: Dict[str, List[str]], rank_map: Dict[str, int]) -> None:
+        rank_map[key] = len(rank_map)
+        tokens = tuple(key.split())
+        self.key_tokens[key] = tokens
+        for tok in set(tokens):
+            if tok not in self.alias_token_index and tok not in self.food_token_index:
+                self._add_token_deletes(tok)
+            if self.copy_on_write:
+                token_index[tok] = [*token_index.get(tok, ()), key]
+            else:
+                token_index.setdefault(tok, []).append(key)
+
+    def _add_token_deletes(self, token: str) -> None:
+        for variant in _delete_variants(token, self.typo_max_distance):
+            if self.copy_on_write:
+                self.typo_deletes[variant] = self.typo_deletes.get(variant, frozenset()) | {token}
+            else:
+                self.typo_deletes.setdefault(variant, set()).add(token)
+
+    def token_frequency(self, token: str) -> int:
+        return len(self.alias_token_index.get(token, ())) + len(self.food_token_index.get(token, ()))
 
 
 class FoodNameMatcher:
     """Xử lý chính tả và tìm kiếm món ăn"""
+
+    # Sửa lỗi gõ (SymSpell): token >= 3 ký tự, tối đa 1 lỗi (<= 4 ký tự) hoặc 2 lỗi,
+    # chỉ nhận khi cả cụm sau khi sửa khớp đúng một tên/alias
+    TYPO_MIN_TOKEN_LEN = 3
+    TYPO_MAX_DISTANCE = 2
+    TYPO_PENALTY_PER_EDIT = 0.1
+    TYPO_MAX_CANDIDATES = 4
+    TYPO_MAX_COMBINATIONS = 64
+    # Từ khóa dự phòng khi không khớp tên/alias nào (độ tin cậy thấp)
+    KEYWORD_FOODS = {
+        "cơm": "cơm trắng",
+        "com": "cơm trắng",
+        "phở": "phở bò",
+        "pho": "phở bò",
+        "bún": "bún chả",
+        "bun": "bún chả",
+        "trứng": "trứng chiên",
+        "trung": "trứng chiên",
+        "sườn": "sườn nướng",
+        "suon": "sườn nướng",
+        "bánh mì": "bánh mì",
+        "banh mi": "bánh mì",
+        "cà phê": "cà phê sữa",
+        "ca phe": "cà phê sữa",
+        "nước cam": "nước cam",
+        "nuoc cam": "nước cam",
+        "thịt": "thịt bò",
+        "thit": "thịt bò",
+        "cá": "cá chiên",
+        "ca": "cá chiên"
+    }
     
-    def __init__(self):
+    def __init__(self, use_prebuilt: bool = True):
+        # Writers (build_index/add_*/learn) are serialized; readers never lock.
+        self._write_lock = threading.Lock()
+        # Bumped on every change so derived indexes (FoodScanner) know they are stale.
+        self.version = 0
+        if use_prebuilt and self._load_prebuilt_index():
+            return
         # Merge foods/aliases learned from DeepSeek (persisted in SQLite)
         # before building the search index.
         try:
@@ -2757,122 +2963,256 @@ class FoodNameMatcher:
             pass
         self.build_index()
     
+    def _load_prebuilt_index(self) -> bool:
+        """
+        Adopt the on-disk artifact (see food_index.py) instead of merging learned
+        foods and building the index. Only the first matcher of a process does this,
+        while the dataset is still exactly what the artifact was built from.
+        """
+        global _LEARNED_LOADED
+        if _LEARNED_LOADED:
+            return False
+        try:
+            from food_index import load_artifact
+            payload = load_artifact()
+        except Exception:
+            # Defensive: a bad artifact must never break startup.
+            return False
+        if not payload:
+            return False
+        VIETNAMESE_FOODS_NUTRITION.update(payload["dataset"])
+        _LEARNED_LOADED = True
+        self._index = payload["index"]
+        self.version += 1
+        bump_dataset_version()
+        return True
+
     def build_index(self):
         """Xây dựng index tìm kiếm"""
-        self.food_map = {}
-        self.alias_map = {}
-        
-        for food_name, data in VIETNAMESE_FOODS_NUTRITION.items():
-            # Thêm tên chính
-            normalized_name = self.normalize_text(food_name)
-            self.food_map[normalized_name] = food_name
-            
-            # Thêm các alias
-            if "aliases" in data:
-                for alias in data["aliases"]:
-                    normalized_alias = self.normalize_text(alias)
-                    self.alias_map[normalized_alias] = food_name
+        with self._write_lock:
+            index = _MatcherIndex(self.TYPO_MAX_DISTANCE)
+            for food_name, data in list(VIETNAMESE_FOODS_NUTRITION.items()):
+                self._index_entry(index, food_name, data)
+            # Swap in one assignment: in-flight lookups keep the old index.
+            index.copy_on_write = True
+            self._index = index
+            self.version += 1
+            bump_dataset_version()
+
+    def _index_entry(self, index, food_name, data):
+        # Thêm tên chính
+        normalized_name = self.normalize_text(food_name)
+        if normalized_name:
+            index.add_food(normalized_name, food_name)
+
+        # Thêm các alias
+        for alias in (data or {}).get("aliases", []) or []:
+            normalized_alias = self.normalize_text(alias)
+            if normalized_alias:
+                index.add_alias(normalized_alias, food_name)
+
+    @property
+    def food_map(self) -> Dict[str, str]:
+        return self._index.food_map
+
+    @property
+    def alias_map(self) -> Dict[str, str]:
+        return self._index.alias_map
+
+    @property
+    def food_token_index(self) -> Dict[str, List[str]]:
+        return self._index.food_token_index
+
+    @property
+    def alias_token_index(self) -> Dict[str, List[str]]:
+        return self._index.alias_token_index
     
     def normalize_text(self, text):
         """Chuẩn hóa text để tìm kiếm không dấu, lowercase"""
         if not text:
             return ""
-        
-        # Chuyển về lowercase
-        text = text.lower()
-        
-        # Loại bỏ dấu tiếng Việt
-        text = re.sub(r'[àáảãạăắằẳẵặâấầẩẫậ]', 'a', text)
-        text = re.sub(r'[đ]', 'd', text)
-        text = re.sub(r'[èéẻẽẹêếềểễệ]', 'e', text)
-        text = re.sub(r'[ìíỉĩị]', 'i', text)
-        text = re.sub(r'[òóỏõọôốồổỗộơớờởỡợ]', 'o', text)
-        text = re.sub(r'[ùúủũụưứừửữự]', 'u', text)
-        text = re.sub(r'[ỳýỷỹỵ]', 'y', text)
-        
-        # Loại bỏ khoảng trắng thừa
-        text = re.sub(r'\s+', ' ', text).strip()
-        
-        return text
+        return normalize_vietnamese(text)
     
     def find_food(self, user_input):
         """Tìm món ăn phù hợp nhất với input của người dùng, trả về (food_name, confidence)"""
-        normalized_input = self.normalize_text(user_input)
-        if not normalized_input:
+        candidates = self.find_candidates(user_input, k=1)
+        if not candidates:
             return None, 0.0
+        return candidates[0]["food_name"], candidates[0]["confidence"]
+
+    def find_candidates(self, user_input, k: int = 5) -> List[Dict[str, Any]]:
+        """
+        Up to `k` distinct foods, best first, as
+        {"food_name", "confidence", "provenance", "matched_text"}.
+
+        Provenance is "exact_alias", "exact_name", "token_subset", "typo" or "keyword";
+        `matched_text` is the normalized name/alias/keyword that produced the match.
+        The first entry is always what find_food returns; the rest are alternatives
+        ordered by confidence, so callers can tell a clear winner from a near-tie.
+        """
+        normalized_input = self.normalize_text(user_input)
+        if not normalized_input or k <= 0:
+            return []
 
         input_tokens = normalized_input.split()
-        
-        # Tìm exact match trong alias map
-        if normalized_input in self.alias_map:
-            return self.alias_map[normalized_input], 0.95
-        
-        # Tìm trong food map
-        if normalized_input in self.food_map:
-            return self.food_map[normalized_input], 0.95
-        
-        # Tìm kiếm fuzzy
-        best_match = (None, 0.0)
-
-        def compute_confidence(token_count: int) -> float:
-            if not input_tokens or token_count == 0:
-                return 0.0
-            coverage = token_count / max(len(input_tokens), token_count, 1)
-            length_bonus = 0.05 * min(token_count, 3)  # thưởng nhẹ cho cụm dài hơn 1 từ
-            # Giới hạn để fuzzy match không quá tự tin
-            return min(0.9, round(0.35 + 0.5 * coverage + length_bonus, 2))
-        
-        # Tìm trong alias map
-        for alias, food_name in self.alias_map.items():
-            alias_tokens = alias.split()
-            if all(tok in input_tokens for tok in alias_tokens):
-                confidence = compute_confidence(len(alias_tokens))
-                if confidence > best_match[1]:
-                    best_match = (food_name, confidence)
-        
-        # Tìm trong food names
-        if not best_match[0]:
-            for food_norm, food_name in self.food_map.items():
-                food_tokens = food_norm.split()
-                if all(tok in input_tokens for tok in food_tokens):
-                    confidence = compute_confidence(len(food_tokens))
-                    if confidence > best_match[1]:
-                        best_match = (food_name, confidence)
-        
-        # Nếu vẫn chưa tìm thấy, thử tìm từ khóa
-        if not best_match[0]:
-            keywords = {
-                "cơm": "cơm trắng",
-                "com": "cơm trắng",
-                "phở": "phở bò",
-                "pho": "phở bò",
-                "bún": "bún chả",
-                "bun": "bún chả",
-                "trứng": "trứng chiên",
-                "trung": "trứng chiên",
-                "sườn": "sườn nướng",
-                "suon": "sườn nướng",
-                "bánh mì": "bánh mì",
-                "banh mi": "bánh mì",
-                "cà phê": "cà phê sữa",
-                "ca phe": "cà phê sữa",
-                "nước cam": "nước cam",
-                "nuoc cam": "nước cam",
-                "thịt": "thịt bò",
-                "thit": "thịt bò",
-                "cá": "cá chiên",
-                "ca": "cá chiên"
-            }
-            
-            for keyword, food_name in keywords.items():
-                if " " in keyword:
-                    if keyword in normalized_input:
-                        return food_name, 0.35
-                else:
-                    if keyword in input_tokens:
-                        return food_name, 0.35
-        
-        return best_match
+        # Một snapshot cho cả lần tìm, kể cả khi build_index chạy song song
+        index = self._index
+
+        # Tìm exact match trong alias map, rồi trong food map
+        exact = None
+        if normalized_input in index.alias_map:
+            exact = (0.95, "exact_alias", index.alias_map[normalized_input], normalized_input)
+        elif normalized_input in index.food_map:
+            exact = (0.95, "exact_name", index.food_map[normalized_input], normalized_input)
+
+        # Tìm kiếm fuzzy: chỉ chấm điểm các key có chung token với input.
+        # Alias được ưu tiên: tên món chỉ thắng khi không alias nào khớp.
+        subsets = []
+        for token_index, name_map, rank_map in (
+            (index.alias_token_index, index.alias_map, index.alias_rank),
+            (index.food_token_index, index.food_map, index.food_rank),
+        ):
+            matches = self._score_token_subset(input_tokens, token_index, name_map, rank_map, index.key_tokens)
+            matches.sort(key=lambda match: (-match[0], match[1]))
+            subsets.extend((conf, "token_subset", food_name, key) for conf, _, food_name, key in matches)
+
+        # Sửa lỗi gõ (vd "phoo bo", "bun chaa") cho các token không có trong index
+        typo_name, typo_conf, corrected_text = self._match_with_typo_correction(input_tokens, index)
+        typo = (typo_conf, "typo", typo_name, corrected_text) if typo_name else None
+
+        if exact:
+            ranked = [exact, *subsets]
+        elif typo and (not subsets or typo_conf > subsets[0][0]):
+            ranked = [typo, *subsets]
+        elif subsets:
+            ranked = [subsets[0], *([typo] if typo else []), *subsets[1:]]
+        else:
+            # Nếu vẫn chưa tìm thấy, thử tìm từ khóa
+            for keyword, food_name in self.KEYWORD_FOODS.items():
+                matched = keyword in normalized_input if " " in keyword else keyword in input_tokens
+                if matched:
+                    return [{
+                        "food_name": food_name,
+                        "confidence": 0.35,
+                        "provenance": "keyword",
+                        "matched_text": keyword,
+                    }]
+            return []
+
+        # Phần còn lại: theo độ tin cậy giảm dần, mỗi món một lần
+        top, rest = ranked[0], sorted(ranked[1:], key=lambda item: -item[0])
+        candidates, seen = [], set()
+        for confidence, provenance, food_name, matched_text in (top, *rest):
+            if food_name in seen:
+                continue
+            seen.add(food_name)
+            candidates.append({
+                "food_name": food_name,
+                "confidence": confidence,
+                "provenance": provenance,
+                "matched_text": matched_text,
+            })
+            if len(candidates) >= k:
+                break
+        return candidates
+
+    @staticmethod
+    def _token_confidence(token_count: int, input_token_count: int) -> float:
+        if not input_token_count or token_count == 0:
+            return 0.0
+        coverage = token_count / max(input_token_count, token_count, 1)
+        length_bonus = 0.05 * min(token_count, 3)  # thưởng nhẹ cho cụm dài hơn 1 từ
+        # Giới hạn để fuzzy match không quá tự tin
+        return min(0.9, round(0.35 + 0.5 * coverage + length_bonus, 2))
+
+    @staticmethod
+    def _score_token_subset(input_tokens, token_index, name_map, rank_map, key_tokens):
+        """
+        [(confidence, rank, food_name, key)] for every key whose tokens all appear in the input.
+        Candidates come from the posting lists of the input tokens only.
+        """
+        input_set = set(input_tokens)
+        scored = []
+        seen = set()
+        for tok in input_set:
+            for key in token_index.get(tok, ()):
+                if key in seen:
+                    continue
+                seen.add(key)
+                tokens = key_tokens[key]
+                if not all(t in input_set for t in tokens):
+                    continue
+                confidence = FoodNameMatcher._token_confidence(len(tokens), len(input_tokens))
+                scored.append((confidence, rank_map[key], name_map[key], key))
+        return scored
+
+    @staticmethod
+    def _match_token_subset(input_tokens, token_index, name_map, rank_map, key_tokens):
+        """
+        Best (food_name, confidence) among keys whose tokens all appear in the input;
+        ties keep the earliest-inserted key, like the original full scan did.
+        """
+        scored = FoodNameMatcher._score_token_subset(input_tokens, token_index, name_map, rank_map, key_tokens)
+        if not scored:
+            return None, 0.0
+        confidence, _, food_name, _ = min(scored, key=lambda match: (-match[0], match[1]))
+        return food_name, confidence
+
+    def typo_candidates(self, token, index=None):
+        """
+        Return [(candidate, edit_distance)] from the SymSpell deletion index, closest
+        and most frequent first. Known or too-short tokens come back unchanged.
+        """
+        index = index or self._index
+        if (
+            len(token) < self.TYPO_MIN_TOKEN_LEN
+            or not token.isalpha()
+            or token in index.alias_token_index
+            or token in index.food_token_index
+        ):
+            return [(token, 0)]
+
+        max_distance = 1 if len(token) <= 4 else self.TYPO_MAX_DISTANCE
+        candidates = set()
+        for variant in _delete_variants(token, max_distance) | {token}:
+            if index.token_frequency(variant):
+                candidates.add(variant)
+            candidates.update(index.typo_deletes.get(variant, ()))
+
+        scored = []
+        for candidate in candidates:
+            distance = _edit_distance(token, candidate)
+            if distance <= max_distance:
+                scored.append((distance, -index.token_frequency(candidate), candidate))
+        scored.sort()
+        return [(candidate, distance) for distance, _, candidate in scored[:self.TYPO_MAX_CANDIDATES]]
+
+    def _match_with_typo_correction(self, input_tokens, index=None):
+        """
+        Exact name/alias match after correcting unknown tokens (vd "phoo bo" -> "pho bo").
+        The correction with the fewest edits wins; confidence is the exact-match score
+        minus a penalty per edit. Returns (food_name, confidence, corrected_text).
+        """
+        index = index or self._index
+        options = [self.typo_candidates(tok, index) for tok in input_tokens]
+        if all(len(opts) == 1 and opts[0][1] == 0 for opts in options):
+            return None, 0.0, None
+        if any(not opts for opts in options):
+            return None, 0.0, None
+
+        best = None
+        for combo in islice(product(*options), self.TYPO_MAX_COMBINATIONS):
+            edits = sum(distance for _, distance in combo)
+            if best is not None and edits >= best[0]:
+                continue
+            corrected_text = " ".join(candidate for candidate, _ in combo)
+            food_name = index.alias_map.get(corrected_text) or index.food_map.get(corrected_text)
+            if food_name:
+                best = (edits, food_name, corrected_text)
+        if best is None:
+            return None, 0.0, None
+        edits, food_name, corrected_text = best
+        return food_name, max(0.0, round(0.95 - self.TYPO_PENALTY_PER_EDIT * edits, 2)), corrected_text
 
     def add_alias(self, alias: str, food_name: str) -> None:
         """Add an alias -> canonical mapping to the in-memory matcher."""
@@ -2883,7 +3223,10 @@ class FoodNameMatcher:
         normalized_alias = self.normalize_text(alias)
         if not normalized_alias:
             return
-        self.alias_map[normalized_alias] = food_name
+        with self._write_lock:
+            self._index.add_alias(normalized_alias, food_name)
+            self.version += 1
+            bump_dataset_version()
 
     def add_food(self, food_name: str, food_data: dict) -> None:
         """
@@ -2897,48 +3240,72 @@ class FoodNameMatcher:
         if not isinstance(food_data, dict):
             food_data = {}
 
-        # Ensure the food exists in the shared dataset.
-        existing = VIETNAMESE_FOODS_NUTRITION.get(food_name)
-        if existing and isinstance(existing, dict):
-            for k, v in food_data.items():
-                if k == "aliases":
-                    continue
-                if v is not None:
-                    existing[k] = v
-            aliases = existing.get("aliases")
-            if not isinstance(aliases, list):
-                aliases = []
-            new_aliases = food_data.get("aliases", [])
-            if isinstance(new_aliases, list):
-                for alias in new_aliases:
-                    if alias and alias not in aliases:
-                        aliases.append(alias)
-            if food_name not in aliases:
-                aliases.append(food_name)
-            existing["aliases"] = aliases
-            VIETNAMESE_FOODS_NUTRITION[food_name] = existing
-        else:
-            data = dict(food_data)
-            aliases = data.get("aliases")
-            if not isinstance(aliases, list):
-                aliases = []
-            if food_name not in aliases:
-                aliases.append(food_name)
-            data["aliases"] = aliases
-            data.setdefault("category", "custom")
-            VIETNAMESE_FOODS_NUTRITION[food_name] = data
-
-        # Update this matcher's searchable maps.
-        normalized_name = self.normalize_text(food_name)
-        if normalized_name:
-            self.food_map[normalized_name] = food_name
-        for alias in VIETNAMESE_FOODS_NUTRITION.get(food_name, {}).get("aliases", []) or []:
-            normalized_alias = self.normalize_text(alias)
-            if normalized_alias:
-                self.alias_map[normalized_alias] = food_name
+        with self._write_lock:
+            # Ensure the food exists in the shared dataset.
+            existing = VIETNAMESE_FOODS_NUTRITION.get(food_name)
+            if existing and isinstance(existing, dict):
+                for k, v in food_data.items():
+                    if k == "aliases":
+                        continue
+                    if v is not None:
+                        existing[k] = v
+                aliases = existing.get("aliases")
+                if not isinstance(aliases, list):
+                    aliases = []
+                new_aliases = food_data.get("aliases", [])
+                if isinstance(new_aliases, list):
+                    for alias in new_aliases:
+                        if alias and alias not in aliases:
+                            aliases.append(alias)
+                if food_name not in aliases:
+                    aliases.append(food_name)
+                existing["aliases"] = aliases
+                VIETNAMESE_FOODS_NUTRITION[food_name] = existing
+            else:
+                data = dict(food_data)
+                aliases = data.get("aliases")
+                if not isinstance(aliases, list):
+                    aliases = []
+                if food_name not in aliases:
+                    aliases.append(food_name)
+                data["aliases"] = aliases
+                data.setdefault("category", "custom")
+                VIETNAMESE_FOODS_NUTRITION[food_name] = data
+
+            # Update this matcher's searchable maps.
+            self._index_entry(self._index, food_name, VIETNAMESE_FOODS_NUTRITION[food_name])
+            self.version += 1
+            bump_dataset_version()
+
+    def learn(self, food_name: str, food_data: Optional[dict] = None, aliases=()) -> None:
+        """
+        Apply one approved learned food/alias without rebuilding the index.
+
+        The dataset is merged exactly like `load_learned_foods` does at startup,
+        then only the keys of `food_name` are (re)indexed, so the cost does not
+        grow with the dataset.
+        """
+        food_name = (food_name or "").strip()
+        if not food_name:
+            return
+        with self._write_lock:
+            if food_data is not None:
+                merge_learned_food(food_name, food_data)
+            for alias in aliases:
+                merge_learned_alias(alias, food_name)
+            data = VIETNAMESE_FOODS_NUTRITION.get(food_name)
+            if not isinstance(data, dict):
+                return
+            self._index_entry(self._index, food_name, data)
+            self.version += 1
+            bump_dataset_version()
 
 class QuantityParser:
     """Phân tích định lượng với sai số"""
+
+    # Mẫu cố định, biên dịch một lần cho mọi instance
+    EXACT_RE = re.compile(r'(\d+(?:\.\d+)?)\s*(g|gr|gram|ml|lít|l|kg|kilogram)(?![a-zA-Z])')
+    NUMBER_RE = re.compile(r'(\d+)')
     
     def __init__(self):
         self.number_words = {
@@ -2959,16 +3326,18 @@ class QuantityParser:
         }
         unit_keys = sorted(UNIT_CONVERSION.keys(), key=len, reverse=True)
         self.unit_pattern = r'(' + '|'.join(map(re.escape, unit_keys)) + r')'
+        # Biên dịch một lần: alternation đơn vị rất dài, không dựa vào cache của `re`
+        self.unit_re = re.compile(rf'(\d+)\s*{self.unit_pattern}')
+        self.word_unit_re = re.compile(
+            rf'(một|môt|mot|hai|ba|bốn|bôn|bon|năm|nam|sáu|sau|bảy|bây|bay|tám|tam|chín|chin|mười|muoi|mấy|vài|dăm)\s+{self.unit_pattern}'
+        )
         
     def parse(self, text):
         """Phân tích định lượng từ text"""
         text = text.lower().strip()
         
         # Mẫu 1: Số chính xác với đơn vị (100g, 500ml)
-        exact_match = re.search(
-            r'(\d+(?:\.\d+)?)\s*(g|gr|gram|ml|lít|l|kg|kilogram)(?![a-zA-Z])',
-            text
-        )
+        exact_match = self.EXACT_RE.search(text)
         if exact_match:
             amount = float(exact_match.group(1))
             unit = exact_match.group(2)
@@ -2989,7 +3358,7 @@ class QuantityParser:
             }
         
         # Mẫu 2: Số + đơn vị tương đối (2 bát, 3 ly)
-        unit_match = re.search(rf'(\d+)\s*{self.unit_pattern}', text)
+        unit_match = self.unit_re.search(text)
         if unit_match:
             amount = int(unit_match.group(1))
             unit = unit_match.group(2)
@@ -3002,10 +3371,7 @@ class QuantityParser:
             }
         
         # Mẫu 3: Số bằng chữ + đơn vị
-        word_match = re.search(
-            rf'(một|môt|mot|hai|ba|bốn|bôn|bon|năm|nam|sáu|sau|bảy|bây|bay|tám|tam|chín|chin|mười|muoi|mấy|vài|dăm)\s+{self.unit_pattern}',
-            text
-        )
+        word_match = self.word_unit_re.search(text)
         if word_match:
             word = word_match.group(1)
             unit = word_match.group(2)
@@ -3019,7 +3385,7 @@ class QuantityParser:
             }
         
         # Mẫu 4: Chỉ có số (mặc định là "phần")
-        number_match = re.search(r'(\d+)', text)
+        number_match = self.NUMBER_RE.search(text)
         if number_match:
             amount = int(number_match.group(1))
             return {
@@ -3037,12 +3403,169 @@ class QuantityParser:
             'confidence': 0.5
         }
 
+class FoodScanner:
+    """
+    Aho-Corasick automaton over the matcher's normalized names/aliases.
+
+    The automaton works on word tokens, so a single pass over a sentence finds
+    every known name on word boundaries, without relying on separators.
+    """
+
+    # Số/đơn vị/nối từ không bao giờ là tên món khi đứng một mình
+    TOKEN_RE = re.compile(r"\d+(?:\.\d+)?[^\W_]*|[^\W_]+")
+
+    def __init__(self, matcher: "FoodNameMatcher", ignored_tokens=()):
+        self.matcher = matcher
+        self.ignored_tokens = set(ignored_tokens)
+        self.build()
+
+    @classmethod
+    def tokenize(cls, text: str) -> List[str]:
+        return cls.TOKEN_RE.findall(text)
+
+    def build(self) -> None:
+        """(Re)build the automaton from the matcher's food_map and alias_map."""
+        # Read before building: a change made meanwhile leaves this automaton stale.
+        self.version = self.matcher.version
+        goto: List[Dict[str, int]] = [{}]
+        # outputs[node] = [(token_length, food_name)], longest first
+        outputs: List[List[Tuple[int, str]]] = [[]]
+        terminal: Dict[int, str] = {}
+
+        # alias_map sau food_map để alias thắng khi trùng key (giống find_food)
+        for name_map in (self.matcher.food_map, self.matcher.alias_map):
+            for key, food_name in list(name_map.items()):
+                tokens = self.tokenize(key)
+                if not tokens or all(tok in self.ignored_tokens for tok in tokens):
+                    continue
+                node = 0
+                for tok in tokens:
+                    nxt = goto[node].get(tok)
+                    if nxt is None:
+                        nxt = len(goto)
+                        goto[node][tok] = nxt
+                        goto.append({})
+                        outputs.append([])
+                    node = nxt
+                terminal[node] = food_name
+                outputs[node] = [(len(tokens), food_name)]
+
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for tok, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and tok not in goto[state]:
+                    state = fail[state]
+                fallback = goto[state].get(tok, 0)
+                fail[child] = fallback if fallback != child else 0
+                outputs[child] = outputs[child] + outputs[fail[child]]
+
+        self._goto = goto
+        self._fail = fail
+        self._outputs = outputs
+        self.size = len(terminal)
+
+    def scan(self, tokens: List[str]) -> List[Tuple[int, int, str]]:
+        """
+        Return non-overlapping (start, end, food_name) token spans, leftmost-longest.
+        `tokens` must already be normalized.
+        """
+        goto, fail, outputs = self._goto, self._fail, self._outputs
+        matches: List[Tuple[int, int, str]] = []
+        node = 0
+        for pos, tok in enumerate(tokens):
+            while node and tok not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(tok, 0)
+            for length, food_name in outputs[node]:
+                matches.append((pos + 1 - length, pos + 1, food_name))
+
+        matches.sort(key=lambda m: (m[0], m[0] - m[1]))
+        selected: List[Tuple[int, int, str]] = []
+        last_end = 0
+        for start, end, food_name in matches:
+            if start >= last_end:
+                selected.append((start, end, food_name))
+                last_end = end
+        return selected
+
+
 class FoodExtractor:
     """Trích xuất món ăn từ câu"""
-    
-    def __init__(self):
+
+    # Loại bỏ từ không cần thiết (chỉ tập trung vào món ăn)
+    STOP_WORDS = [
+        'tôi', 'mình', 'em', 'anh', 'chị', 'bạn', 'hôm nay',
+        'sáng', 'trưa', 'tối', 'đã', 'ăn', 'uống', 'dùng', 'thì',
+        'có', 'bữa', 'bữa ăn', 'hôm qua', 'ngày mai'
+    ]
+    # Từ nối giữa các món (dùng cho chế độ scan)
+    CONNECTOR_WORDS = ['và', 'rồi', 'sau đó', 'tiếp theo', 'cùng', 'với']
+    NO_SUGAR_TOKENS = {'khong', 'ko', 'k0', 'co', 'duong', 'no', 'sugar', 'free', 'unsweetened'}
+    MODES = ("split", "scan")
+    # Từ thừa còn lại sau khi bỏ định lượng
+    UNNECESSARY_WORDS = ['cái', 'cục', 'miếng', 'phần', 'suất', 'của']
+
+    # Regex dùng trong mỗi lần extract, biên dịch một lần
+    SEPARATOR_RE = re.compile(r'[,\.;]|\+|\bvà\b|\brồi\b|\bsau đó\b|\btiếp theo\b|\bcùng\b|\bvới\b')
+    WHITESPACE_RE = re.compile(r'\s+')
+    NO_SUGAR_NORMALIZED_RE = re.compile(r"\b(khong|ko|k0)\s*(co\s*)?duong\b")
+    NO_SUGAR_REMOVE_RES = (
+        re.compile(r"(không|khong|ko|k0)\s*(có\s*)?đường", re.IGNORECASE),
+        re.compile(r"(khong|ko|k0)\s*(co\s*)?duong", re.IGNORECASE),
+        re.compile(r"\bno\s*sugar\b", re.IGNORECASE),
+        re.compile(r"\bsugar\s*free\b", re.IGNORECASE),
+        re.compile(r"\bunsweetened\b", re.IGNORECASE),
+    )
+    EXACT_QUANTITY_RE = re.compile(r'\d+(?:\.\d+)?\s*(?:g|gr|gram|ml|lít|l|kg|kilogram)')
+    # Số phương án giữ lại cho mỗi món (xem FoodNameMatcher.find_candidates)
+    MATCH_CANDIDATES = 3
+    
+    def __init__(self, mode: str = "split", cache_size: int = 0):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown extraction mode: {mode}")
+        self.mode = mode
+        # Cache kết quả extract (0 = tắt); key gồm dataset version nên tự hết hạn khi học món mới
+        self.cache: Optional[LRUCache] = LRUCache(cache_size) if cache_size > 0 else None
         self.matcher = FoodNameMatcher()
         self.parser = QuantityParser()
+        self.filler_tokens = self._scan_filler_tokens()
+        self._scanner: Optional[FoodScanner] = None
+        # Một alternation cho mọi stop word (dài trước) thay vì một re.sub mỗi từ
+        self.stop_words_re = self._word_alternation(self.STOP_WORDS)
+        self.unnecessary_words_re = self._word_alternation(self.UNNECESSARY_WORDS)
+
+    @staticmethod
+    def _word_alternation(words) -> "re.Pattern":
+        ordered = sorted(words, key=len, reverse=True)
+        return re.compile(r'\b(?:' + '|'.join(map(re.escape, ordered)) + r')\b')
+
+    @property
+    def scanner(self) -> FoodScanner:
+        """Aho-Corasick scanner, built on first use and after matcher updates."""
+        scanner = self._scanner
+        if scanner is None or scanner.version != self.matcher.version:
+            scanner = FoodScanner(self.matcher, self.filler_tokens)
+            self._scanner = scanner
+        return scanner
+
+    def _scan_filler_tokens(self) -> set:
+        words = [*self.STOP_WORDS, *self.CONNECTOR_WORDS, *self.parser.number_words, *UNIT_CONVERSION]
+        tokens = set()
+        for word in words:
+            tokens.update(self.matcher.normalize_text(word).split())
+        return tokens
+
+    def unexplained_tokens(self, food_text: str, matched_text: str) -> List[str]:
+        """Tokens of `food_text` covered neither by the matched name/alias nor by filler words."""
+        matched_tokens = set((matched_text or "").split())
+        return [
+            tok for tok in FoodScanner.tokenize(self.matcher.normalize_text(food_text))
+            if tok not in matched_tokens and tok not in self.filler_tokens
+        ]
 
     def _has_no_sugar(self, text: str) -> bool:
         """Detect 'không đường' / 'no sugar' markers in the same food segment."""
@@ -3050,7 +3573,7 @@ class FoodExtractor:
         if not normalized:
             return False
 
-        if re.search(r"\b(khong|ko|k0)\s*(co\s*)?duong\b", normalized):
+        if self.NO_SUGAR_NORMALIZED_RE.search(normalized):
             return True
         if "no sugar" in normalized or "sugar free" in normalized or "unsweetened" in normalized:
             return True
@@ -3061,48 +3584,55 @@ class FoodExtractor:
         if not text:
             return text
 
-        result = re.sub(
-            r"(không|khong|ko|k0)\s*(có\s*)?đường",
-            " ",
-            text,
-            flags=re.IGNORECASE,
-        )
-        result = re.sub(
-            r"(khong|ko|k0)\s*(co\s*)?duong",
-            " ",
-            result,
-            flags=re.IGNORECASE,
-        )
-        result = re.sub(r"\bno\s*sugar\b", " ", result, flags=re.IGNORECASE)
-        result = re.sub(r"\bsugar\s*free\b", " ", result, flags=re.IGNORECASE)
-        result = re.sub(r"\bunsweetened\b", " ", result, flags=re.IGNORECASE)
-        return re.sub(r"\s+", " ", result).strip()
+        result = text
+        for pattern in self.NO_SUGAR_REMOVE_RES:
+            result = pattern.sub(" ", result)
+        return self.WHITESPACE_RE.sub(" ", result).strip()
         
     def extract(self, text):
         """Trích xuất các món ăn từ text"""
-        # Loại bỏ từ không cần thiết (chỉ tập trung vào món ăn)
-        stop_words = [
-            'tôi', 'mình', 'em', 'anh', 'chị', 'bạn', 'hôm nay',
-            'sáng', 'trưa', 'tối', 'đã', 'ăn', 'uống', 'dùng', 'thì',
-            'có', 'bữa', 'bữa ăn', 'hôm qua', 'ngày mai'
-        ]
-        # Các từ nối dùng để tách nhiều món trong cùng câu
-        separators = r'[,\.;]|\+|\bvà\b|\brồi\b|\bsau đó\b|\btiếp theo\b|\bcùng\b|\bvới\b'
-        
-        # Tách câu trước rồi mới loại bỏ stop words để tránh dính các món lại với nhau
-        parts = re.split(separators, text.lower())
+        return [seg['food'] for seg in self.extract_segments(text) if seg['food'] is not None]
+
+    def extract_segments(self, text):
+        """
+        Các đoạn món theo thứ tự trong câu: {'text', 'food'}; food là None khi đoạn
+        có chữ nhưng không match được món nào (dùng cho fallback LLM theo đoạn).
+        """
+        if self.cache is None:
+            return self._segments_uncached(text)
+
+        # Kết quả chỉ phụ thuộc text.lower() (khoảng trắng đầu/cuối bị bỏ khi tách câu)
+        key = (get_dataset_version(), self.mode, text.lower().strip())
+        segments = self.cache.get(key)
+        if segments is None:
+            segments = self._segments_uncached(text)
+            self.cache.put(key, copy.deepcopy(segments))
+            return segments
+        return copy.deepcopy(segments)
+
+    def _segments_uncached(self, text):
+        if self.mode == "scan":
+            return self._scan_segments(text)
+        return self._split_segments(text)
+
+    def extract_split(self, text):
+        """Tách câu theo dấu câu/từ nối rồi match từng phần"""
+        return [seg['food'] for seg in self._split_segments(text) if seg['food'] is not None]
+
+    def _split_segments(self, text):
+        # Tách câu trước (dấu câu + từ nối, xem SEPARATOR_RE) rồi mới loại bỏ
+        # stop words để tránh dính các món lại với nhau
+        parts = self.SEPARATOR_RE.split(text.lower())
         
-        foods = []
+        segments = []
         for part in parts:
             part = part.strip()
             if not part or len(part) < 2:
                 continue
             
-            # Loại bỏ stop words trong từng phần
-            clean_part = part
-            for word in stop_words:
-                clean_part = re.sub(rf'\b{re.escape(word)}\b', ' ', clean_part)
-            clean_part = re.sub(r'\s+', ' ', clean_part).strip()
+            # Loại bỏ stop words trong từng phần (một lượt)
+            clean_part = self.stop_words_re.sub(' ', part)
+            clean_part = self.WHITESPACE_RE.sub(' ', clean_part).strip()
             if not clean_part:
                 continue
 
@@ -3116,52 +3646,152 @@ class FoodExtractor:
             # Tìm tên món ăn (loại bỏ số và đơn vị đã tìm thấy)
             food_text = self._remove_quantity_from_text(clean_part, quantity_info)
             
-            # Tìm món ăn phù hợp
-            food_name, match_confidence = self.matcher.find_food(food_text)
+            # Tìm món ăn phù hợp (giữ cả các phương án kế tiếp)
+            candidates = self.matcher.find_candidates(food_text, self.MATCH_CANDIDATES)
             
-            if food_name:
-                foods.append({
+            if candidates:
+                segments.append({'text': part, 'food': {
                     'original_text': part.strip(),
-                    'food_name': food_name,
-                    'match_confidence': match_confidence,
+                    'food_name': candidates[0]['food_name'],
+                    'match_confidence': candidates[0]['confidence'],
+                    'match_candidates': candidates,
                     'quantity_info': quantity_info,
                     'extracted_food_text': food_text,
                     'no_sugar': no_sugar
-                })
+                }})
+            elif self._is_food_like(food_text):
+                segments.append({'text': part, 'food': None})
         
-        return foods
-    
+        return segments
+
+    def _is_food_like(self, text: str) -> bool:
+        """Đoạn không match được nhưng còn chữ ngoài từ đệm/"không đường" (đáng hỏi LLM)."""
+        ignored = self.filler_tokens | self.NO_SUGAR_TOKENS
+        return any(
+            tok not in ignored and any(ch.isalpha() for ch in tok)
+            for tok in FoodScanner.tokenize(self.matcher.normalize_text(text))
+        )
+
+    def extract_scan(self, text):
+        """
+        Quét cả câu một lần bằng Aho-Corasick, không cần dấu phân cách.
+
+        Định lượng trong đoạn đứng trước một món thuộc về món đó; đoạn cuối câu
+        thuộc về món cuối cùng. Cụm "không đường" sau món gán cho món đứng trước.
+        Từ lạ còn thừa giữa các món được thử lại bằng find_candidates.
+        Nếu không quét được món nào thì quay về chế độ tách câu.
+        """
+        return [seg['food'] for seg in self._scan_segments(text) if seg['food'] is not None]
+
+    def _scan_segments(self, text):
+        raw_tokens = FoodScanner.tokenize(text.lower())
+        norm_tokens = [self.matcher.normalize_text(tok) for tok in raw_tokens]
+        scanner = self.scanner
+        matches = scanner.scan(norm_tokens)
+        if not matches:
+            return self._split_segments(text)
+
+        ignored = scanner.ignored_tokens | self.NO_SUGAR_TOKENS
+        segments = []
+        prev = None  # món đứng ngay trước gap hiện tại
+        prev_end = 0
+        for start, end, food_name in [*matches, (len(raw_tokens), len(raw_tokens), None)]:
+            gap_text = " ".join(raw_tokens[prev_end:start])
+            residual_at = [
+                i for i in range(prev_end, start)
+                if norm_tokens[i] not in ignored and not norm_tokens[i][0].isdigit()
+            ]
+            residual = [norm_tokens[i] for i in residual_at]
+            residual_candidates = []
+            if residual:
+                residual_candidates = self.matcher.find_candidates(" ".join(residual), self.MATCH_CANDIDATES)
+
+            gap_quantity = self.parser.parse(gap_text)
+            if residual_candidates:
+                # Món chưa có trong automaton: giữ lại cùng định lượng của gap
+                segments.append({'text': gap_text, 'food': {
+                    'original_text': gap_text,
+                    'food_name': residual_candidates[0]['food_name'],
+                    'match_confidence': residual_candidates[0]['confidence'],
+                    'match_candidates': residual_candidates,
+                    'quantity_info': gap_quantity,
+                    'extracted_food_text': " ".join(residual),
+                    'no_sugar': self._has_no_sugar(gap_text)
+                }})
+                gap_text, gap_quantity = "", self.parser.parse("")
+            elif self._is_food_like(" ".join(residual)):
+                # Từ lạ không match được: để LLM xử lý riêng đoạn này
+                segments.append({'text': " ".join(raw_tokens[residual_at[0]:residual_at[-1] + 1]), 'food': None})
+
+            if prev is not None and not residual_candidates and self._has_no_sugar(gap_text):
+                prev['no_sugar'] = True
+
+            if food_name is None:
+                # Đoạn cuối câu: định lượng đứng sau món cuối (vd "ức gà 150g")
+                if prev is not None and gap_quantity['confidence'] > prev['quantity_info']['confidence']:
+                    prev['quantity_info'] = gap_quantity
+                    prev['original_text'] = f"{prev['original_text']} {gap_text}"
+                break
+
+            food_text = " ".join(raw_tokens[start:end])
+            prev = {
+                'original_text': " ".join(filter(None, [gap_text, food_text])),
+                'food_name': food_name,
+                'match_confidence': 0.95,
+                'quantity_info': gap_quantity,
+                'extracted_food_text': food_text,
+                'no_sugar': False
+            }
+            segments.append({'text': None, 'food': prev})
+            prev_end = end
+
+        for seg in segments:
+            if seg['text'] is None:
+                seg['text'] = seg['food']['original_text']
+        return segments
+
     def _remove_quantity_from_text(self, text, quantity_info):
         """Loại bỏ phần định lượng đã trích xuất khỏi text"""
         result = text.lower()
         
         # Loại bỏ số và đơn vị
         if quantity_info['type'] == 'exact':
-            pattern = r'\d+(?:\.\d+)?\s*(?:g|gr|gram|ml|lít|l|kg|kilogram)'
-            result = re.sub(pattern, '', result)
+            result = self.EXACT_QUANTITY_RE.sub('', result)
         else:
             unit_pattern = re.escape(quantity_info['unit'])
             # Loại bỏ số và đơn vị
             if quantity_info['amount'] > 1:
                 pattern = f"{quantity_info['amount']}\\s*{unit_pattern}"
-                result = re.sub(pattern, '', result)
             else:
                 # Nếu amount = 1, có thể là "một" hoặc "1"
                 pattern = f"(?:một|môt|mot|1)\\s*{unit_pattern}"
-                result = re.sub(pattern, '', result)
+            result = _compile_cached(pattern).sub('', result)
         
         # Loại bỏ khoảng trắng thừa và từ thừa
-        result = re.sub(r'\s+', ' ', result).strip()
+        result = self.WHITESPACE_RE.sub(' ', result).strip()
         
         # Loại bỏ từ thừa
-        unnecessary = ['cái', 'cục', 'miếng', 'phần', 'suất', 'của']
-        for word in unnecessary:
-            result = re.sub(f'\\b{word}\\b', '', result)
+        result = self.unnecessary_words_re.sub('', result)
         
-        return re.sub(r'\s+', ' ', result).strip()
+        return self.WHITESPACE_RE.sub(' ', result).strip()
+
+# Điều chỉnh theo loại thức ăn
+CATEGORY_WEIGHT_MULTIPLIER = {
+    'drink': 1.0,   # ml
+    'rice': 0.9,    # cơm đặc
+    'noodle': 0.8,  # có nước
+    'bread': 1.2,   # bánh mì nhẹ hơn
+}
+DEFAULT_PORTION_WEIGHT = 200  # Mặc định 200g/portion
+
+
+def estimate_weight(quantity_info, food_category=None, deterministic=None):
+    """
+    Ước lượng trọng lượng với sai số.
 
-def estimate_weight(quantity_info, food_category=None):
-    """Ước lượng trọng lượng với sai số"""
+    deterministic=True trả đúng giá trị trung tâm (default của đơn vị) để cùng input
+    luôn ra cùng kết quả; None lấy theo Config.DETERMINISTIC_WEIGHT.
+    """
     if quantity_info['type'] == 'exact':
         return quantity_info['amount']
     
@@ -3170,19 +3800,12 @@ def estimate_weight(quantity_info, food_category=None):
     
     if unit in UNIT_CONVERSION:
         unit_info = UNIT_CONVERSION[unit]
-        
-        # Điều chỉnh theo loại thức ăn
-        multiplier = 1.0
-        if food_category == 'drink':
-            multiplier = 1.0  # ml
-        elif food_category == 'rice':
-            multiplier = 0.9  # cơm đặc
-        elif food_category == 'noodle':
-            multiplier = 0.8  # có nước
-        elif food_category == 'bread':
-            multiplier = 1.2  # bánh mì nhẹ hơn
-        
-        base_weight = unit_info['default'] * multiplier
+        base_weight = unit_info['default'] * CATEGORY_WEIGHT_MULTIPLIER.get(food_category, 1.0)
+
+        if deterministic is None:
+            deterministic = Config.DETERMINISTIC_WEIGHT
+        if deterministic:
+            return base_weight * amount
         
         # Thêm sai số ngẫu nhiên nhỏ (±10%)
         error_range = 0.1  # 10%
@@ -3190,7 +3813,21 @@ def estimate_weight(quantity_info, food_category=None):
         
         return weight * amount
     
-    return 200 * amount  # Mặc định 200g/portion
+    return DEFAULT_PORTION_WEIGHT * amount
+
+
+def estimate_weight_range(quantity_info, food_category=None):
+    """Khoảng (min, max) gram theo min/max của UNIT_CONVERSION, cùng hệ số loại món."""
+    amount = quantity_info['amount']
+    if quantity_info['type'] == 'exact':
+        return amount, amount
+
+    unit_info = UNIT_CONVERSION.get(quantity_info['unit'])
+    if not unit_info:
+        return DEFAULT_PORTION_WEIGHT * amount, DEFAULT_PORTION_WEIGHT * amount
+
+    multiplier = CATEGORY_WEIGHT_MULTIPLIER.get(food_category, 1.0)
+    return unit_info['min'] * multiplier * amount, unit_info['max'] * multiplier * amount
 
 def calculate_nutrition(food_name, weight):
     """Tính dinh dưỡng cho món ăn"""